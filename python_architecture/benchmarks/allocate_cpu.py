@@ -0,0 +1,53 @@
+"""Python CPU time per `services.allocate`, with and without cached statements.
+
+Runs against an in-memory SQLite, so that what we measure is the time spent in
+our code and in SQLAlchemy (building, compiling, hydrating) and not the network.
+Every allocation goes to its own sku, so hydration stays the same size (loading
+a long allocation history dwarfs everything else, see the write-only mode):
+
+    python benchmarks/allocate_cpu.py [allocations] [batches per sku]
+"""
+
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters import engines, orm
+from allocation.service_layer import services, unit_of_work
+
+
+def cpu_per_allocate(cached: bool, allocations: int, batches: int) -> float:
+    engine = create_engine(
+        'sqlite://', execution_options=engines.cached_statements() if cached else {}
+    )
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            sessionmaker(bind=engine), baked_queries=cached
+        )
+        for sku in range(allocations + 1):
+            for i in range(batches):
+                services.add_batch(f'batch-{sku}-{i}', f'SKU-{sku}', 10, None, uow)
+
+        services.allocate('warm-up', f'SKU-{allocations}', 1, uow)
+        start = time.process_time()
+        for i in range(allocations):
+            services.allocate(f'order-{i}', f'SKU-{i}', 1, uow)
+        return (time.process_time() - start) / allocations
+    finally:
+        clear_mappers()
+
+
+if __name__ == '__main__':
+    allocations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batches = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    # best of 3, alternating, so warm-up effects don't favour either side
+    runs = [(cpu_per_allocate(False, allocations, batches),
+             cpu_per_allocate(True, allocations, batches)) for _ in range(3)]
+    before, after = min(r[0] for r in runs), min(r[1] for r in runs)
+    print(f'uncached: {before * 1e6:,.0f} us CPU per allocate')
+    print(f'cached:   {after * 1e6:,.0f} us CPU per allocate ({before / after:.2f}x)')
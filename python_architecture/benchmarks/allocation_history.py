@@ -0,0 +1,52 @@
+"""Latency and memory of one `services.allocate` vs the allocation history of
+the batch, with `Batch._allocations` as a set vs write-only:
+
+    python benchmarks/allocation_history.py [history sizes...]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters import orm
+from allocation.service_layer import services, unit_of_work
+
+
+def one_allocate(write_only: bool, history: int):
+    engine = create_engine('sqlite://')
+    orm.metadata.create_all(engine)
+    orm.start_mappers(write_only_allocations=write_only)
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+        services.add_batch('b1', 'LAMP', history + 10, None, uow)
+        with engine.begin() as conn:  # the history, without going through the ORM
+            batch_id = conn.execute(orm.batches.select()).first().id
+            conn.execute(orm.order_lines.insert(), [
+                {'orderid': f'o{i}', 'sku': 'LAMP', 'qty': 1} for i in range(history)
+            ])
+            conn.execute(orm.allocations.insert().from_select(
+                ['orderline_id', 'batch_id'],
+                orm.order_lines.select().with_only_columns([orm.order_lines.c.id, batch_id]),
+            ))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        services.allocate('o-new', 'LAMP', 1, uow)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak
+    finally:
+        clear_mappers()
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [100, 1_000, 10_000, 100_000]
+    for history in sizes:
+        for write_only in (False, True):
+            elapsed, peak = one_allocate(write_only, history)
+            print(f'{history:>8,} lines, {"write-only" if write_only else "set":>10}: '
+                  f'{elapsed * 1000:8.1f} ms {peak / 1024:10,.0f} KB')
@@ -0,0 +1,98 @@
+"""Cold start: from `import flask_app` to the first 200, in fresh interpreters.
+
+On a sqlite file (so it runs anywhere), seeded with a few products. Every run is
+a new process, i.e. what a new Cloud Run instance goes through. `delay` is how
+long after start-up the first request comes in, for the pre-warm to have a go.
+
+    python benchmarks/cold_start.py [runs] [delay ms]
+
+On a laptop (python 3.11, SQLAlchemy 1.3, Flask 3), medians of 15 runs:
+
+                          import   1st request   import -> 200   2nd request
+    eager engines [*]      ~380ms      ~48ms          ~435ms          ~3ms
+    lazy engines           ~350ms      ~52ms          ~410ms          ~3ms
+    lazy + pre-warm, 50ms  ~340ms       ~6ms          ~350ms          ~2ms
+
+[*] before, with the engines created (sqlite: and the schema) on import.
+The import of Flask and SQLAlchemy (~300ms) is the bulk of it and can't be
+deferred, the service needs both for any request. What is deferred is what
+comes after: creating the engines, connecting, configuring the mappers,
+compiling the queries and the first reads. Which the pre-warm then does while
+nobody is waiting (import -> 200 doesn't count the 50ms nobody asked for
+anything). On postgres connecting costs more (TCP, TLS, auth), and so the
+pre-warm saves more.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SKUS = [f'SKU-{i}' for i in range(10)]
+
+SEED = '''
+from allocation.entrypoints.flask_app import app
+client = app.test_client()
+for sku in {skus!r}:
+    client.post('/add_batch', json={{'ref': f'b-{{sku}}', 'sku': sku, 'qty': 100}})
+'''
+
+COLD_START = '''
+import json, time
+start = time.perf_counter()
+from allocation.entrypoints import flask_app
+imported = time.perf_counter()
+time.sleep({delay})
+client = flask_app.app.test_client()
+first = time.perf_counter()
+status = client.get('/products/{sku}').status_code
+first_done = time.perf_counter()
+client.get('/products/{sku}')
+second_done = time.perf_counter()
+print(json.dumps({{
+    'status': status,
+    'import': imported - start,
+    'first': first_done - first,
+    'to_first_200': first_done - start - {delay},
+    'second': second_done - first_done,
+}}))
+'''
+
+
+def run(script: str, env: dict) -> str:
+    return subprocess.run(
+        [sys.executable, '-c', script], env=env, check=True,
+        capture_output=True, text=True,
+    ).stdout
+
+
+def cold_starts(env: dict, runs: int, delay: float) -> dict:
+    results = []
+    for _ in range(runs):
+        result = json.loads(run(COLD_START.format(delay=delay, sku=SKUS[0]), env))
+        assert result['status'] == 200, result
+        results.append(result)
+    return {key: statistics.median(r[key] for r in results)
+            for key in ('import', 'first', 'to_first_200', 'second')}
+
+
+def show(name: str, timings: dict) -> None:
+    print(f'{name:<24}' + '  '.join(
+        f'{key} {seconds * 1000:6.1f}ms' for key, seconds in timings.items()
+    ))
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DB_BACKEND='sqlite',
+                   SQLITE_PATH=os.path.join(directory, 'allocation.db'))
+        run(SEED.format(skus=SKUS), env)
+
+        show('lazy engines', cold_starts(env, runs, 0))
+        prewarm = dict(env, PREWARM='1', PREWARM_SKUS=','.join(SKUS))
+        show(f'pre-warm, {delay * 1000:.0f}ms', cold_starts(prewarm, runs, delay))
@@ -0,0 +1,47 @@
+"""Sends/sec and queue latency of the email transport vs a connection per email.
+
+Needs a local SMTP server which accepts everything, e.g. a debugging server:
+
+    python -m aiosmtpd -n -l localhost:1025 &
+    python benchmarks/email_transport.py [emails] [port]
+"""
+
+import smtplib
+import sys
+import time
+from email.message import EmailMessage
+
+from allocation.adapters import email
+
+
+def connection_per_email(port: int, emails: int) -> float:
+    start = time.perf_counter()
+    for i in range(emails):
+        message = EmailMessage()
+        message['From'], message['To'] = 'allocation@made.com', 'stock@made.com'
+        message.set_content(f'Out of stock for SKU-{i}')
+        with smtplib.SMTP('localhost', port) as smtp:
+            smtp.send_message(message)
+    return emails / (time.perf_counter() - start)
+
+
+def pooled(port: int, emails: int) -> email.TransportStats:
+    transport = email.SmtpTransport('localhost', port)
+    start = time.perf_counter()
+    for i in range(emails):
+        transport.send('stock@made.com', f'Out of stock for SKU-{i}')
+    enqueued = time.perf_counter() - start
+    transport.close()
+    print(f'handlers blocked for {enqueued / emails * 1e6:,.0f} us per email')
+    return transport.stats()
+
+
+if __name__ == '__main__':
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1025
+
+    print(f'connection per email: {connection_per_email(port, emails):,.0f} sends/s')
+    stats = pooled(port, emails)
+    print(f'pooled and batched:   {stats.sends_per_sec:,.0f} sends/s in '
+          f'{stats.batches} batches, queue latency {stats.mean_latency * 1000:.1f}ms '
+          f'(max {stats.max_latency * 1000:.1f}ms)')
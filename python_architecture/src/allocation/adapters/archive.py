@@ -0,0 +1,127 @@
+"""Moves exhausted batches (and their allocations) out of the live tables.
+
+`Product.batches` would otherwise keep every batch ever received for a sku and
+`Product.allocate` sorts and scans all of them, even the ones which can't take
+a single unit anymore. A batch is exhausted when its allocations add up to the
+purchased quantity. The job works in chunks of batch ids, one transaction per
+chunk, entirely in SQL (no aggregates are loaded):
+
+* copy the batches to `archived_batches`, the allocations to `archived_allocations`
+* delete them from `allocations` and `batches` (order lines stay where they are)
+* bump `version_number` of the products, so in-flight writers and warm-start
+  snapshots notice the aggregate changed
+
+Run it in the background with `python -m allocation.adapters.archive`.
+"""
+
+import logging
+import sys
+import time
+from typing import List, Tuple
+
+from sqlalchemy import bindparam, func, select
+
+from allocation.adapters import orm
+from allocation.service_layer import unit_of_work
+
+
+logger = logging.getLogger(__name__)
+
+
+def _exhausted_batches(conn, after_id: int, chunk_size: int) -> List[tuple]:
+    allocated = (
+        select([
+            orm.allocations.c.batch_id,
+            func.sum(orm.order_lines.c.qty).label('allocated'),
+        ])
+        .select_from(orm.allocations.join(orm.order_lines))
+        .group_by(orm.allocations.c.batch_id)
+        .alias('allocated')
+    )
+    return list(conn.execute(
+        select([orm.batches.c.id, orm.batches.c.sku, orm.batches.c.partition])
+        .select_from(orm.batches.join(
+            allocated, allocated.c.batch_id == orm.batches.c.id
+        ))
+        .where(orm.batches.c._purchased_quantity <= allocated.c.allocated)
+        .where(orm.batches.c.id > after_id)
+        .order_by(orm.batches.c.id)
+        .limit(chunk_size)
+    ))
+
+
+def _archive_chunk(conn, ids: List[int], products: List[Tuple[str, str]]) -> None:
+    batch_columns = ['id', 'reference', 'sku', 'partition', '_purchased_quantity', 'eta']
+    conn.execute(orm.archived_batches.insert().from_select(
+        batch_columns,
+        select([orm.batches.c[name] for name in batch_columns])
+        .where(orm.batches.c.id.in_(ids)),
+    ))
+    allocation_columns = ['id', 'orderline_id', 'batch_id']
+    conn.execute(orm.archived_allocations.insert().from_select(
+        allocation_columns,
+        select([orm.allocations.c[name] for name in allocation_columns])
+        .where(orm.allocations.c.batch_id.in_(ids)),
+    ))
+    conn.execute(orm.allocations.delete().where(orm.allocations.c.batch_id.in_(ids)))
+    conn.execute(orm.batches.delete().where(orm.batches.c.id.in_(ids)))
+    conn.execute(
+        orm.products.update()
+        .where(orm.products.c.sku == bindparam('b_sku'))
+        .where(orm.products.c.partition == bindparam('b_partition'))
+        .values(version_number=orm.products.c.version_number + 1),
+        [{'b_sku': sku, 'b_partition': partition} for sku, partition in products],
+    )
+
+
+def archive_exhausted_batches(engine, chunk_size: int = 1000, attempts: int = 3) -> int:
+    """One pass over the live batches, returns how many were archived"""
+    archived, after_id = 0, 0
+    while True:
+        ids = _archive_next_chunk(engine, after_id, chunk_size, attempts)
+        if not ids:
+            return archived
+        archived += len(ids)
+        after_id = ids[-1]
+
+
+def _archive_next_chunk(engine, after_id: int, chunk_size: int, attempts: int) -> List[int]:
+    """A transaction per chunk, again when an allocation to one of its products
+    committed in between (exhausted batches are on the hot skus)
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            with engine.begin() as conn:
+                chunk = _exhausted_batches(conn, after_id, chunk_size)
+                ids = [batch_id for batch_id, _, _ in chunk]
+                if ids:
+                    _archive_chunk(conn, ids, sorted({(sku, p) for _, sku, p in chunk}))
+                return ids
+        except Exception as e:
+            if attempt == attempts or not unit_of_work.is_conflict(e):
+                raise
+            logger.info('archiving after batch %s conflicted, again (%s)', after_id, e)
+    return []
+
+
+def run_forever(engine, interval: float = 300) -> None:
+    """The background job: a pass every `interval` seconds, a failed pass is
+    logged and the next one comes as usual
+    """
+    while True:
+        start = time.perf_counter()
+        try:
+            archived = archive_exhausted_batches(engine)
+        except Exception:
+            logger.exception('archiving failed, next pass in %ss', interval)
+        else:
+            logger.info(
+                'archived %s batches in %.1fs', archived, time.perf_counter() - start
+            )
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else 300
+    run_forever(unit_of_work.DEFAULT_ENGINE, interval)
@@ -0,0 +1,187 @@
+"""Bulk ingest of inbound shipments, bypassing the domain model on purpose.
+
+`services.add_batch` is one unit of work, one `products.get` and one commit per
+batch, fine for the API but not for files with 100k+ rows. Here we stream the
+file in chunks and per chunk, in a single transaction:
+
+* insert the missing products (one SELECT .. IN + one executemany)
+* insert the batches (executemany, or COPY on postgres)
+* bump `version_number` once per product, so concurrent allocations notice
+* recompute the `stock_levels` rows of those skus
+* move the checkpoint of the file forward
+
+Since the checkpoint is committed together with the chunk, a failed load can be
+re-run with the same file and continues after the last committed chunk.
+"""
+
+import csv
+import io
+import time
+from dataclasses import dataclass
+from datetime import date
+from itertools import islice
+from typing import Iterator, List, Optional, TypedDict
+
+from sqlalchemy import bindparam, select
+
+from allocation.adapters import orm, stock_levels
+from allocation.domain import model
+
+
+class BatchRow(TypedDict):
+    """A row of the batches table"""
+    reference: str
+    sku: str
+    partition: str
+    _purchased_quantity: int
+    eta: Optional[date]
+
+
+@dataclass
+class LoadStats:
+    rows: int = 0
+    skipped: int = 0
+    products_created: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+# =========== Readers =================================
+# =====================================================
+def _to_row(record: dict) -> BatchRow:
+    eta = record.get('eta') or None
+    if isinstance(eta, str):
+        eta = date.fromisoformat(eta)
+    return {
+        'reference': record['ref'],
+        'sku': record['sku'],
+        'partition': record.get('partition') or model.DEFAULT_PARTITION,
+        '_purchased_quantity': int(record['qty']),
+        'eta': eta,
+    }
+
+
+def read_csv(path) -> Iterator[BatchRow]:
+    """Expects a header with ref, sku, qty and (optional) eta and partition
+    columns, a row without a partition is for the sku's default one
+    """
+    with open(path, newline='') as f:
+        for record in csv.DictReader(f):
+            yield _to_row(record)
+
+
+def read_parquet(path, batch_size: int = 10_000) -> Iterator[BatchRow]:
+    """Needs pyarrow, which is not a dependency of the service itself"""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('pip install pyarrow to load parquet files')
+
+    for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        for record in record_batch.to_pylist():
+            yield _to_row(record)
+
+
+def read_rows(path) -> Iterator[BatchRow]:
+    if str(path).endswith('.parquet'):
+        return read_parquet(path)
+    return read_csv(path)
+
+
+# =========== Writers =================================
+# =====================================================
+def _insert_batches(conn, rows: List[BatchRow]) -> None:
+    if conn.dialect.name != 'postgresql':
+        conn.execute(orm.batches.insert(), rows)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        eta = row['eta']
+        writer.writerow([
+            row['reference'], row['sku'], row['partition'], row['_purchased_quantity'],
+            eta.isoformat() if eta else '',
+        ])
+    buffer.seek(0)
+    # the DBAPI cursor shares the transaction of the SQLAlchemy connection
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        'COPY batches (reference, sku, partition, _purchased_quantity, eta)'
+        " FROM STDIN WITH (FORMAT csv, NULL '')",
+        buffer,
+    )
+
+
+def _load_chunk(conn, source: str, rows: List[BatchRow], rows_done: int) -> int:
+    # a product per (sku, partition), like the aggregates
+    keys = {(row['sku'], row['partition']) for row in rows}
+    skus = {sku for sku, _ in keys}
+    existing = {tuple(row) for row in conn.execute(
+        select([orm.products.c.sku, orm.products.c.partition])
+        .where(orm.products.c.sku.in_(skus))
+    )}
+    missing = [
+        {'sku': sku, 'partition': partition, 'version_number': 0}
+        for sku, partition in sorted(keys - existing)
+    ]
+    if missing:
+        conn.execute(orm.products.insert(), missing)
+
+    _insert_batches(conn, rows)
+
+    conn.execute(
+        orm.products.update()
+        .where(orm.products.c.sku == bindparam('b_sku'))
+        .where(orm.products.c.partition == bindparam('b_partition'))
+        .values(version_number=orm.products.c.version_number + 1),
+        [{'b_sku': sku, 'b_partition': partition} for sku, partition in sorted(keys)],
+    )
+    stock_levels.recompute(conn, sorted(skus))
+    conn.execute(
+        orm.ingest_checkpoints.update()
+        .where(orm.ingest_checkpoints.c.source == source)
+        .values(rows_done=rows_done + len(rows))
+    )
+    return len(missing)
+
+
+def load_batches(
+    engine, source: str, rows: Iterator[BatchRow], chunk_size: int = 5000,
+    progress=None,
+) -> LoadStats:
+    """Loads `rows` coming from `source` (e.g. the file name), resuming after
+    the last checkpoint. `progress` is called with the stats after each chunk.
+    """
+    stats = LoadStats()
+    start = time.perf_counter()
+
+    with engine.begin() as conn:
+        rows_done = conn.execute(
+            select([orm.ingest_checkpoints.c.rows_done])
+            .where(orm.ingest_checkpoints.c.source == source)
+        ).scalar()
+        if rows_done is None:
+            rows_done = 0
+            conn.execute(orm.ingest_checkpoints.insert(), source=source, rows_done=0)
+
+    stats.skipped = rows_done
+    rows = islice(rows, rows_done, None)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        with engine.begin() as conn:
+            stats.products_created += _load_chunk(conn, source, chunk, rows_done)
+        rows_done += len(chunk)
+        stats.rows += len(chunk)
+        stats.seconds = time.perf_counter() - start
+        if progress is not None:
+            progress(stats)
+
+    stats.seconds = time.perf_counter() - start
+    return stats
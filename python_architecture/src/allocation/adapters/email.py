@@ -1,2 +1,269 @@
-def send_email(*args):
-    print('SENDING EMAIL:', *args)
\ No newline at end of file
+"""Sending notifications without making anybody wait for the mail server
+
+A naive SMTP client opens one connection per email: TCP + EHLO (+ STARTTLS, AUTH)
+for every `OutOfStock`, inside of the request. Here instead:
+
+* `send_email` only puts the message on a queue, so handlers return immediately
+* a few workers drain the queue in batches, every batch goes through one
+  connection of a small pool, kept open between batches
+* connections which broke are dropped, what's left of the batch is retried
+  once on a new one (servers close idle connections at some point)
+
+Without a configured transport (SMTP_HOST) the messages are only printed.
+To try it locally: `python -m aiosmtpd -n -l localhost:1025` and SMTP_HOST=localhost
+"""
+
+import logging
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from typing import Callable, Iterator, List, Optional
+
+from allocation.adapters import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """At most `size` open SMTP connections, reused for as long as they work"""
+    def __init__(self, host: str, port: int, size: int = 2, timeout: float = 10.0):
+        self.host, self.port, self.timeout = host, port, timeout
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.opened = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        self.opened += 1
+        return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    @contextmanager
+    def connection(self) -> Iterator[smtplib.SMTP]:
+        self._slots.acquire()
+        try:
+            try:
+                smtp = self._idle.get_nowait()
+            except queue.Empty:
+                smtp = self._connect()
+            try:
+                yield smtp
+            except BaseException:
+                # broken, or in the middle of something: the next one gets a new
+                # connection
+                smtp.close()
+                raise
+            self._idle.put(smtp)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        while True:
+            try:
+                smtp = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+
+def _call(fn: Callable, *args):
+    return fn(*args)
+
+
+@dataclass
+class _Queued:
+    to: str
+    subject: str
+    body: str
+    queued_at: float = field(default_factory=time.perf_counter)
+    # runs in the context of `send`, so the worker's spans join its trace.
+    # Outside of a (sampled) trace there's nothing to carry.
+    in_context: Callable = field(default_factory=lambda: (
+        tracing.carry(_call) if tracing.current_trace_id() is not None else _call
+    ))
+
+
+@dataclass
+class TransportStats:
+    sent: int = 0
+    failed: int = 0
+    dropped: int = 0  # the queue was full
+    batches: int = 0
+    first_batch: Optional[float] = None
+    last_batch: Optional[float] = None
+    total_latency: float = 0.0  # from `send` to accepted by the server
+    max_latency: float = 0.0
+
+    @property
+    def sends_per_sec(self) -> float:
+        """Over the time the workers have been sending, all of them together"""
+        first, last = self.first_batch, self.last_batch
+        if first is None or last is None or last == first:
+            return 0.0
+        return self.sent / (last - first)
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.sent if self.sent else 0.0
+
+
+_STOP = object()
+
+
+class SmtpTransport:
+    def __init__(
+        self, host: str, port: int = 25, sender: str = 'allocation@made.com',
+        pool_size: int = 2, batch_size: int = 50, linger: float = 0.05,
+        max_queue: int = 10_000,
+    ):
+        self.sender = sender
+        self.pool = ConnectionPool(host, port, size=pool_size)
+        self.batch_size = batch_size
+        self.linger = linger  # how long a worker waits for a batch to fill up
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        self._stats = TransportStats()
+        self._stats_lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._work, name=f'smtp-{i}', daemon=True)
+            for i in range(pool_size)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def send(self, to: str, body: str, subject: str = 'Allocation service') -> None:
+        try:
+            self._queue.put_nowait(_Queued(to, subject, body))
+        except queue.Full:
+            with self._stats_lock:
+                self._stats.dropped += 1
+            logger.warning('email queue full, dropping the message to %s', to)
+
+    def _next_batch(self) -> Optional[List[_Queued]]:
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        until = time.perf_counter() + self.linger
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0.0, until - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)  # for after this batch
+                self._queue.task_done()
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                self._queue.task_done()
+                return
+            try:
+                self._send_batch(batch)
+            except Exception:
+                logger.exception('could not send %d emails', len(batch))
+                with self._stats_lock:
+                    self._stats.failed += len(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send_batch(self, batch: List[_Queued]) -> None:
+        start = time.perf_counter()
+        sent: List[_Queued] = []
+        refused: List[_Queued] = []
+        try:
+            self._send_on_one_connection(batch, sent, refused)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            logger.info('smtp connection lost, retrying on a new one')
+            done = {id(item) for item in sent + refused}
+            rest = [item for item in batch if id(item) not in done]
+            try:
+                self._send_on_one_connection(rest, sent, refused)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                logger.exception('could not send %d emails', len(rest))
+                done = {id(item) for item in sent + refused}
+                refused += [item for item in rest if id(item) not in done]
+        end = time.perf_counter()
+        with self._stats_lock:
+            stats = self._stats
+            stats.batches += 1
+            stats.sent += len(sent)
+            stats.failed += len(refused)
+            if stats.first_batch is None:
+                stats.first_batch = start
+            stats.last_batch = end
+            for item in sent:
+                stats.total_latency += end - item.queued_at
+                stats.max_latency = max(stats.max_latency, end - item.queued_at)
+
+    def _message(self, item: _Queued) -> EmailMessage:
+        message = EmailMessage()
+        message['From'], message['To'] = self.sender, item.to
+        message['Subject'] = item.subject
+        message.set_content(item.body)
+        return message
+
+    def _send_on_one_connection(
+        self, batch: List[_Queued], sent: List[_Queued], refused: List[_Queued]
+    ) -> None:
+        with self.pool.connection() as smtp:
+            for item in batch:
+                try:
+                    item.in_context(self._send_one, smtp, item)
+                    sent.append(item)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                        smtplib.SMTPDataError) as e:
+                    logger.warning('email to %s refused: %s', item.to, e)
+                    refused.append(item)
+                    smtp.rset()
+
+    def _send_one(self, smtp: smtplib.SMTP, item: _Queued) -> None:
+        with tracing.span('email.send', to=item.to):
+            smtp.send_message(self._message(item))
+
+    def stats(self) -> TransportStats:
+        with self._stats_lock:
+            return TransportStats(**vars(self._stats))
+
+    def flush(self) -> None:
+        """Blocks until everything queued so far has been handed over"""
+        self._queue.join()
+
+    def close(self) -> None:
+        for _ in self._workers:
+            self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self.pool.close()
+        stats = self.stats()
+        logger.info(
+            'emails: %d sent, %d failed, %d dropped, %.0f/s, latency %.1fms (max %.1fms)',
+            stats.sent, stats.failed, stats.dropped, stats.sends_per_sec,
+            stats.mean_latency * 1000, stats.max_latency * 1000,
+        )
+
+
+TRANSPORT: Optional[SmtpTransport] = None
+
+
+def configure(transport: Optional[SmtpTransport]) -> None:
+    global TRANSPORT
+    TRANSPORT = transport
+
+
+def send_email(to: str, body: str) -> None:
+    if TRANSPORT is None:
+        print('SENDING EMAIL:', to, body)
+        return
+    TRANSPORT.send(to, body)
@@ -0,0 +1,103 @@
+"""Storage backends: which engines the unit of work talks to.
+
+* postgres (default): the primary, with REPEATABLE READ, and optionally a replica
+* sqlite: for single-node deployments (edge warehouses) without a postgres.
+  Tuned for concurrency rather than for the tests' `sqlite:///:memory:`:
+
+  - WAL journal, so readers don't block the writer and vice versa
+  - a single writer connection; writers queue up in the pool instead of
+    fighting over the database lock. `BEGIN IMMEDIATE` takes the write lock
+    up front, so a transaction never fails half-way trying to upgrade its lock
+  - a pool of `query_only` reader connections, used like a replica
+  - `busy_timeout` makes SQLite wait (and retry) on a lock held by another
+    process rather than failing with "database is locked" right away
+"""
+
+from typing import Optional, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import LRUCache
+
+from allocation import config
+from allocation.adapters import orm
+
+
+Engines = Tuple[Engine, Optional[Engine]]  # primary, readers (or None)
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # durable with WAL, except on power loss
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative means KiB, i.e. 64MB per connection
+    'temp_store': 'MEMORY',
+}
+
+
+def cached_statements() -> dict:
+    """Compiled forms of Core statements, keyed by the statement object. So it
+    only pays off for statements built once (module level), bounded because the
+    one-off statements would otherwise pile up in there.
+    """
+    return {'compiled_cache': LRUCache(500)}
+
+
+def postgres_engines() -> Engines:
+    primary = create_engine(
+        config.get_postgres_uri(),
+        isolation_level="REPEATABLE_READ",  # read about!!
+        execution_options=cached_statements(),
+    )
+    replica = None
+    if config.get_postgres_replica_uri() is not None:
+        replica = create_engine(
+            config.get_postgres_replica_uri(), execution_options=cached_statements()
+        )
+    return primary, replica
+
+
+def _sqlite_engine(
+    path: str, pool_size: int, busy_timeout_ms: int, readonly: bool
+) -> Engine:
+    engine = create_engine(
+        f'sqlite:///{path}', poolclass=QueuePool, pool_size=pool_size,
+        max_overflow=0, connect_args={'check_same_thread': False},
+        execution_options=cached_statements(),
+    )
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, _):
+        # take over transaction handling from pysqlite, see `on_begin`
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma}={value}')
+        cursor.execute(f'PRAGMA busy_timeout={busy_timeout_ms}')
+        if readonly:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        conn.execute('BEGIN' if readonly else 'BEGIN IMMEDIATE')
+
+    return engine
+
+
+def sqlite_engines(
+    path: str, readers: int = 4, busy_timeout_ms: int = 5000
+) -> Engines:
+    """One writer and a pool of readers on the same file, schema included"""
+    writer = _sqlite_engine(path, 1, busy_timeout_ms, readonly=False)
+    orm.metadata.create_all(writer)
+    return writer, _sqlite_engine(path, readers, busy_timeout_ms, readonly=True)
+
+
+def create_engines() -> Engines:
+    if config.get_db_backend() == "sqlite":
+        return sqlite_engines(
+            config.get_sqlite_path(), readers=config.get_sqlite_readers(),
+            busy_timeout_ms=config.get_sqlite_busy_timeout_ms(),
+        )
+    return postgres_engines()
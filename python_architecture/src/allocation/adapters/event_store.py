@@ -0,0 +1,185 @@
+"""Event-sourced persistence for the Product aggregate, an alternative to the ORM.
+
+Loading a Product through the ORM means loading every batch and allocation ever
+made for the sku. Here the changes are appended to `product_events` instead and
+every `snapshot_interval` events a compact snapshot of the aggregate is written
+to `product_snapshots`. Loading = latest snapshot + the events after it, so the
+cost is bounded by the interval and not by the history of the sku.
+
+The domain model doesn't know about any of it: the repository remembers the
+state it handed out and diffs it at commit time into events:
+
+* batch_added       {ref, qty, eta}
+* quantity_changed  {ref, qty}
+* allocated         {ref, orderid, qty}
+* deallocated       {ref, orderid, qty}
+
+A line is its (orderid, qty) within a batch, as in the domain model: an order
+can have more than one line of a sku, and so in one batch.
+"""
+
+import json
+from datetime import date
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from allocation.adapters import orm
+from allocation.adapters.repository import AbstractRepository
+from allocation.domain import model
+
+
+# {ref: {"qty": int, "eta": str|None, "lines": [[orderid, qty], ...]}}
+State = Dict[str, dict]
+
+
+def _state_of(product: model.Product) -> State:
+    return {
+        b.reference: {
+            'qty': b._purchased_quantity,
+            'eta': b.eta.isoformat() if b.eta else None,
+            'lines': sorted([line.orderid, line.qty] for line in b._allocations),
+        }
+        for b in product.batches
+    }
+
+
+def _lines(batch: dict) -> Set[Tuple[str, int]]:
+    return {(orderid, qty) for orderid, qty in batch['lines']}
+
+
+def _apply(state: State, kind: str, event: dict) -> None:
+    if kind == 'batch_added':
+        state[event['ref']] = {'qty': event['qty'], 'eta': event['eta'], 'lines': []}
+    elif kind == 'quantity_changed':
+        state[event['ref']]['qty'] = event['qty']
+    elif kind == 'allocated':
+        state[event['ref']]['lines'].append([event['orderid'], event['qty']])
+    elif kind == 'deallocated':
+        lines = state[event['ref']]['lines']
+        if [event['orderid'], event['qty']] in lines:
+            lines.remove([event['orderid'], event['qty']])
+    else:
+        raise ValueError(f'Unknown product event {kind}')
+
+
+def _diff(before: State, after: State) -> List[Tuple[str, dict]]:
+    changes = []
+    for ref, batch in after.items():
+        old = before.get(ref)
+        if old is None:
+            changes.append(('batch_added', {'ref': ref, 'qty': batch['qty'], 'eta': batch['eta']}))
+            old = {'qty': batch['qty'], 'lines': []}
+        elif old['qty'] != batch['qty']:
+            changes.append(('quantity_changed', {'ref': ref, 'qty': batch['qty']}))
+
+        for orderid, qty in sorted(_lines(old) - _lines(batch)):
+            changes.append(('deallocated', {'ref': ref, 'orderid': orderid, 'qty': qty}))
+        for orderid, qty in sorted(_lines(batch) - _lines(old)):
+            changes.append(('allocated', {'ref': ref, 'orderid': orderid, 'qty': qty}))
+    return changes
+
+
+def _build(sku: model.Sku, state: State, version_number: int) -> model.Product:
+    batches = []
+    for ref, batch in state.items():
+        eta = date.fromisoformat(batch['eta']) if batch['eta'] else None
+        b = model.Batch(model.BatchReference(ref), sku, batch['qty'], eta)
+        b._allocations = model.Allocations(
+            model.OrderLine(orderid, sku, qty) for orderid, qty in batch['lines']
+        )
+        batches.append(b)
+    return model.Product(sku, batches, version_number=version_number)
+
+
+class _Loaded:
+    """What we know about a product as it was handed out"""
+    def __init__(self, state: State, seq: int, snapshot_seq: int) -> None:
+        self.state = state
+        self.seq = seq
+        self.snapshot_seq = snapshot_seq
+
+
+class EventSourcedRepository(AbstractRepository):
+    def __init__(self, session, snapshot_interval: int = 100) -> None:
+        super().__init__()
+        self.session = session
+        self.snapshot_interval = snapshot_interval
+        self._loaded: Dict[str, _Loaded] = {}
+        self._products: Dict[str, model.Product] = {}  # our identity map
+
+    def _add(self, product: model.Product) -> None:
+        self._loaded[product.sku] = _Loaded({}, seq=0, snapshot_seq=0)
+        self._products[product.sku] = product
+
+    def _get(self, sku, partition=model.DEFAULT_PARTITION) -> Optional[model.Product]:
+        """One log per sku: no partitions here, the entrypoint turns them down"""
+        if partition != model.DEFAULT_PARTITION:
+            return None
+        if sku in self._products:
+            return self._products[sku]
+
+        snapshot = self.session.execute(
+            select([orm.product_snapshots.c.seq, orm.product_snapshots.c.payload])
+            .where(orm.product_snapshots.c.sku == sku)
+        ).first()
+        snapshot_seq, version_number, state = 0, 0, {}
+        if snapshot is not None:
+            snapshot_seq = snapshot.seq
+            payload = json.loads(snapshot.payload)
+            version_number, state = payload['version_number'], payload['batches']
+
+        tail = list(self.session.execute(
+            select([
+                orm.product_events.c.seq, orm.product_events.c.kind,
+                orm.product_events.c.payload, orm.product_events.c.version_number,
+            ])
+            .where(orm.product_events.c.sku == sku)
+            .where(orm.product_events.c.seq > snapshot_seq)
+            .order_by(orm.product_events.c.seq)
+        ))
+        if snapshot is None and not tail:
+            return None
+
+        seq = snapshot_seq
+        for seq, kind, payload, version_number in tail:
+            _apply(state, kind, json.loads(payload))
+
+        self._loaded[sku] = _Loaded(state, seq, snapshot_seq)
+        self._products[sku] = _build(sku, state, version_number)
+        return self._products[sku]
+
+    def save(self) -> None:
+        """Appends the changes of every product used by the unit of work"""
+        for product in self.seen:
+            loaded = self._loaded[product.sku]
+            changes = _diff(loaded.state, _state_of(product))
+            if not changes:
+                continue
+
+            rows = [
+                {
+                    'sku': product.sku, 'seq': loaded.seq + i, 'kind': kind,
+                    'payload': json.dumps(event),
+                    'version_number': product.version_number,
+                }
+                for i, (kind, event) in enumerate(changes, start=1)
+            ]
+            self.session.execute(orm.product_events.insert(), rows)
+            loaded.seq += len(rows)
+            loaded.state = _state_of(product)
+
+            if loaded.seq - loaded.snapshot_seq >= self.snapshot_interval:
+                self._write_snapshot(product, loaded)
+
+    def _write_snapshot(self, product: model.Product, loaded: _Loaded) -> None:
+        table = orm.product_snapshots
+        self.session.execute(table.delete().where(table.c.sku == product.sku))
+        self.session.execute(table.insert(), {
+            'sku': product.sku, 'seq': loaded.seq,
+            'payload': json.dumps({
+                'version_number': product.version_number,
+                'batches': loaded.state,
+            }),
+        })
+        loaded.snapshot_seq = loaded.seq
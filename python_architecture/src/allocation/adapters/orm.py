@@ -4,13 +4,18 @@ The ORM depends the model, but not the other way around! We get the benefits of
 using SQLAlchemy (e.g. alembic for migrations), transparently query domain obj..
 """
 
+import time
+
 from sqlalchemy import (
-    Table, MetaData, Column, Integer, String, Date, 
-    ForeignKey, event
+    Table, MetaData, Column, Integer, String, Date, Text,
+    ForeignKey, ForeignKeyConstraint, UniqueConstraint, event, func
 )
-from sqlalchemy.orm import mapper, relationship
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import Session, mapper, relationship
+from sqlalchemy.orm.dynamic import AppenderQuery
 
 from allocation.domain import model
+from allocation.adapters import profiling
 
 
 metadata = MetaData()
@@ -23,9 +28,11 @@ order_lines = Table(
     Column('orderid', String(255)),
 )
 
+# a product is a (sku, partition), the partition is '' unless the sku is split up
 products = Table(
     'products', metadata,
     Column('sku', String(255), primary_key=True),
+    Column('partition', String(64), primary_key=True, default='', server_default=''),
     Column('version_number', Integer, nullable=False, server_default='0'),
 )
 
@@ -33,38 +40,211 @@ batches = Table(
     'batches', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('reference', String(255)),
-    Column('sku', ForeignKey('products.sku')),
+    Column('sku', String(255)),
+    Column('partition', String(64), nullable=False, default='', server_default=''),
     Column('_purchased_quantity', Integer, nullable=False),
     Column('eta', Date, nullable=True),
+    ForeignKeyConstraint(['sku', 'partition'], ['products.sku', 'products.partition']),
 )
 
 allocations = Table(
     'allocations', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('orderline_id', ForeignKey('order_lines.id')),
-    Column('batch_id', ForeignKey('batches.id')),
+    Column('orderline_id', ForeignKey('order_lines.id'), index=True),
+    Column('batch_id', ForeignKey('batches.id'), index=True),
+)
+
+# read model for availability checks, kept up to date at commit time by the
+# unit of work (see `adapters.stock_levels`), never loaded as an aggregate
+stock_levels = Table(
+    'stock_levels', metadata,
+    Column('sku', String(255), primary_key=True),
+    Column('partition', String(64), primary_key=True, default='', server_default=''),
+    Column('available', Integer, nullable=False),
+    Column('earliest_eta', Date, nullable=True),
+)
+
+# exhausted batches are moved here (see `adapters.archive`) so that the live
+# aggregate only has batches which can still take allocations
+archived_batches = Table(
+    'archived_batches', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('reference', String(255)),
+    Column('sku', String(255)),
+    Column('partition', String(64), nullable=False, default='', server_default=''),
+    Column('_purchased_quantity', Integer, nullable=False),
+    Column('eta', Date, nullable=True),
+)
+
+archived_allocations = Table(
+    'archived_allocations', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('orderline_id', ForeignKey('order_lines.id'), index=True),
+    Column('batch_id', ForeignKey('archived_batches.id')),
+)
+
+# the version of every product as the last reconciliation saw it (see
+# `adapters.reconcile`), versions must never go down
+reconciled_versions = Table(
+    'reconciled_versions', metadata,
+    Column('sku', String(255), primary_key=True),
+    Column('partition', String(64), primary_key=True, default='', server_default=''),
+    Column('version_number', Integer, nullable=False),
+)
+
+# progress of the bulk loader, so a failed ingest can be resumed
+ingest_checkpoints = Table(
+    'ingest_checkpoints', metadata,
+    Column('source', String(1024), primary_key=True),
+    Column('rows_done', Integer, nullable=False),
+)
+
+# the event-sourced persistence mode (see `adapters.event_store`): an append-only
+# log of changes per sku, plus the latest compact snapshot of each aggregate
+product_events = Table(
+    'product_events', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('sku', String(255), nullable=False),
+    Column('seq', Integer, nullable=False),
+    Column('kind', String(32), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('version_number', Integer, nullable=False),
+    # two writers appending the same seq -> the second one fails, like versions
+    UniqueConstraint('sku', 'seq'),
+)
+
+product_snapshots = Table(
+    'product_snapshots', metadata,
+    Column('sku', String(255), primary_key=True),
+    Column('seq', Integer, nullable=False),
+    Column('payload', Text, nullable=False),
 )
 
+# cache of the repository's hot ORM queries, built and compiled only once.
+# Renewed by `start_mappers`, cached queries hold on to the mappers they use.
+bakery = baked.bakery()
+
+# see `start_mappers`, whether `Batch._allocations` is a `WriteOnlyAllocations`
+WRITE_ONLY_ALLOCATIONS = False
+
 
-def start_mappers() -> None:
+# session.info key: allocated quantity per batch id, see `WriteOnlyAllocations`
+_QUANTITIES = 'allocated_quantities'
+
+
+class WriteOnlyAllocations(AppenderQuery):
+    """`Batch._allocations` which is never loaded: lines are inserted and
+    deleted one by one and the quantity is a `SUM` in the database, so memory
+    and latency don't grow with the allocation history of a batch.
+    Iterating over it still loads everything, which is what we want to avoid.
+
+    The sums are queried for all batches of the product at once (allocating
+    looks at every batch) and kept up to date in the session until the
+    transaction ends.
+    """
+    def add(self, line: model.OrderLine) -> None:
+        if line in self:  # idempotent, like adding to a set
+            return
+        self.append(line)
+        self._adjust(line.qty)
+
+    def _matching(self, line: model.OrderLine):
+        return self.filter_by(orderid=line.orderid, sku=line.sku, qty=line.qty)
+
+    def _find(self, line: model.OrderLine):
+        return self._matching(line).first()
+
+    def __contains__(self, line) -> bool:
+        if self.session is None:  # a new batch, what we have is pending
+            return line in list(self)
+        return self.session.query(self._matching(line).exists()).scalar()
+
+    def remove(self, line: model.OrderLine) -> None:
+        if self.session is None:
+            return super().remove(line)
+        super().remove(self._find(line))
+        self._adjust(-line.qty)
+
+    def _adjust(self, qty: int) -> None:
+        if self.session is not None:
+            quantities = self.session.info.get(_QUANTITIES, {})
+            if self.instance.id in quantities:
+                quantities[self.instance.id] += qty
+
+    @property
+    def quantity(self) -> int:
+        if self.session is None:
+            return sum(line.qty for line in self)
+
+        batch = self.instance
+        quantities = self.session.info.setdefault(_QUANTITIES, {})
+        if batch.id not in quantities:
+            # a Query, not session.execute: flushes pending batches and lines first
+            quantities.update(
+                self.session.query(
+                    batches.c.id, func.coalesce(func.sum(order_lines.c.qty), 0)
+                )
+                .select_from(batches.outerjoin(allocations).outerjoin(order_lines))
+                .filter(batches.c.sku == batch.sku, batches.c.partition == batch.partition)
+                .group_by(batches.c.id)
+            )
+        return quantities[batch.id]
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_quantities(session, transaction):
+    """The sums are only valid within the transaction they were read in"""
+    if transaction.parent is None:
+        session.info.pop(_QUANTITIES, None)
+
+
+def start_mappers(write_only_allocations: bool = False) -> None:
     """Function to load and save domain model instances from and to a database.
     
     If we don't call the function, the model will be unaware of the database.
     Map model.Batch -> Table.batches. We're basically working with an aggregate.
+
+    With `write_only_allocations`, loading a product doesn't load the order lines
+    of its batches, which is what makes big allocation histories expensive.
     """
+    global bakery, WRITE_ONLY_ALLOCATIONS
+    bakery = baked.bakery()
+    WRITE_ONLY_ALLOCATIONS = write_only_allocations
+
     lines_mapper = mapper(model.OrderLine, order_lines)
-    batches_mapper = mapper(model.Batch, batches, properties={
-        '_allocations': relationship(
-            lines_mapper,
-            secondary=allocations,
-            collection_class=set,
+    if write_only_allocations:
+        allocations_property = relationship(
+            lines_mapper, secondary=allocations,
+            lazy='dynamic', query_class=WriteOnlyAllocations,
+        )
+    else:
+        allocations_property = relationship(
+            lines_mapper, secondary=allocations, collection_class=model.Allocations,
         )
+    batches_mapper = mapper(model.Batch, batches, properties={
+        '_allocations': allocations_property,
     })
     mapper(model.Product, products, properties={
         'batches': relationship(batches_mapper)
     })
 
 
+def register_profiler(engine, profiler: profiling.QueryProfiler) -> None:
+    """Hooks the statement profiler into the engine's cursor events.
+
+    A connection can execute nested statements, hence the stack of start times
+    in `conn.info` (the recipe from the SQLAlchemy docs).
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        profiler.record(statement, elapsed, cursor.rowcount)
+
+
 @event.listens_for(model.Product, 'load')
 def receive_load(product, _):
     """A little hack in the ORM so that the events work."""
@@ -0,0 +1,149 @@
+"""A tiny statement profiler for the SQLAlchemy engine: per-statement timing,
+row counts grouped by normalized SQL and a slow-query log.
+
+The listeners themselves live in `orm.register_profiler`, this module only keeps
+the bookkeeping. A report is collected per unit of work (see `collect`), so we
+can tell which service call issued the queries that show up as outliers.
+"""
+
+import contextvars
+import functools
+import logging
+import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, Optional
+
+
+logger = logging.getLogger(__name__)
+
+_current_call: contextvars.ContextVar = contextvars.ContextVar(
+    'current_call', default=None
+)
+_current_report: contextvars.ContextVar = contextvars.ContextVar(
+    'current_report', default=None
+)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,?)+\)", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|:\w+|%s")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    """Strip literals and placeholders so that the same query with different
+    parameters ends up in the same bucket.
+    """
+    statement = _STRING_LITERAL.sub('?', statement)
+    statement = _NUMBER_LITERAL.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _IN_LIST.sub('IN (...)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+@dataclass
+class StatementStats:
+    count: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    rows: int = 0
+
+    def record(self, elapsed: float, rowcount: int) -> None:
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        # rowcount is -1 for SELECTs on most DBAPIs, don't let it go negative
+        self.rows += max(rowcount, 0)
+
+
+class QueryReport:
+    """Aggregated statements issued within one unit of work"""
+
+    def __init__(self, call: Optional[str] = None) -> None:
+        self.call = call
+        self.statements: Dict[str, StatementStats] = defaultdict(StatementStats)
+
+    @property
+    def count(self) -> int:
+        return sum(s.count for s in self.statements.values())
+
+    @property
+    def total_time(self) -> float:
+        return sum(s.total_time for s in self.statements.values())
+
+    def as_dict(self) -> dict:
+        return {
+            'call': self.call,
+            'count': self.count,
+            'total_time': self.total_time,
+            'statements': {
+                sql: vars(stats) for sql, stats in self.statements.items()
+            },
+        }
+
+
+class QueryProfiler:
+    """Process-wide statistics, shared by all the connections of an engine.
+
+    Statements slower than `slow_threshold` (seconds) are logged as warnings
+    together with the service call which issued them.
+    """
+
+    def __init__(self, slow_threshold: float = 0.1) -> None:
+        self.slow_threshold = slow_threshold
+        self.statements: Dict[str, StatementStats] = defaultdict(StatementStats)
+        self._lock = threading.Lock()
+
+    def record(self, statement: str, elapsed: float, rowcount: int) -> None:
+        sql = normalize(statement)
+        with self._lock:
+            self.statements[sql].record(elapsed, rowcount)
+
+        report = _current_report.get()
+        if report is not None:
+            report.statements[sql].record(elapsed, rowcount)
+
+        if elapsed >= self.slow_threshold:
+            logger.warning(
+                'slow query (%.1f ms, %s rows) in %s: %s',
+                elapsed * 1000, rowcount, _current_call.get(), sql,
+            )
+
+    def top(self, n: int = 10) -> Dict[str, StatementStats]:
+        """The statements where we spend most of the time"""
+        with self._lock:
+            ranked = sorted(
+                self.statements.items(), key=lambda kv: kv[1].total_time,
+                reverse=True,
+            )
+        return dict(ranked[:n])
+
+    def reset(self) -> None:
+        with self._lock:
+            self.statements.clear()
+
+
+@contextmanager
+def collect() -> Iterator[QueryReport]:
+    """Statements recorded inside the block are also added to the report"""
+    report = QueryReport(_current_call.get())
+    token = _current_report.set(report)
+    try:
+        yield report
+    finally:
+        _current_report.reset(token)
+
+
+def service_call(fn: Callable) -> Callable:
+    """Decorator which tags the queries issued by a service with its name"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current_call.set(fn.__name__)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_call.reset(token)
+    return wrapper
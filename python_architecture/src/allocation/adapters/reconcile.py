@@ -0,0 +1,202 @@
+"""Nightly consistency checks over the allocation store, entirely in SQL.
+
+The invariants the domain model keeps, checked on what actually is in the DB:
+
+* `over_allocated`: no batch has more allocated than it was purchased with
+* `sku_mismatch`: a batch only has order lines of its own sku
+* `dangling_allocation`: an allocation points to an existing order line
+* `version_regressed`: `version_number` of a product (i.e. of a partition of
+  a sku) never goes down (against
+  what the previous run saw, kept in `reconciled_versions`)
+* `orphaned_line`: every order line is allocated, live or archived. Note that
+  `deallocate` leaves the line behind, so these are worth a look, not an alarm
+
+Every check is a scan in keyset chunks (`id > :last ORDER BY id LIMIT n`),
+which walks the primary key / `batch_id` indexes and never loads an aggregate,
+so a run stays linear in the size of the tables and memory stays flat. A chunk
+is one short read transaction, i.e. the job doesn't hold anything up.
+
+    python -m allocation.adapters.reconcile [chunk size]
+"""
+
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import and_, bindparam, case, exists, func, select, tuple_
+
+from allocation.adapters import orm
+
+
+logger = logging.getLogger(__name__)
+
+CHECKS = (
+    'over_allocated', 'sku_mismatch', 'dangling_allocation',
+    'version_regressed', 'orphaned_line',
+)
+
+
+@dataclass
+class Violation:
+    check: str
+    key: str  # batch reference, sku or order line id
+    detail: str
+
+
+@dataclass
+class ReconciliationReport:
+    max_samples: int = 100  # violations kept per check, all of them are counted
+    violations: Counter = field(default_factory=Counter)
+    samples: List[Violation] = field(default_factory=list)
+    rows: Counter = field(default_factory=Counter)  # scanned, per table
+    elapsed: float = 0.0
+
+    def add(self, check: str, key, detail: str) -> None:
+        self.violations[check] += 1
+        if self.violations[check] <= self.max_samples:
+            self.samples.append(Violation(check, str(key), detail))
+
+    @property
+    def ok(self) -> bool:
+        return not self.violations
+
+    @property
+    def rows_per_sec(self) -> float:
+        return sum(self.rows.values()) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'ok': self.ok,
+            'violations': {check: self.violations[check] for check in CHECKS},
+            'samples': [vars(v) for v in self.samples],
+            'rows': dict(self.rows),
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_sec': round(self.rows_per_sec),
+        }
+
+
+def _check_batches(conn, report: ReconciliationReport, chunk_size: int) -> None:
+    """over-allocation, sku mismatch and dangling allocations, one pass over
+    `allocations` in ranges of batch ids
+    """
+    b, a, ol = orm.batches, orm.allocations, orm.order_lines
+    last_id = 0
+    while True:
+        ids = [row.id for row in conn.execute(
+            select([b.c.id]).where(b.c.id > last_id).order_by(b.c.id).limit(chunk_size)
+        )]
+        if not ids:
+            return
+        rows = conn.execute(
+            select([
+                b.c.reference, b.c.sku, b.c._purchased_quantity,
+                func.coalesce(func.sum(ol.c.qty), 0).label('allocated'),
+                func.count(a.c.id).label('allocations'),
+                func.sum(case([(ol.c.sku != b.c.sku, 1)], else_=0)).label('mismatched'),
+                func.sum(case([(and_(a.c.id.isnot(None), ol.c.id.is_(None)), 1)],
+                              else_=0)).label('dangling'),
+            ])
+            .select_from(b.outerjoin(a, a.c.batch_id == b.c.id).outerjoin(ol))
+            .where(b.c.id.between(ids[0], ids[-1]))
+            .group_by(b.c.id, b.c.reference, b.c.sku, b.c._purchased_quantity)
+        )
+        for ref, sku, purchased, allocated, allocations, mismatched, dangling in rows:
+            report.rows['allocations'] += allocations
+            if allocated > purchased:
+                report.add('over_allocated', ref, f'{allocated} allocated of {purchased}')
+            if mismatched:
+                report.add('sku_mismatch', ref, f'{mismatched} lines not of {sku}')
+            if dangling:
+                report.add('dangling_allocation', ref, f'{dangling} without order line')
+        report.rows['batches'] += len(ids)
+        last_id = ids[-1]
+
+
+def _check_versions(conn, report: ReconciliationReport, chunk_size: int) -> None:
+    """Compares with the previous run and remembers what we saw for the next one"""
+    p, seen = orm.products, orm.reconciled_versions
+    last: Optional[tuple] = None
+    while True:
+        query = (
+            select([p.c.sku, p.c.partition, p.c.version_number, seen.c.version_number])
+            .select_from(p.outerjoin(seen, and_(
+                seen.c.sku == p.c.sku, seen.c.partition == p.c.partition
+            )))
+            .order_by(p.c.sku, p.c.partition)
+            .limit(chunk_size)
+        )
+        if last is not None:
+            query = query.where(tuple_(p.c.sku, p.c.partition) > tuple_(*last))
+        rows = list(conn.execute(query))
+        if not rows:
+            return
+
+        for sku, partition, version, previous in rows:
+            if version < 0 or (previous is not None and version < previous):
+                key = f'{sku}@{partition}' if partition else sku
+                report.add('version_regressed', key, f'{version} after {previous}')
+        with conn.begin():
+            conn.execute(
+                seen.delete()
+                .where(seen.c.sku == bindparam('b_sku'))
+                .where(seen.c.partition == bindparam('b_partition')),
+                [{'b_sku': sku, 'b_partition': partition} for sku, partition, _, _ in rows],
+            )
+            conn.execute(seen.insert(), [
+                {'sku': sku, 'partition': partition,
+                 'version_number': max(version, previous or 0)}
+                for sku, partition, version, previous in rows
+            ])
+        report.rows['products'] += len(rows)
+        last = tuple(rows[-1][:2])
+
+
+def _check_order_lines(conn, report: ReconciliationReport, chunk_size: int) -> None:
+    ol, a, archived = orm.order_lines, orm.allocations, orm.archived_allocations
+    last_id = 0
+    while True:
+        ids = [row.id for row in conn.execute(
+            select([ol.c.id]).where(ol.c.id > last_id).order_by(ol.c.id).limit(chunk_size)
+        )]
+        if not ids:
+            return
+        orphans = conn.execute(
+            select([ol.c.id, ol.c.orderid, ol.c.sku])
+            .where(ol.c.id.between(ids[0], ids[-1]))
+            .where(~exists().where(a.c.orderline_id == ol.c.id))
+            .where(~exists().where(archived.c.orderline_id == ol.c.id))
+        )
+        for line_id, orderid, sku in orphans:
+            report.add('orphaned_line', line_id, f'{orderid} for {sku} is not allocated')
+        report.rows['order_lines'] += len(ids)
+        last_id = ids[-1]
+
+
+def reconcile(engine, chunk_size: int = 10_000) -> ReconciliationReport:
+    report = ReconciliationReport()
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        _check_batches(conn, report, chunk_size)
+        _check_versions(conn, report, chunk_size)
+        _check_order_lines(conn, report, chunk_size)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+if __name__ == '__main__':
+    from allocation.service_layer import unit_of_work
+
+    logging.basicConfig(level=logging.INFO)
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    report = reconcile(unit_of_work.DEFAULT_ENGINE, chunk_size)
+    logger.info(
+        'reconciled %s rows in %.1fs (%.0f rows/s), %s violations',
+        sum(report.rows.values()), report.elapsed, report.rows_per_sec,
+        sum(report.violations.values()),
+    )
+    print(json.dumps(report.as_dict(), indent=2))
+    sys.exit(0 if report.ok else 1)
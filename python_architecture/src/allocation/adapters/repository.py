@@ -1,7 +1,10 @@
 """An implementation of the repository pattern, to abstract away the DB layer"""
 
-from typing import List, Set
+from typing import Iterator, List, Mapping, Optional, Sequence, Set
 import abc
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import selectinload
+from allocation.adapters import orm, stock_levels, tracing
 from allocation.domain import model
 
 
@@ -18,32 +21,274 @@ class AbstractRepository(abc.ABC):
         self._add(product)
         self.seen.add(product)
     
-    def get(self, sku) -> model.Product:
-        product = self._get(sku)
+    def get(self, sku, partition: str = model.DEFAULT_PARTITION) -> Optional[model.Product]:
+        product = self._get_partition(sku, partition)
         if product:
             self.seen.add(product)
         return product
 
+    def _get_partition(self, sku, partition) -> Optional[model.Product]:
+        if partition == model.DEFAULT_PARTITION:
+            return self._get(sku)  # repositories which know nothing of partitions
+        return self._get(sku, partition)
+
+    def partitions(self, sku) -> List[str]:
+        """The partitions a sku is split into, `[DEFAULT_PARTITION]` if it isn't"""
+        return [model.DEFAULT_PARTITION]
+
+    def get_readonly(self, sku, min_version: int = 0) -> Optional[model.Product]:
+        """For queries: the product is not tracked, so it is never committed.
+        The partitions of a partitioned sku come as one, see `merge_partitions`
+        """
+        return merge_partitions(sku, [
+            self._get_partition(sku, partition) for partition in self.partitions(sku)
+        ])
+
+    def stock_level(self, sku) -> Optional[stock_levels.StockLevel]:
+        """(available, earliest_eta), without the need for the aggregate"""
+        product = self.get_readonly(sku)
+        return stock_levels.of_product(product) if product else None
+
     @abc.abstractmethod
     def _add(self, product: model.Product) -> None:
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get(self, sku: str) -> model.Product:
+    def _get(self, sku: str, partition: str = model.DEFAULT_PARTITION) -> Optional[model.Product]:
         raise NotImplementedError
 
 
+def merge_partitions(
+    sku, products: Sequence[Optional[model.Product]]
+) -> Optional[model.Product]:
+    """A read-only view of all partitions of a sku: their batches together, the
+    sum of their versions (which grows with every write to any of them).
+    Never add it to a session, it's no aggregate.
+    """
+    found = [p for p in products if p is not None]
+    if len(found) <= 1:
+        return found[0] if found else None
+    return model.Product(
+        sku, batches=[b for p in found for b in p.batches],
+        version_number=sum(p.version_number for p in found),
+    )
+
+
+# the hot statements are built once and compiled once: baked ORM queries, and
+# Core statements which hit the engine's compiled_cache (see `adapters.engines`).
+# The lazy loads of batches and allocations are baked by SQLAlchemy already.
+# `baked=False` builds the queries every time, only there for the comparison
+# (see `benchmarks/allocate_cpu.py`).
+
+_VERSION_BY_SKU = (
+    select([orm.products.c.version_number])
+    .where(orm.products.c.sku == bindparam('sku'))
+    .where(orm.products.c.partition == model.DEFAULT_PARTITION)
+)
+
+_PARTITIONS = (
+    select([orm.products.c.partition])
+    .where(orm.products.c.sku == bindparam('sku'))
+    .order_by(orm.products.c.partition)
+)
+
+
+def _product_by_sku(
+    session, sku, partition: str = model.DEFAULT_PARTITION, baked: bool = True,
+) -> Optional[model.Product]:
+    if not baked:
+        return session.query(model.Product).filter_by(sku=sku, partition=partition).first()
+
+    query = orm.bakery(lambda s: s.query(model.Product))
+    query += lambda q: q.filter(
+        orm.products.c.sku == bindparam('sku'),
+        orm.products.c.partition == bindparam('partition'),
+    )
+    return query(session).params(sku=sku, partition=partition).first()
+
+
+def _products_by_sku(session, sku, baked: bool = True) -> List[model.Product]:
+    """All partitions"""
+    if not baked:
+        return (
+            session.query(model.Product).filter_by(sku=sku)
+            .order_by(orm.products.c.partition).all()
+        )
+
+    query = orm.bakery(lambda s: s.query(model.Product))
+    query += lambda q: q.filter(orm.products.c.sku == bindparam('sku'))
+    query += lambda q: q.order_by(orm.products.c.partition)
+    return query(session).params(sku=sku).all()
+
+
+class InMemoryRepository(AbstractRepository):
+    """Products live in a dict, for simulations and for the unit tests"""
+    def __init__(self, products=()) -> None:
+        super().__init__()
+        self._products = {p.key: p for p in products}
+
+    def _add(self, product) -> None:
+        self._products[product.key] = product
+
+    def _get(self, sku, partition=model.DEFAULT_PARTITION) -> Optional[model.Product]:
+        return self._products.get(model.aggregate_key(sku, partition))
+
+    def partitions(self, sku) -> List[str]:
+        found = sorted(p.partition for p in self._products.values() if p.sku == sku)
+        return found or [model.DEFAULT_PARTITION]
+
+    def list(self) -> List[model.Product]:
+        return list(self._products.values())
+
+
 class SqlAlchemyRepository(AbstractRepository):
     """A concrete implementation of AbstractRepository, using SQLAlchemy"""
-    def __init__(self, session) -> None:
+    def __init__(
+        self, session, snapshot=None, before_get=None, read_session=None,
+        min_versions: Optional[Mapping[str, int]] = None, baked: bool = True,
+    ) -> None:
         super().__init__()
         self.session = session
+        self.baked = baked
+        self.snapshot = snapshot
+        self.before_get = before_get  # called with (sku, partition) before any read
+
+        # reads go to the replica if there is one, writes always to the primary
+        self.read_session = read_session if read_session is not None else session
+        self.min_versions = min_versions if min_versions is not None else {}
 
     def _add(self, product) -> None:
         self.session.add(product)
 
-    def _get(self, sku) -> str:
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+    def _get(self, sku, partition=model.DEFAULT_PARTITION) -> Optional[model.Product]:
+        with tracing.span('repository.get', sku=sku, partition=partition):
+            if self.before_get is not None:
+                self.before_get(sku, partition)
+
+            # the snapshot only has the products which aren't partitioned
+            if (self.snapshot is not None and partition == model.DEFAULT_PARTITION
+                    and sku in self.snapshot):
+                product = self._get_from_snapshot(sku)
+                if product is not None:
+                    return product
+
+            return _product_by_sku(self.session, sku, partition, self.baked)
+
+    def partitions(self, sku) -> List[str]:
+        found = [row.partition for row in self.session.execute(_PARTITIONS, {'sku': sku})]
+        return found or [model.DEFAULT_PARTITION]
+
+    def _get_from_snapshot(self, sku) -> Optional[model.Product]:
+        """Only the version is read from the DB, the rest comes from the file"""
+        version = self.session.execute(_VERSION_BY_SKU, {'sku': sku}).scalar()
+        cached = self.snapshot.get(sku, version) if version is not None else None
+        if cached is None:
+            return None
+
+        # load=False trusts the snapshot as the current DB state, no SELECTs
+        product = self.session.merge(cached, load=False)
+        if not hasattr(product, 'events'):
+            product.events = []
+        return product
+
+    def get_readonly(self, sku, min_version: int = 0) -> Optional[model.Product]:
+        """Read-your-writes: if the replica is behind the version we know was
+        committed (by us, or by the caller), ask the primary instead.
+        """
+        product, replica_is_behind = self._read(self.read_session, sku, min_version)
+        if replica_is_behind and self.read_session is not self.session:
+            product, _ = self._read(self.session, sku, min_version)
+        return product
+
+    def _read(self, session, sku, min_version: int):
+        """(all partitions as one, whether it's older than what we know of)"""
+        products = _products_by_sku(session, sku, self.baked)
+        product = merge_partitions(sku, products)
+        min_version = max(min_version, self.min_versions.get(sku, 0))
+        behind = (
+            product.version_number < min_version if product else min_version > 0
+        ) or any(p.version_number < self.min_versions.get(p.key, 0) for p in products)
+        return product, behind
+
+    def stock_level(self, sku) -> Optional[stock_levels.StockLevel]:
+        """A single row of the `stock_levels` read model, or the aggregate if
+        the sku has no row yet (not backfilled)
+        """
+        return stock_levels.get(self.read_session, sku) or super().stock_level(sku)
+
+    def archived_batches(self, sku) -> List[dict]:
+        """History: the exhausted batches which are no longer part of the
+        aggregate (see `adapters.archive`), with what was allocated to them.
+        """
+        rows = self.read_session.execute(
+            select([
+                orm.archived_batches.c.reference, orm.archived_batches.c.eta,
+                orm.archived_batches.c._purchased_quantity,
+                orm.order_lines.c.orderid, orm.order_lines.c.qty,
+            ])
+            .select_from(
+                orm.archived_batches
+                .outerjoin(orm.archived_allocations)
+                .outerjoin(orm.order_lines)
+            )
+            .where(orm.archived_batches.c.sku == sku)
+            .order_by(orm.archived_batches.c.id)
+        )
+        history: dict = {}
+        for ref, eta, qty, orderid, line_qty in rows:
+            batch = history.setdefault(ref, {'ref': ref, 'eta': eta, 'qty': qty, 'lines': {}})
+            if orderid is not None:
+                batch['lines'][orderid] = line_qty
+        return list(history.values())
 
     def list(self) -> List[model.Product]:
-        return self.session.query(model.Product).all()
\ No newline at end of file
+        """Materializes the whole catalog, prefer `iter_products` for jobs"""
+        return self.read_session.query(model.Product).all()
+
+    def iter_products(self, chunk_size: int = 500) -> Iterator[model.Product]:
+        """Streams all products in sku order, `chunk_size` aggregates at a time.
+
+        * keyset pagination on `products.sku`, no OFFSET which gets slower and
+          slower the deeper we go
+        * batches and allocations are eagerly loaded per chunk with two
+          `SELECT .. IN` queries instead of one lazy load per product
+        * a chunk is expunged from the session when the next one is loaded, so
+          memory stays flat. Don't keep references if you want it to stay so!
+        * `stream_results` asks the driver for a server-side cursor (postgres)
+        """
+        # by name: the model doesn't declare the mapped relationships
+        batches = selectinload('batches')
+        if not orm.WRITE_ONLY_ALLOCATIONS:  # else there's nothing to load
+            batches = batches.selectinload('_allocations')
+        query = (
+            self.read_session.query(model.Product)
+            .options(batches)
+            .order_by(orm.products.c.sku)
+            .execution_options(stream_results=True)
+        )
+        last_sku = None
+        while True:
+            page = query
+            if last_sku is not None:
+                page = page.filter(orm.products.c.sku > last_sku)
+            chunk = page.limit(chunk_size).all()
+            if not chunk:
+                return
+
+            yield from chunk
+            last_sku = chunk[-1].sku
+            self._expunge(chunk)
+
+    def _expunge(self, products: List[model.Product]) -> None:
+        """Default cascades don't include expunge, so we walk the aggregate.
+        Products used by the unit of work stay, they still have to be committed.
+        """
+        for product in products:
+            if product in self.seen:
+                continue
+            for batch in product.batches:
+                if not orm.WRITE_ONLY_ALLOCATIONS:
+                    for line in batch._allocations:
+                        self.read_session.expunge(line)
+                self.read_session.expunge(batch)
+            self.read_session.expunge(product)
\ No newline at end of file
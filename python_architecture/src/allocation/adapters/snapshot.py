@@ -0,0 +1,212 @@
+"""Binary snapshots of the Product aggregates, to warm-start a fresh process.
+
+After a deploy every worker would otherwise hydrate the same hot products from
+Postgres. The exporter writes all products (batches, allocations and the
+version_number) into one compact file, which is memory-mapped at startup. Only
+a small index is decoded eagerly, products are decoded on the first `get`.
+
+Entries are validated lazily: the repository still asks the DB for the current
+`products.version_number` (one tiny query) and only uses the snapshot when it
+matches. Stale entries are dropped, so we don't ask twice.
+
+File layout (little endian):
+    header:  MAGIC | u32 count
+    index:   count x (str sku | u32 version | u64 offset | u32 length)
+    records: u32 n_batches, n_batches x (
+                 u32 id | str reference | i32 qty | i32 eta | u32 n_lines,
+                 n_lines x (u32 id | str orderid | i32 qty)
+             )
+where `str` is a u16 length followed by utf-8 bytes and eta is a date ordinal
+(0 stands for no eta, i.e. warehouse stock).
+"""
+
+import mmap
+import struct
+import sys
+import threading
+from collections import defaultdict
+from datetime import date
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import make_transient_to_detached
+
+from allocation.adapters import orm
+from allocation.domain import model
+
+
+MAGIC = b'ALS1'
+
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_HEADER = struct.Struct('<4sI')
+_INDEX_ENTRY = struct.Struct('<IQI')
+_BATCH = struct.Struct('<iiI')
+_LINE_QTY = struct.Struct('<i')
+
+IndexEntry = Tuple[int, int, int]  # version, offset, length
+
+
+def _pack_str(value: str) -> bytes:
+    encoded = value.encode('utf-8')
+    return _U16.pack(len(encoded)) + encoded
+
+
+def _unpack_str(buffer, offset: int) -> Tuple[str, int]:
+    (length,) = _U16.unpack_from(buffer, offset)
+    offset += _U16.size
+    return str(buffer[offset:offset + length], 'utf-8'), offset + length
+
+
+# =========== Export ==================================
+# =====================================================
+def export(session, out: BinaryIO) -> int:
+    """Dumps every product with three plain table scans, no ORM hydration.
+    Returns the number of products written. Partitioned skus are left out.
+    """
+    versions = list(session.execute(
+        select([orm.products.c.sku, orm.products.c.version_number])
+        .where(orm.products.c.partition == model.DEFAULT_PARTITION)
+        .order_by(orm.products.c.sku)
+    ))
+
+    lines: Dict[int, List[tuple]] = defaultdict(list)
+    for batch_id, line_id, orderid, qty in session.execute(
+        select([
+            orm.allocations.c.batch_id, orm.order_lines.c.id,
+            orm.order_lines.c.orderid, orm.order_lines.c.qty,
+        ]).select_from(orm.allocations.join(orm.order_lines))
+    ):
+        lines[batch_id].append((line_id, orderid, qty))
+
+    batches: Dict[str, List[bytes]] = defaultdict(list)
+    for batch_id, ref, sku, qty, eta in session.execute(
+        select([
+            orm.batches.c.id, orm.batches.c.reference, orm.batches.c.sku,
+            orm.batches.c._purchased_quantity, orm.batches.c.eta,
+        ])
+        .where(orm.batches.c.partition == model.DEFAULT_PARTITION)
+        .order_by(orm.batches.c.id)
+    ):
+        parts = [
+            _U32.pack(batch_id), _pack_str(ref),
+            _BATCH.pack(qty, eta.toordinal() if eta else 0, len(lines[batch_id])),
+        ]
+        for line_id, orderid, line_qty in lines[batch_id]:
+            parts += [_U32.pack(line_id), _pack_str(orderid), _LINE_QTY.pack(line_qty)]
+        batches[sku].append(b''.join(parts))
+
+    records = [
+        _U32.pack(len(batches[sku])) + b''.join(batches[sku]) for sku, _ in versions
+    ]
+    # offsets are only known once we know the size of the index
+    offset = _HEADER.size + sum(
+        _U16.size + len(sku.encode('utf-8')) + _INDEX_ENTRY.size for sku, _ in versions
+    )
+    index_parts = []
+    for (sku, version), record in zip(versions, records):
+        index_parts.append(
+            _pack_str(sku) + _INDEX_ENTRY.pack(version, offset, len(record))
+        )
+        offset += len(record)
+
+    out.write(_HEADER.pack(MAGIC, len(versions)))
+    out.write(b''.join(index_parts))
+    for record in records:
+        out.write(record)
+
+    return len(versions)
+
+
+# =========== Load ====================================
+# =====================================================
+class Snapshot:
+    """A read-only, memory-mapped view over an exported file"""
+
+    def __init__(self, buffer) -> None:
+        self._buffer = buffer
+        self._lock = threading.Lock()
+        self.index: Dict[str, IndexEntry] = {}
+
+        magic, count = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'Not a product snapshot: {magic!r}')
+
+        offset = _HEADER.size
+        for _ in range(count):
+            sku, offset = _unpack_str(buffer, offset)
+            self.index[sku] = _INDEX_ENTRY.unpack_from(buffer, offset)
+            offset += _INDEX_ENTRY.size
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, sku) -> bool:
+        return sku in self.index
+
+    def get(self, sku: str, version_number: int) -> Optional[model.Product]:
+        """A fresh, detached Product if the snapshot is still current"""
+        entry = self.index.get(sku)
+        if entry is None:
+            return None
+
+        version, offset, _ = entry
+        if version != version_number:
+            self.discard(sku)
+            return None
+
+        return self._decode(model.Sku(sku), version, offset)
+
+    def discard(self, sku: str) -> None:
+        with self._lock:
+            self.index.pop(sku, None)
+
+    def _decode(self, sku: model.Sku, version: int, offset: int) -> model.Product:
+        buffer = self._buffer
+        (n_batches,) = _U32.unpack_from(buffer, offset)
+        offset += _U32.size
+
+        batches = []
+        for _ in range(n_batches):
+            (batch_id,) = _U32.unpack_from(buffer, offset)
+            ref, offset = _unpack_str(buffer, offset + _U32.size)
+            qty, eta, n_lines = _BATCH.unpack_from(buffer, offset)
+            offset += _BATCH.size
+
+            batch = model.Batch(
+                model.BatchReference(ref), sku, qty, date.fromordinal(eta) if eta else None
+            )
+            batch.id = batch_id  # type: ignore[attr-defined]  # mapped, not in the model
+            for _ in range(n_lines):
+                (line_id,) = _U32.unpack_from(buffer, offset)
+                orderid, offset = _unpack_str(buffer, offset + _U32.size)
+                (line_qty,) = _LINE_QTY.unpack_from(buffer, offset)
+                offset += _LINE_QTY.size
+
+                line = model.OrderLine(model.OrderReference(orderid), sku, line_qty)
+                line.id = line_id  # type: ignore[attr-defined]
+                make_transient_to_detached(line)
+                batch._allocations.add(line)
+
+            make_transient_to_detached(batch)
+            batches.append(batch)
+
+        product = model.Product(sku, batches, version_number=version)
+        make_transient_to_detached(product)
+        return product
+
+
+def load(path) -> Snapshot:
+    """Memory-maps the file, the OS pages records in as they are used"""
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(buffer)
+
+
+if __name__ == '__main__':
+    from allocation.service_layer import unit_of_work
+
+    orm.start_mappers()
+    session = unit_of_work.DEFAULT_SESSION_FACTORY()
+    with open(sys.argv[1], 'wb') as f:
+        print('exported', export(session, f), 'products')
@@ -0,0 +1,140 @@
+"""The `stock_levels` read model: one row per sku with what is available.
+
+Storefront availability checks only need "how much of X can I get, and when",
+which is a single row lookup here instead of loading the whole aggregate. The
+row is written in the same transaction as the aggregate, so it's never stale:
+
+* by the unit of work, at commit, from the products it has seen
+* by the bulk loader with `recompute`, which works in SQL (no aggregates)
+
+The skus which haven't been written to since the table was added have no row,
+`backfill` (or `python -m allocation.adapters.stock_levels`) computes them all.
+Until it ran, the repository falls back to the aggregate for them.
+
+A partitioned sku has a row per partition, so that the partitions don't wait
+for each other on a shared row. `get` adds them up.
+"""
+
+import logging
+from datetime import date
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import bindparam, func, select
+
+from allocation.adapters import orm
+from allocation.domain import model
+
+
+logger = logging.getLogger(__name__)
+
+StockLevel = Tuple[int, Optional[date]]  # available, earliest_eta
+
+# built once, so they are compiled once (engine's compiled_cache)
+_UPDATE = (
+    orm.stock_levels.update()
+    .where(orm.stock_levels.c.sku == bindparam('b_sku'))
+    .where(orm.stock_levels.c.partition == bindparam('b_partition'))
+    .values(
+        available=bindparam('b_available'), earliest_eta=bindparam('b_earliest_eta')
+    )
+)
+_INSERT = orm.stock_levels.insert().values(
+    sku=bindparam('b_sku'), partition=bindparam('b_partition'),
+    available=bindparam('b_available'),
+    earliest_eta=bindparam('b_earliest_eta'),
+)
+_SELECT = (
+    select([orm.stock_levels.c.available, orm.stock_levels.c.earliest_eta])
+    .where(orm.stock_levels.c.sku == bindparam('b_sku'))
+)
+
+
+def of_product(product: model.Product) -> StockLevel:
+    """earliest_eta is the eta of the batch the next allocation would go to,
+    so it's `None` both for warehouse stock and when nothing is available.
+    """
+    available = [b for b in sorted(product.batches) if b.available_quantity > 0]
+    return (
+        sum(b.available_quantity for b in available),
+        available[0].eta if available else None,
+    )
+
+
+def _earliest_first(levels: Iterable[StockLevel]) -> Optional[date]:
+    """Warehouse stock (no eta) comes first, like in `Batch.__gt__`"""
+    in_stock = sorted(
+        (eta for qty, eta in levels if qty > 0),
+        key=lambda eta: (eta is not None, eta or date.min),
+    )
+    return in_stock[0] if in_stock else None
+
+
+def save(
+    conn, sku: str, level: StockLevel, partition: str = model.DEFAULT_PARTITION
+) -> None:
+    available, earliest_eta = level
+    params = {
+        'b_sku': sku, 'b_partition': partition,
+        'b_available': available, 'b_earliest_eta': earliest_eta,
+    }
+    if conn.execute(_UPDATE, params).rowcount == 0:
+        conn.execute(_INSERT, params)
+
+
+def save_products(conn, products: Iterable[model.Product]) -> None:
+    for product in products:
+        save(conn, product.sku, of_product(product), product.partition)
+
+
+def recompute(conn, skus: Iterable[str]) -> None:
+    """Same numbers as `of_product`, but aggregated by the DB"""
+    allocated = (
+        select([func.sum(orm.order_lines.c.qty)])
+        .select_from(orm.allocations.join(orm.order_lines))
+        .where(orm.allocations.c.batch_id == orm.batches.c.id)
+        .as_scalar()
+    )
+    available = orm.batches.c._purchased_quantity - func.coalesce(allocated, 0)
+    for sku in skus:
+        partitions: dict = {}
+        for partition, qty, eta in conn.execute(
+            select([orm.batches.c.partition, available.label('available'), orm.batches.c.eta])
+            .where(orm.batches.c.sku == sku)
+        ):
+            partitions.setdefault(partition, []).append((qty, eta))
+        for partition, rows in (partitions or {model.DEFAULT_PARTITION: []}).items():
+            save(conn, sku, (
+                sum(qty for qty, _ in rows if qty > 0), _earliest_first(rows)
+            ), partition)
+
+
+def get(conn, sku: str) -> Optional[StockLevel]:
+    """All the partitions of the sku together"""
+    rows = [tuple(row) for row in conn.execute(_SELECT, {'b_sku': sku})]
+    if not rows:
+        return None
+    return sum(available for available, _ in rows), _earliest_first(rows)
+
+
+def backfill(engine, chunk_size: int = 1000) -> int:
+    """`recompute` of every sku, a chunk per transaction. Returns how many"""
+    done, after = 0, ''
+    while True:
+        with engine.begin() as conn:
+            skus = [sku for (sku,) in conn.execute(
+                select([orm.products.c.sku]).distinct()
+                .where(orm.products.c.sku > after)
+                .order_by(orm.products.c.sku).limit(chunk_size)
+            )]
+            if not skus:
+                return done
+            recompute(conn, skus)
+        done += len(skus)
+        after = skus[-1]
+
+
+if __name__ == '__main__':
+    from allocation.service_layer import unit_of_work
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info('backfilled the stock levels of %s skus', backfill(unit_of_work.DEFAULT_ENGINE))
@@ -0,0 +1,212 @@
+"""Lightweight tracing: spans for services, units of work, repository and the
+message bus handlers, to see why a *particular* request was slow.
+
+A trace starts at the entrypoint (`start_trace`), is sampled or not right there,
+and travels with the context like the profiler's service call. Inside an
+unsampled request `span` finds nothing in the context and returns a shared
+no-op, so that's all it costs. Work handed over to another thread keeps the
+trace if it is wrapped with `carry`.
+
+A finished trace goes to an exporter: a local JSON-lines file, or an
+OTLP/HTTP-JSON collector (e.g. a local otel-collector standing in for the real one).
+"""
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterator, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    def __init__(self, trace: 'Trace', name: str, parent_id: Optional[str], **attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return {
+            'trace_id': self.trace.trace_id, 'span_id': self.span_id,
+            'parent_id': self.parent_id, 'name': self.name,
+            'start': self.start, 'end': self.end,
+            'attributes': self.attributes, 'error': self.error,
+        }
+
+
+class Trace:
+    def __init__(self, trace_id: Optional[str] = None) -> None:
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+
+# =========== Exporters ===============================
+# =====================================================
+class FileExporter:
+    """One JSON line per span"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace) -> None:
+        lines = ''.join(json.dumps(s.as_dict()) + '\n' for s in trace.spans)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+class OtlpHttpExporter:
+    """Posts OTLP/JSON to `{url}/v1/traces` from a background thread, so the
+    request never waits for the collector. Traces are dropped when it can't keep up.
+    """
+    def __init__(self, url: str, service_name: str = 'allocation') -> None:
+        self.url = url.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+        self._queue: queue.Queue = queue.Queue(maxsize=1000)
+        threading.Thread(target=self._run, daemon=True, name='otlp-exporter').start()
+
+    def export(self, trace: Trace) -> None:
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning('dropping trace %s, exporter queue is full', trace.trace_id)
+
+    def payload(self, trace: Trace) -> dict:
+        def attributes(values: dict) -> list:
+            return [{'key': k, 'value': {'stringValue': str(v)}} for k, v in values.items()]
+
+        return {'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': self.service_name})},
+            'scopeSpans': [{'spans': [
+                {
+                    'traceId': trace.trace_id, 'spanId': s.span_id,
+                    'parentSpanId': s.parent_id or '', 'name': s.name,
+                    'startTimeUnixNano': int(s.start * 1e9),
+                    'endTimeUnixNano': int((s.end or s.start) * 1e9),
+                    'attributes': attributes(s.attributes),
+                    'status': {'code': 2, 'message': s.error} if s.error else {},
+                }
+                for s in trace.spans
+            ]}],
+        }]}
+
+    def _run(self) -> None:
+        while True:
+            trace = self._queue.get()
+            request = urllib.request.Request(
+                self.url, data=json.dumps(self.payload(trace)).encode(),
+                headers={'Content-Type': 'application/json'},
+            )
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except OSError as e:
+                logger.warning('could not export trace %s: %s', trace.trace_id, e)
+
+
+# =========== Spans ===================================
+# =====================================================
+_current: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+SAMPLE_RATE = 0.0
+EXPORTER = None
+
+
+def configure(sample_rate: float, exporter) -> None:
+    global SAMPLE_RATE, EXPORTER
+    SAMPLE_RATE, EXPORTER = sample_rate, exporter
+
+
+_NULL_SPAN = nullcontext()  # reusable, it holds no state
+
+
+@contextmanager
+def _span(parent: Span, name: str, attributes: dict) -> Iterator[Span]:
+    span = Span(parent.trace, name, parent.span_id, **attributes)
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        span.end = time.time()
+        span.trace.add(span)
+        _current.reset(token)
+
+
+def span(name: str, **attributes):
+    """A child of the current span, a no-op outside of a sampled trace"""
+    parent = _current.get()
+    if parent is None:
+        return _NULL_SPAN
+    return _span(parent, name, attributes)
+
+
+@contextmanager
+def start_trace(
+    name: str, trace_id: Optional[str] = None, sampled: Optional[bool] = None,
+    **attributes,
+) -> Iterator[Optional[Span]]:
+    """The root span of a request. `sampled=None` leaves it to SAMPLE_RATE"""
+    if sampled is None:
+        sampled = EXPORTER is not None and random.random() < SAMPLE_RATE
+    if not sampled or EXPORTER is None:
+        yield None
+        return
+
+    trace = Trace(trace_id)
+    root = Span(trace, name, None, **attributes)
+    token = _current.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        root.end = time.time()
+        trace.add(root)
+        _current.reset(token)
+        EXPORTER.export(trace)
+
+
+def traced(fn: Callable) -> Callable:
+    """Decorator: a span named after the function for each call"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return fn(*args, **kwargs)
+        with _span(_current.get(), fn.__qualname__, {}):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def current_trace_id() -> Optional[str]:
+    """`None` outside of a sampled trace"""
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
+
+
+def carry(fn: Callable) -> Callable:
+    """For handing work to another thread: runs `fn` in a copy of the current
+    context, so its spans end up in the same trace.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
@@ -1,6 +1,23 @@
 import os
 
 
+def get_db_backend():
+    """"postgres" or "sqlite" (single node, see `adapters.engines`)"""
+    return os.environ.get("DB_BACKEND", "postgres")
+
+
+def get_sqlite_path():
+    return os.environ.get("SQLITE_PATH", "/var/lib/allocation/allocation.db")
+
+
+def get_sqlite_readers():
+    return int(os.environ.get("SQLITE_READERS", 4))
+
+
+def get_sqlite_busy_timeout_ms():
+    return int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+
 def get_postgres_uri():
     host = os.environ.get("DB_HOST", "localhost")
     if host == "localhost":
@@ -14,6 +31,18 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_postgres_replica_uri():
+    """A read-only replica, `None` means all reads go to the primary"""
+    host = os.environ.get("DB_REPLICA_HOST")
+    if host is None:
+        return None
+
+    password = os.environ.get("DB_PASSWORD", "abc123")
+    user, db_name = "allocation", "allocation"
+
+    return f"postgresql://{user}:{password}@{host}:5432/{db_name}"
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     if host == "localhost":
@@ -21,4 +50,120 @@ def get_api_url():
     else:
         port = 80
 
-    return f"http://{host}:{port}"
\ No newline at end of file
+    return f"http://{host}:{port}"
+
+def get_slow_query_threshold():
+    """Seconds after which a statement is logged, `None` disables profiling"""
+    threshold_ms = os.environ.get("SLOW_QUERY_MS")
+    if threshold_ms is None:
+        return None
+
+    return float(threshold_ms) / 1000
+
+
+def get_snapshot_path():
+    """A product snapshot to warm-start from (see `adapters.snapshot`)"""
+    return os.environ.get("PRODUCT_SNAPSHOT")
+
+
+def get_allocate_coalesce_window():
+    """Seconds to park concurrent allocations of a SKU, `None` disables it"""
+    window_ms = os.environ.get("ALLOCATE_COALESCE_MS")
+    if window_ms is None:
+        return None
+
+    return float(window_ms) / 1000
+
+
+def get_sku_lock_mode():
+    """One of "thread", "advisory" (postgres) or "file", `None` disables it"""
+    return os.environ.get("SKU_LOCKS")
+
+
+def get_sku_lock_dir():
+    return os.environ.get("SKU_LOCK_DIR", "/tmp/allocation-locks")
+
+
+def get_persistence_mode():
+    """"orm" (tables per entity) or "events" (event log + snapshots)"""
+    return os.environ.get("PERSISTENCE", "orm")
+
+
+def get_event_snapshot_interval():
+    return int(os.environ.get("EVENT_SNAPSHOT_INTERVAL", 100))
+
+
+def get_request_timeout():
+    """Default deadline of a request in seconds, `None` means no deadline"""
+    timeout_ms = os.environ.get("REQUEST_TIMEOUT_MS")
+    if timeout_ms is None:
+        return None
+
+    return float(timeout_ms) / 1000
+
+
+def get_admin_token():
+    """The admin endpoints (e.g. the profiler) are off unless it's set"""
+    return os.environ.get("ADMIN_TOKEN")
+
+
+def get_trace_sample_rate():
+    """Share of the requests which are traced, 0 (the default) turns it off"""
+    return float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+
+
+def get_trace_file():
+    return os.environ.get("TRACE_FILE")
+
+
+def get_otlp_endpoint():
+    """e.g. http://localhost:4318 for a local otel-collector"""
+    return os.environ.get("OTLP_ENDPOINT")
+
+
+def get_memory_budget():
+    """Bytes of aggregates a unit of work may hold, `None` means no limit"""
+    budget_mb = os.environ.get("MEMORY_BUDGET_MB")
+    if budget_mb is None:
+        return None
+
+    return int(float(budget_mb) * 1024 * 1024)
+
+
+def get_smtp_host():
+    """Without one, emails are only printed"""
+    return os.environ.get("SMTP_HOST")
+
+
+def get_smtp_port():
+    return int(os.environ.get("SMTP_PORT", 25))
+
+
+def get_smtp_pool_size():
+    return int(os.environ.get("SMTP_POOL_SIZE", 2))
+
+
+def get_write_only_allocations():
+    """ALLOCATIONS=write-only: batches never load their order lines"""
+    return os.environ.get("ALLOCATIONS", "set") == "write-only"
+
+
+def get_hot_skus_log_interval():
+    """Seconds between dumps of the hottest skus to the log, `None` for never"""
+    seconds = os.environ.get("HOT_SKUS_LOG_SECONDS")
+    return float(seconds) if seconds else None
+
+
+def get_prewarm():
+    """PREWARM=1: connect and load the hot skus in the background on start-up"""
+    return os.environ.get("PREWARM", "0") == "1"
+
+
+def get_prewarm_skus():
+    """Comma separated, the skus the first requests are likely to ask for"""
+    return [sku for sku in os.environ.get("PREWARM_SKUS", "").split(",") if sku]
+
+
+def get_prewarm_connections():
+    """Per engine, opened at the same time"""
+    return int(os.environ.get("PREWARM_CONNECTIONS", 2))
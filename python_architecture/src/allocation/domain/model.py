@@ -22,12 +22,16 @@ from allocation.domain import events
 Quantity = NewType("Quantity", int)
 
 Sku = NewType("Sku", str)
+Partition = NewType("Partition", str)  # e.g. a warehouse or a region
 BatchReference = NewType("BatchReference", str)
 OrderReference = NewType("OrderReference", str)
 
 class OutOfStock(Exception):
     pass
 
+# a sku which isn't split up (by warehouse) is one aggregate, in this partition
+DEFAULT_PARTITION = Partition("")
+
 # =========== Value objects (without identity) ========
 # =====================================================
 @dataclass(unsafe_hash=True)
@@ -48,6 +52,15 @@ class OrderLine:
     qty: Quantity
 
 
+class Allocations(set):
+    """The lines allocated to a batch. The ORM can swap in a collection which
+    knows its quantity without holding all of the lines (write-only mode)
+    """
+    @property
+    def quantity(self) -> int:
+        return sum(line.qty for line in self)
+
+
 # =========== Entities with behavior ==================
 # =====================================================
 class Batch(object):
@@ -64,14 +77,16 @@ class Batch(object):
     immutable, but then there is no point in OOP besides namespacing
     """
     def __init__(self, 
-        ref: BatchReference, sku: Sku, qty: Quantity, eta: Optional[date]
+        ref: BatchReference, sku: Sku, qty: Quantity, eta: Optional[date],
+        partition: Partition = DEFAULT_PARTITION,
     ) -> None:
         self.reference = ref
         self.sku = sku
         self.eta = eta
+        self.partition = partition
 
         self._purchased_quantity = qty
-        self._allocations: Set[OrderLine] = set()
+        self._allocations = Allocations()
 
     def __repr__(self) -> str:
         """Display the representation of the object (entity -> id)"""
@@ -107,7 +122,7 @@ class Batch(object):
     @property
     def allocated_quantity(self) -> int:
         """Calculated property based on the state"""
-        return sum(line.qty for line in self._allocations)
+        return self._allocations.quantity
 
     @property
     def available_quantity(self) -> int:
@@ -141,19 +156,78 @@ def allocate(line: OrderLine, batches: List[Batch]) -> BatchReference:
         raise OutOfStock(f'Out of stock for sku {line.sku}')
 
 
+def _by_eta(batch: Batch) -> Tuple[bool, date]:
+    """The order of `sorted(batches)`, as a key: warehouse stock (no eta) first"""
+    return batch.eta is not None, batch.eta or date.min
+
+
+def plan_split(line: OrderLine, batches: List[Batch]) -> List[Tuple[Batch, Quantity]]:
+    """How much of the line each batch takes, filling them in eta order: every
+    batch what it has available, until the line is covered.
+
+    A single pass with a running (prefix) sum of the available quantities,
+    which stops at the batch covering the line, so the later batches aren't
+    even looked at. Empty when all of them together don't have enough.
+    """
+    if line.qty <= 0:
+        raise ValueError(f"Can't split a line of {line.qty}")
+
+    plan: List[Tuple[Batch, Quantity]] = []
+    covered = 0
+    for batch in sorted(batches, key=_by_eta):
+        if batch.sku != line.sku:
+            continue
+        available = batch.available_quantity
+        if available <= 0:
+            continue
+        take = Quantity(min(available, line.qty - covered))
+        plan.append((batch, take))
+        covered += take
+        if covered == line.qty:
+            return plan
+    return []
+
+
+def aggregate_key(sku: Sku, partition: Partition = DEFAULT_PARTITION) -> str:
+    return f"{sku}@{partition}" if partition != DEFAULT_PARTITION else sku
+
+
 # =========== Aggregates and Data Consistency ================
 # ============================================================
 class Product:  # GlobalSKUStock
-    """Could be also called GlobalSkuStock. It is an aggregate/cluster of entities"""
+    """Could be also called GlobalSkuStock. It is an aggregate/cluster of entities
+
+    A popular sku can be split into partitions (e.g. by warehouse), each one a
+    Product of its own, with its own batches and version_number. Allocations in
+    different partitions then don't wait for each other.
+    """
     
-    def __init__(self, sku: Sku, batches: List[Batch], version_number: int = 0):
+    def __init__(
+        self, sku: Sku, batches: List[Batch], version_number: int = 0,
+        partition: Partition = DEFAULT_PARTITION,
+    ):
         self.sku = sku
+        self.partition = partition
         self.batches = batches
         self.version_number = version_number
 
         self.events: List[events.Event] = []
 
-    def allocate(self, line: OrderLine) -> str:
+    @property
+    def key(self) -> str:
+        """Identifies the aggregate, e.g. for locks: the sku if not partitioned"""
+        return aggregate_key(self.sku, self.partition)
+
+    def add_batch(self, batch: Batch) -> None:
+        """Any change of the batches is a new version: concurrent writers and
+        the warm-start snapshot (which is only used while the version matches)
+        have to notice it
+        """
+        self.batches.append(batch)
+        self.version_number += 1
+
+    def allocate(self, line: OrderLine) -> Optional[BatchReference]:
+        """The batch the line went to, `None` (and an OutOfStock event) if none"""
         try:
             batch = next(
                 b for b in sorted(self.batches) if b.can_allocate(line)
@@ -166,3 +240,19 @@ class Product:  # GlobalSKUStock
 
             # the event now does the job of the exception
             # raise OutOfStock(f"Out of stock for sku {line.sku}")
+            return None
+
+    def allocate_split(self, line: OrderLine) -> Optional[List[Tuple[BatchReference, Quantity]]]:
+        """For lines no single batch can take (e.g. B2B orders): split across
+        batches in eta order, see `plan_split`. Every batch gets an OrderLine
+        of its part, same orderid. All or nothing, `None` when out of stock.
+        """
+        plan = plan_split(line, self.batches)
+        if not plan:
+            self.events.append(events.OutOfStock(line.sku))
+            return None
+
+        for batch, qty in plan:
+            batch.allocate(OrderLine(line.orderid, line.sku, qty))
+        self.version_number += 1
+        return [(batch.reference, qty) for batch, qty in plan]
@@ -0,0 +1,38 @@
+"""Command line entrypoint for the bulk shipment loader:
+
+    python -m allocation.entrypoints.bulk_load shipments.csv [--chunk-size 5000]
+
+Re-running the same command after a failure resumes from the last checkpoint.
+"""
+
+import argparse
+import os
+
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import bulk_load
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='a .csv or .parquet file with ref,sku,qty,eta(,partition)')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--db-uri', default=None, help='defaults to postgres')
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.db_uri or config.get_postgres_uri())
+    stats = bulk_load.load_batches(
+        engine, os.path.abspath(args.path), bulk_load.read_rows(args.path),
+        chunk_size=args.chunk_size,
+        progress=lambda s: print(f'{s.rows} rows, {s.rows_per_sec:,.0f} rows/sec'),
+    )
+    print(
+        f'loaded {stats.rows} batches ({stats.skipped} already done),'
+        f' {stats.products_created} new products'
+        f' in {stats.seconds:.1f}s: {stats.rows_per_sec:,.0f} rows/sec'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,178 @@
 """The web service only takes care of typical web-server stuff. Request-response
 
-TODO(Mihai): a read-only endpoint: repo.get() in the flask handler. Note that 
-reads vs writes is quite a big topic and has its own pattern.
+The read-only endpoint (GET /products/<sku>) can be served by a replica. Note
+that reads vs writes is quite a big topic and has its own pattern (CQRS).
 """
 
+import atexit
+import hmac
+import threading
 from datetime import datetime
-from flask import Flask, jsonify, request
+from typing import Optional
+from flask import Flask, Response, abort, g, jsonify, make_response, request
+from sqlalchemy.exc import OperationalError
 
+from allocation import config
 from allocation.domain import model
-from allocation.adapters import orm
-from allocation.service_layer import services, unit_of_work
+from allocation.adapters import email, orm, snapshot, tracing
+from allocation.service_layer import (
+    coalescer, deadlines, hot_skus, memory, messagebus, services, unit_of_work,
+    warmup,
+)
 
 
+# Importing this module is on the cold start path: the engines are only created
+# (and the mappers configured) when needed, or by the pre-warm below.
 app = Flask(__name__)
-orm.start_mappers()
+orm.start_mappers(write_only_allocations=config.get_write_only_allocations())
+
+# warm start: hot products come from the memory-mapped file, not from postgres
+SNAPSHOT = None
+if config.get_snapshot_path():
+    SNAPSHOT = snapshot.load(config.get_snapshot_path())
+
+
+
+def requested_partition() -> Optional[str]:
+    """`None` if the client didn't ask for one. The event store keeps one log
+    per sku, it can't have partitions.
+    """
+    partition = request.json.get("partition")
+    if partition and config.get_persistence_mode() == "events":
+        abort(make_response(
+            jsonify({"message": "Partitions need PERSISTENCE=orm"}), 400
+        ))
+    return partition
+
+
+def new_uow() -> unit_of_work.AbstractUnitOfWork:
+    """Dependency injection (only one place), one uow per request"""
+    if config.get_persistence_mode() == "events":
+        return unit_of_work.EventSourcedUnitOfWork()
+    return unit_of_work.SqlAlchemyUnitOfWork(snapshot=SNAPSHOT)
+
+
+# spans of a share of the requests, to a file or to an OTLP collector
+if config.get_otlp_endpoint():
+    tracing.configure(
+        config.get_trace_sample_rate(),
+        tracing.OtlpHttpExporter(config.get_otlp_endpoint()),
+    )
+elif config.get_trace_file():
+    tracing.configure(
+        config.get_trace_sample_rate(), tracing.FileExporter(config.get_trace_file())
+    )
+
+# notifications go out in batches, from a queue, over pooled connections
+if config.get_smtp_host():
+    transport = email.SmtpTransport(
+        config.get_smtp_host(), config.get_smtp_port(),
+        pool_size=config.get_smtp_pool_size(),
+    )
+    email.configure(transport)
+    atexit.register(transport.close)  # sends what's still queued
+
+# connect and load the hot skus while the first requests already come in
+if config.get_prewarm():
+    warmup.start_in_background(
+        new_uow, config.get_prewarm_skus(), config.get_prewarm_connections(),
+    )
+
+# which skus to shard, cache or coalesce (see /admin/hot_skus)
+if config.get_hot_skus_log_interval():
+    hot_skus.TRACKER.log_every(config.get_hot_skus_log_interval())
+
+# the on-demand sampling profiler, at most one at a time (see /admin/profile)
+SAMPLER = None
+_sampler_lock = threading.Lock()
+
+# group commit of concurrent allocations for the same (hot) sku
+COALESCER = None
+if config.get_allocate_coalesce_window() is not None:
+    COALESCER = coalescer.AllocateCoalescer(
+        new_uow, window=config.get_allocate_coalesce_window(),
+    )
+
+
+@app.before_request
+def start_deadline():
+    """The client can ask for a tighter deadline with `X-Request-Timeout` (ms),
+    never for a looser one than REQUEST_TIMEOUT_MS
+    """
+    timeout = config.get_request_timeout()
+    if request.headers.get("X-Request-Timeout"):
+        try:
+            asked = float(request.headers["X-Request-Timeout"]) / 1000
+        except ValueError:
+            asked = float("nan")
+        if not asked >= 0:  # negative or not a number
+            abort(400, "X-Request-Timeout is in milliseconds")
+        timeout = asked if timeout is None else min(timeout, asked)
+    g.deadline = deadlines.deadline(timeout)
+    g.deadline.__enter__()
+    g.memory = memory.track()
+    g.memory.__enter__()
+
+
+@app.before_request
+def start_trace():
+    """Joins the caller's trace if it sends a (sampled) W3C `traceparent`"""
+    trace_id, sampled = None, None
+    parts = request.headers.get("traceparent", "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[3]) == 2:
+        try:
+            flags = int(parts[3], 16)
+        except ValueError:
+            flags = None
+        if flags is not None:  # bit 0 is `sampled`, the others are for later
+            trace_id, sampled = parts[1], bool(flags & 1)
+    g.trace = tracing.start_trace(
+        f"{request.method} {request.path}", trace_id=trace_id, sampled=sampled
+    )
+    g.trace.__enter__()
+
+
+@app.teardown_request
+def end_request(_):
+    if "trace" in g:
+        g.trace.__exit__(None, None, None)
+    if "memory" in g:
+        g.memory.__exit__(None, None, None)
+    if "deadline" in g:
+        g.deadline.__exit__(None, None, None)
+
+
+@app.after_request
+def count_profiled_request(response):
+    if SAMPLER is not None:  # all it costs while the profiler is off
+        SAMPLER.request_done()
+    return response
+
+
+@app.after_request
+def report_memory_peak(response):
+    """Peak bytes of aggregates held by the units of work of the request"""
+    if memory.peak():
+        response.headers["X-Aggregate-Memory-Peak"] = str(memory.peak())
+    return response
+
+
+@app.errorhandler(deadlines.DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({"message": str(e)}), 504
+
+
+@app.errorhandler(memory.MemoryBudgetExceeded)
+def memory_budget_exceeded(e):
+    return jsonify({"message": str(e)}), 503
+
+
+@app.errorhandler(OperationalError)
+def db_timeout(e):
+    """Statements cancelled by the deadline's timeouts are 504s too"""
+    if deadlines.is_db_timeout(e):
+        return jsonify({"message": "Deadline exceeded"}), 504
+    raise e
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -24,7 +183,7 @@ def add_batch():
     
     services.add_batch(
         request.json["ref"], request.json["sku"], request.json["qty"], eta,
-        unit_of_work.SqlAlchemyUnitOfWork(),  # dependency injection (only one)
+        new_uow(), partition=requested_partition() or model.DEFAULT_PARTITION,
     )
 
     return "OK", 201
@@ -32,14 +191,141 @@ def add_batch():
 
 @app.route("/allocate", methods=["POST"])
 def allocate_endpoint():
+    """With `"split": true` a line can be spread over several batches"""
+    if request.json.get("split"):
+        return allocate_split_endpoint()
+    try:
+        partition = requested_partition()
+        if COALESCER is not None and partition is None:
+            batchref = COALESCER.allocate(
+                request.json["orderid"], request.json["sku"], request.json["qty"]
+            )
+        else:
+            batchref = services.allocate(
+                request.json["orderid"],
+                request.json["sku"],
+                request.json["qty"],
+                new_uow(),
+                partition=partition,
+            )
+    except (model.OutOfStock, services.InvalidSku) as e:
+        return jsonify({"message": str(e)}), 400
+
+    return jsonify({"batchref": batchref}), 201
+
+
+def allocate_split_endpoint():
+    qty = request.json["qty"]
+    if not isinstance(qty, int) or isinstance(qty, bool) or qty <= 0:
+        return jsonify({"message": "qty must be a positive integer"}), 400
+
     try:
-        batchref = services.allocate(
+        allocations = services.allocate_split(
             request.json["orderid"],
             request.json["sku"],
             request.json["qty"],
-            unit_of_work.SqlAlchemyUnitOfWork(),   
+            new_uow(),
+            partition=requested_partition(),
         )
     except (model.OutOfStock, services.InvalidSku) as e:
         return jsonify({"message": str(e)}), 400
 
-    return jsonify({"batchref": batchref}), 201
\ No newline at end of file
+    if allocations is None:  # for `allocate` that's a `"batchref": null`
+        return jsonify({"message": f"Out of stock for sku {request.json['sku']}"}), 400
+    return jsonify({
+        "allocations": [{"batchref": ref, "qty": qty} for ref, qty in allocations]
+    }), 201
+
+
+@app.route("/products/<sku>", methods=["GET"])
+def get_product_endpoint(sku):
+    try:
+        product = services.get_product(
+            sku, new_uow(),
+            min_version=request.args.get("min_version", 0, type=int),
+        )
+    except services.InvalidSku as e:
+        return jsonify({"message": str(e)}), 404
+
+    return jsonify(product), 200
+
+
+@app.route("/stock/<sku>", methods=["GET"])
+def get_stock_endpoint(sku):
+    try:
+        stock = services.get_stock(sku, new_uow())
+    except services.InvalidSku as e:
+        return jsonify({"message": str(e)}), 404
+
+    return jsonify(stock), 200
+
+
+def _check_admin():
+    token = config.get_admin_token()
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(403)
+
+
+@app.route("/admin/profile", methods=["POST"])
+def profile_endpoint():
+    """Samples stacks for `seconds` (or until `requests` were served), returns
+    `format=collapsed` (flamegraph.pl) or `format=speedscope` (json).
+    Needs `Authorization: Bearer $ADMIN_TOKEN`, doesn't exist without a token.
+    """
+    from allocation.entrypoints import sampler  # not needed to start up
+
+    global SAMPLER
+    _check_admin()
+    if not _sampler_lock.acquire(blocking=False):
+        return jsonify({"message": "Already profiling"}), 409
+
+    try:
+        profile = SAMPLER = sampler.StackSampler(
+            interval=request.args.get("interval_ms", 5.0, type=float) / 1000
+        )
+        profile.run_for(
+            min(request.args.get("seconds", 10.0, type=float), 300),
+            max_requests=request.args.get("requests", None, type=int),
+        )
+    finally:
+        SAMPLER = None
+        _sampler_lock.release()
+
+    if request.args.get("format") == "speedscope":
+        return jsonify(profile.speedscope()), 200
+    return Response(profile.collapsed(), mimetype="text/plain"), 200
+
+
+@app.route("/admin/bus", methods=["GET"])
+def bus_metrics_endpoint():
+    """Latency, failures and retries per handler, and the dead letters"""
+    _check_admin()
+    metrics = messagebus.metrics()
+    return jsonify({
+        "handlers": {
+            name: dict(vars(stats), mean_time=stats.mean_time)
+            for name, stats in metrics["handlers"].items()
+        },
+        "dead_letters": [
+            {"event": repr(letter.event), "handler": letter.handler.__name__,
+             "error": letter.error, "attempts": letter.attempts, "at": letter.at}
+            for letter in messagebus.DEAD_LETTERS
+        ],
+    }), 200
+
+
+@app.route("/admin/hot_skus", methods=["GET"])
+def hot_skus_endpoint():
+    """Top `n` skus of the last minute or two, `by` one metric or all of them"""
+    _check_admin()
+    n = request.args.get("n", 10, type=int)
+    by = request.args.get("by")
+    if by is not None and by not in hot_skus.METRICS:
+        return jsonify({"message": f"by is one of {', '.join(hot_skus.METRICS)}"}), 400
+
+    report = {by: hot_skus.TRACKER.top(by, n)} if by else hot_skus.TRACKER.report(n)
+    return jsonify({
+        metric: [vars(hot) for hot in ranked] for metric, ranked in report.items()
+    }), 200
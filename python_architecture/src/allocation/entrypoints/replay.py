@@ -0,0 +1,161 @@
+"""Replays a recorded stream of commands through the service layer, offline.
+
+To answer capacity questions ("how many allocations/sec with 300 batches per
+sku?") and to compare allocation engines and loading strategies on identical
+workloads. The log is NDJSON, one command per line:
+
+    {"cmd": "add_batch", "ref": "b1", "sku": "LAMP", "qty": 100, "eta": null}
+    {"cmd": "allocate", "orderid": "o1", "sku": "LAMP", "qty": 10}
+
+    python -m allocation.entrypoints.replay orders.ndjson --uow sqlite
+"""
+
+import argparse
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from allocation.domain import events
+from allocation.service_layer import messagebus, services, unit_of_work
+
+
+UowFactory = Callable[[], unit_of_work.AbstractUnitOfWork]
+
+
+@dataclass
+class ReplayReport:
+    seconds: float = 0.0
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    errors: Counter = field(default_factory=Counter)
+    out_of_stock: int = 0
+    stock: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def commands(self) -> int:
+        return sum(len(l) for l in self.latencies.values())
+
+    @property
+    def throughput(self) -> float:
+        return self.commands / self.seconds if self.seconds else 0.0
+
+    def percentiles(self, cmd: str, points=(50, 90, 99, 100)) -> Dict[int, float]:
+        """Nearest-rank percentiles of the latency, in seconds"""
+        latencies = sorted(self.latencies[cmd])
+        if not latencies:
+            return {}
+        return {
+            p: latencies[max(0, -(-p * len(latencies) // 100) - 1)] for p in points
+        }
+
+    def summary(self) -> str:
+        lines = [
+            f'{self.commands} commands in {self.seconds:.2f}s:'
+            f' {self.throughput:,.0f} commands/sec',
+        ]
+        for cmd in sorted(self.latencies):
+            lines.append(f'  {cmd}: ' + ', '.join(
+                f'p{p}={latency * 1000:.2f}ms'
+                for p, latency in self.percentiles(cmd).items()
+            ))
+        lines.append(f'  out of stock: {self.out_of_stock}, errors: {dict(self.errors)}')
+        lines.append(f'  available stock: {sum(self.stock.values())} over'
+                     f' {len(self.stock)} skus')
+        return '\n'.join(lines)
+
+
+def read_commands(path) -> Iterator[dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+@contextmanager
+def _counting_out_of_stock(report: ReplayReport):
+    """Counts the events instead of sending an email for each of them"""
+    def count(event):
+        report.out_of_stock += 1
+
+    handlers = messagebus.HANDLERS[events.OutOfStock]
+    messagebus.HANDLERS[events.OutOfStock] = [count]
+    try:
+        yield
+    finally:
+        messagebus.HANDLERS[events.OutOfStock] = handlers
+
+
+def _execute(command: dict, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    if command['cmd'] == 'add_batch':
+        eta = command.get('eta')
+        services.add_batch(
+            command['ref'], command['sku'], command['qty'],
+            date.fromisoformat(eta) if eta else None, uow,
+        )
+    elif command['cmd'] == 'allocate':
+        services.allocate(command['orderid'], command['sku'], command['qty'], uow)
+    else:
+        raise ValueError(f"Unknown command {command['cmd']}")
+
+
+def replay(commands: Iterable[dict], uow_factory: UowFactory) -> ReplayReport:
+    report = ReplayReport()
+    skus = set()
+
+    with _counting_out_of_stock(report):
+        start = time.perf_counter()
+        for command in commands:
+            skus.add(command['sku'])
+            before = time.perf_counter()
+            try:
+                _execute(command, uow_factory())
+            except Exception as e:
+                report.errors[type(e).__name__] += 1
+            report.latencies[command['cmd']].append(time.perf_counter() - before)
+        report.seconds = time.perf_counter() - start
+
+    for sku in sorted(skus):
+        try:
+            product = services.get_product(sku, uow_factory())
+        except services.InvalidSku:
+            continue
+        report.stock[sku] = sum(b['available'] for b in product['batches'])
+    return report
+
+
+def _uow_factory(kind: str, sqlite_path: str) -> UowFactory:
+    if kind == 'memory':
+        uow = unit_of_work.InMemoryUnitOfWork()
+        return lambda: uow
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from allocation import config
+    from allocation.adapters import orm
+
+    orm.start_mappers(write_only_allocations=config.get_write_only_allocations())
+    if kind == 'postgres':
+        return unit_of_work.SqlAlchemyUnitOfWork
+
+    engine = create_engine(f'sqlite:///{sqlite_path}')
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    return lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='NDJSON file with add_batch/allocate commands')
+    parser.add_argument('--uow', choices=['memory', 'sqlite', 'postgres'], default='memory')
+    parser.add_argument('--sqlite-path', default=':memory:')
+    args = parser.parse_args(argv)
+
+    report = replay(read_commands(args.path), _uow_factory(args.uow, args.sqlite_path))
+    print(report.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""A low-overhead sampling profiler, switched on at runtime from the admin API.
+
+A background thread looks at the stacks of all the other threads every few ms
+(`sys._current_frames`) and counts how often each stack is seen. Nothing is
+instrumented, so requests don't pay anything while it's off (the default), and
+little while it's on: the cost is in the sampling thread, proportional to the
+sampling rate.
+
+The result is either in the collapsed-stack format of flamegraph.pl
+(`module:function;module:function count` per line) or a speedscope file.
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+Stack = Tuple[str, ...]  # root first
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005, max_depth: int = 128) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: Counter = Counter()
+        self.requests = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True, name='sampler')
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_for(self, seconds: float, max_requests: Optional[int] = None) -> None:
+        """Samples until `seconds` have passed or `max_requests` were served"""
+        self.start()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if max_requests is not None and self.requests >= max_requests:
+                break
+            time.sleep(min(0.05, max(0.0, deadline - time.monotonic())))
+        self.stop()
+
+    def request_done(self) -> None:
+        self.requests += 1
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me:
+                    self.samples[self._stack(frame)] += 1
+
+    def _stack(self, frame) -> Stack:
+        stack: List[str] = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def collapsed(self) -> str:
+        return '\n'.join(
+            f"{';'.join(stack)} {count}" for stack, count in self.samples.most_common()
+        )
+
+    def speedscope(self, name: str = 'allocation') -> dict:
+        frames: Dict[str, int] = {}
+        samples, weights = [], []
+        for stack, count in self.samples.most_common():
+            samples.append([frames.setdefault(f, len(frames)) for f in stack])
+            weights.append(count)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': [{'name': f} for f in frames]},
+            'profiles': [{
+                'type': 'sampled', 'name': name, 'unit': 'none',
+                'startValue': 0, 'endValue': sum(weights),
+                'samples': samples, 'weights': weights,
+            }],
+        }
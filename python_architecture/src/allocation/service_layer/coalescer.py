@@ -0,0 +1,142 @@
+"""Group commit for `allocate` calls on hot SKUs.
+
+Every `services.allocate` runs its own unit of work, so a burst of orders for
+the same SKU turns into a burst of transactions which conflict on
+`version_number` and retry. The coalescer parks the calls for a few ms, then a
+single *leader* thread loads the Product once, applies the lines in arrival
+order and commits all of them in one transaction. The other callers just wait
+for their result.
+
+The leader of the next group waits for the previous commit of the same SKU,
+so groups don't fight each other either.
+"""
+
+import copy
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from allocation.adapters import tracing
+from allocation.domain.model import OrderLine, OrderReference, Quantity, Sku
+from allocation.service_layer import deadlines, services, unit_of_work
+
+
+UowFactory = Callable[[], unit_of_work.AbstractUnitOfWork]
+
+
+class _PendingAllocation:
+    def __init__(self, line: OrderLine) -> None:
+        self.line = line
+        self.done = threading.Event()
+        self.batchref: Optional[str] = None
+        self.error: Optional[Exception] = None
+        # under the coalescer's lock: in a flush already, or given up on
+        self.taken = False
+        self.abandoned = False
+
+
+class _Group:
+    def __init__(self, trace_id: Optional[str]) -> None:
+        self.requests: List[_PendingAllocation] = []
+        self.full = threading.Event()
+        self.trace_id = trace_id  # the leader's, where the work shows up
+
+
+class AllocateCoalescer:
+    """`window` is how long (in seconds) the leader waits for followers"""
+
+    def __init__(
+        self, uow_factory: UowFactory, window: float = 0.005, max_group: int = 256,
+        stripes: int = 64,
+    ) -> None:
+        self.uow_factory = uow_factory
+        self.window = window
+        self.max_group = max_group
+
+        self._lock = threading.Lock()
+        self._pending: Dict[str, _Group] = {}
+        # striped like `locks.SkuLockManager`, not a lock per sku ever seen
+        self._commit_locks = [threading.Lock() for _ in range(stripes)]
+
+    def allocate(self, orderid: str, sku: str, qty: int) -> Optional[str]:
+        """Same contract as `services.allocate`, minus the uow argument.
+
+        The group runs with the leader's deadline, in the leader's trace. A
+        follower's trace has a span for the wait (pointing to that trace), and
+        a follower with time left does its line itself if the leader's ran out.
+        """
+        request = _PendingAllocation(
+            OrderLine(OrderReference(orderid), Sku(sku), Quantity(qty))
+        )
+
+        with self._lock:
+            group = self._pending.get(sku)
+            is_leader = group is None
+            if group is None:
+                group = self._pending[sku] = _Group(tracing.current_trace_id())
+            group.requests.append(request)
+            if len(group.requests) >= self.max_group:
+                # a full group is flushed now, latecomers start the next one
+                self._pending.pop(sku)
+                group.full.set()
+
+        if is_leader:
+            self._lead(sku, group)
+        else:
+            with tracing.span('allocate (coalesced)', sku=sku, group_trace=group.trace_id):
+                self._follow(request)
+
+        if request.error is not None:
+            if not is_leader and _out_of_time(request.error) and not deadlines.expired():
+                return services.allocate(orderid, sku, qty, self.uow_factory())
+            # every caller raises its own (a traceback is per raise), the
+            # group's error is the cause
+            raise _copy_of(request.error) from request.error
+        return request.batchref
+
+    def _lead(self, sku: str, group: _Group) -> None:
+        group.full.wait(self.window)
+        with self._lock:
+            if self._pending.get(sku) is group:
+                self._pending.pop(sku)
+        stripe = zlib.crc32(sku.encode('utf-8')) % len(self._commit_locks)
+        with self._commit_locks[stripe]:
+            self._flush(sku, group.requests)
+
+    def _follow(self, request: _PendingAllocation) -> None:
+        if request.done.wait(deadlines.wait_timeout()):
+            return
+        with self._lock:
+            request.abandoned = not request.taken
+        if request.abandoned:
+            raise deadlines.DeadlineExceeded('Deadline exceeded waiting for the group')
+        request.done.wait()  # too late to back out, the flush has it
+
+    def _flush(self, sku: str, group: List[_PendingAllocation]) -> None:
+        with self._lock:
+            group = [request for request in group if not request.abandoned]
+            for request in group:
+                request.taken = True
+        try:
+            batchrefs = services.allocate_group(
+                sku, [request.line for request in group], self.uow_factory()
+            )
+            for request, batchref in zip(group, batchrefs):
+                request.batchref = batchref
+        except Exception as e:
+            for request in group:
+                request.batchref, request.error = None, e
+        finally:
+            for request in group:
+                request.done.set()
+
+
+def _copy_of(error: Exception) -> Exception:
+    try:
+        return copy.copy(error)
+    except Exception:  # can't be rebuilt from its args
+        return RuntimeError(f'coalesced allocation failed: {error!r}')
+
+
+def _out_of_time(error: Exception) -> bool:
+    return isinstance(error, deadlines.DeadlineExceeded) or deadlines.is_db_timeout(error)
@@ -0,0 +1,79 @@
+"""Per-request deadlines, so that a slow query can't hold a worker for seconds
+after the HTTP client has already given up.
+
+The entrypoint sets a deadline, which travels with the context (like the
+profiler's service call, no extra arguments through every layer). The unit of
+work checks it when it starts and before it commits, and turns what is left of
+it into postgres `statement_timeout`/`lock_timeout` for the transaction. The
+message bus skips the non-essential handlers once it has passed.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar('deadline', default=None)
+
+# postgres: query_canceled (statement_timeout), lock_not_available (lock_timeout)
+_TIMEOUT_PGCODES = {'57014', '55P03'}
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """`None` means no deadline, i.e. the block can take as long as it takes"""
+    if seconds is None:
+        yield
+        return
+
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left, negative once it has passed, `None` if there's no deadline"""
+    expires = _deadline.get()
+    return expires - time.monotonic() if expires is not None else None
+
+
+def wait_timeout() -> Optional[float]:
+    """For blocking waits in the process (locks, events): `None` is forever"""
+    left = remaining()
+    return max(0.0, left) if left is not None else None
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check() -> None:
+    if expired():
+        raise DeadlineExceeded('Deadline exceeded')
+
+
+def apply_to_session(session) -> None:
+    """Bounds the statements of the session's transaction by what is left.
+    Only postgres has such timeouts, elsewhere it's up to the checks above.
+    """
+    left = remaining()
+    if left is None or session.get_bind().dialect.name != 'postgresql':
+        return
+
+    check()
+    timeout_ms = max(1, int(left * 1000))
+    session.execute(f'SET LOCAL statement_timeout = {timeout_ms}')
+    session.execute(f'SET LOCAL lock_timeout = {timeout_ms}')
+
+
+def is_db_timeout(error: Exception) -> bool:
+    """Did the DB cancel the statement because of the timeouts we set?"""
+    return getattr(getattr(error, 'orig', None), 'pgcode', None) in _TIMEOUT_PGCODES
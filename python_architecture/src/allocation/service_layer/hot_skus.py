@@ -0,0 +1,117 @@
+"""Which SKUs are hot: allocated the most, rolled back the most, keeping units
+of work (and each other, see `lock_wait`) busy the longest. To decide which
+ones to shard, cache or coalesce.
+
+The catalog is too big to count everything, so each metric is a Space-Saving
+summary (Metwally et al.): `k` counters, a new SKU takes over the smallest one.
+Heavy hitters are guaranteed to be in there, a count is over-estimated by at
+most its `error`. "Rolling": a summary per window, we look at the current and
+the previous one, i.e. at the last 1-2 windows.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('allocations', 'rollbacks', 'uow_time', 'lock_wait')
+
+
+class SpaceSaving:
+    def __init__(self, k: int) -> None:
+        self.k = k
+        self.counts: Dict[str, float] = {}
+        self.errors: Dict[str, float] = {}
+
+    def add(self, key: str, weight: float = 1) -> None:
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.k:
+            self.counts[key], self.errors[key] = weight, 0
+        else:
+            # O(k), but k is small and it only happens for new keys
+            smallest = min(self.counts, key=self.counts.__getitem__)
+            floor = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[key], self.errors[key] = floor + weight, floor
+
+
+@dataclass
+class HotSku:
+    sku: str
+    value: float  # over the covered time span
+    per_second: float
+    error: float  # the value is at most this much too high
+
+
+class HotSkus:
+    def __init__(self, k: int = 100, window: float = 60.0) -> None:
+        self.k, self.window = k, window
+        self._lock = threading.Lock()
+        self._current = {metric: SpaceSaving(k) for metric in METRICS}
+        self._previous: Optional[Dict[str, SpaceSaving]] = None
+        self._started = self._previous_started = time.monotonic()
+
+    def _rotate(self, now: float) -> None:
+        if now - self._started < self.window:
+            return
+        if now - self._started < 2 * self.window:
+            self._previous, self._previous_started = self._current, self._started
+        else:  # nothing happened for a while, the previous window is stale too
+            self._previous = None
+        self._current = {metric: SpaceSaving(self.k) for metric in METRICS}
+        self._started = now
+
+    def record(self, sku: str, **weights: float) -> None:
+        """e.g. `record('LAMP', allocations=1)`, weights of the METRICS"""
+        with self._lock:
+            self._rotate(time.monotonic())
+            for metric, weight in weights.items():
+                if weight:
+                    self._current[metric].add(sku, weight)
+
+    def top(self, metric: str, n: int = 10) -> List[HotSku]:
+        if metric not in METRICS:
+            raise ValueError(f'Unknown metric {metric}, one of {METRICS}')
+        with self._lock:
+            now = time.monotonic()
+            self._rotate(now)
+            summaries = [self._current[metric]]
+            since = self._started
+            if self._previous is not None:
+                summaries.append(self._previous[metric])
+                since = self._previous_started
+            merged: Dict[str, Tuple[float, float]] = {}
+            for summary in summaries:
+                for sku, count in summary.counts.items():
+                    value, error = merged.get(sku, (0, 0))
+                    merged[sku] = (value + count, error + summary.errors[sku])
+
+        span = max(now - since, 1e-9)
+        ranked = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)
+        return [HotSku(sku, value, value / span, error) for sku, (value, error) in ranked[:n]]
+
+    def report(self, n: int = 10) -> Dict[str, List[HotSku]]:
+        return {metric: self.top(metric, n) for metric in METRICS}
+
+    def log_every(self, seconds: float, n: int = 10) -> threading.Thread:
+        """Dumps the top SKUs of every metric to the log, from a daemon thread"""
+        def dump():
+            while True:
+                time.sleep(seconds)
+                for metric, hot in self.report(n).items():
+                    if hot:
+                        logger.info('hot skus by %s: %s', metric, ', '.join(
+                            f'{h.sku}={h.value:.3g} ({h.per_second:.3g}/s)' for h in hot
+                        ))
+
+        thread = threading.Thread(target=dump, name='hot-skus', daemon=True)
+        thread.start()
+        return thread
+
+
+TRACKER = HotSkus()
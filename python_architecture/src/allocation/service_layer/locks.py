@@ -0,0 +1,178 @@
+"""Per-SKU locks held by the unit of work from `products.get` until commit.
+
+Under REPEATABLE READ two threads allocating the same SKU both do all of their
+work and only then one of them fails with a serialization error. Taking a lock
+on the SKU up front makes them wait for each other instead (pessimistic vs
+optimistic concurrency, the version_number check is still there as a safety net).
+
+Locks are striped, i.e. SKUs are hashed onto a fixed number of RLocks so memory
+doesn't grow with the catalog. There's no lock ordering between stripes: the
+services load one Product per UoW (a partitioned sku is one UoW per partition),
+a UoW loading two of them could deadlock with another one doing the same.
+
+Subclasses extend the in-process lock across processes: Postgres advisory locks
+(on a small pool of connections of their own) or, for a single box without
+Postgres, plain lock files.
+"""
+
+import fcntl
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List
+
+from sqlalchemy import create_engine, text
+
+from allocation.service_layer import deadlines
+
+
+@dataclass
+class LockStats:
+    acquisitions: int = 0
+    contended: int = 0
+    wait_time: float = 0.0
+
+
+class SkuLockManager:
+    """In-process only, good enough for the threads of one worker"""
+
+    def __init__(self, stripes: int = 64) -> None:
+        self._stripes = [threading.RLock() for _ in range(stripes)]
+        self._stats: Dict[str, LockStats] = defaultdict(LockStats)
+        self._stats_lock = threading.Lock()
+
+    def stripe(self, sku: str) -> int:
+        # not hash(), which is randomized per process
+        return zlib.crc32(sku.encode('utf-8')) % len(self._stripes)
+
+    def acquire(self, sku: str, session=None) -> float:
+        """Blocks until the SKU is ours (or the request's deadline), returns
+        the time spent waiting
+        """
+        lock = self._stripes[self.stripe(sku)]
+        contended = not lock.acquire(blocking=False)
+        start = time.perf_counter()
+        if contended:
+            timeout = deadlines.wait_timeout()
+            if not lock.acquire(timeout=-1 if timeout is None else timeout):
+                raise deadlines.DeadlineExceeded(f'Deadline exceeded waiting for {sku}')
+        try:
+            self._acquire_external(sku, session)
+        except BaseException:
+            lock.release()
+            raise
+        waited = time.perf_counter() - start
+
+        with self._stats_lock:
+            stats = self._stats[sku]
+            stats.acquisitions += 1
+            stats.contended += contended
+            stats.wait_time += waited
+        return waited
+
+    def release(self, sku: str) -> None:
+        self._release_external(sku)
+        self._stripes[self.stripe(sku)].release()
+
+    def stats(self) -> Dict[str, LockStats]:
+        with self._stats_lock:
+            return {sku: LockStats(**vars(s)) for sku, s in self._stats.items()}
+
+    def most_contended(self, n: int = 10) -> List[str]:
+        stats = self.stats()
+        return sorted(stats, key=lambda sku: stats[sku].wait_time, reverse=True)[:n]
+
+    def _acquire_external(self, sku: str, session) -> None:
+        pass
+
+    def _release_external(self, sku: str) -> None:
+        pass
+
+
+class AdvisoryLockManager(SkuLockManager):
+    """Cross-process via Postgres session-level advisory locks.
+
+    Not `pg_advisory_xact_lock` in the unit of work's transaction: under
+    REPEATABLE READ that statement takes the transaction's snapshot, before
+    waiting, so the waiter would still read what was there before the holder
+    committed. The lock is taken on a connection of its own (autocommit), before
+    the transaction reads anything, and given back explicitly on release.
+
+    Those connections come from an engine of their own: from the unit of work's
+    pool, a holder could wait for its session's connection while the lock
+    connections use up the pool.
+    """
+
+    def __init__(self, stripes: int = 64, pool_size: int = 5) -> None:
+        super().__init__(stripes)
+        self.pool_size = pool_size
+        self._engine = None
+        self._engine_lock = threading.Lock()
+        # a sku is only ever held by one thread (its stripe's RLock), the list
+        # is for the same thread taking it again
+        self._connections: Dict[str, List] = defaultdict(list)
+
+    def _lock_engine(self, session):
+        """Same database as the session, created with the first lock"""
+        with self._engine_lock:
+            if self._engine is None:
+                self._engine = create_engine(
+                    session.get_bind().url, isolation_level='AUTOCOMMIT',
+                    pool_size=self.pool_size, max_overflow=2 * self.pool_size,
+                )
+            return self._engine
+
+    def _acquire_external(self, sku: str, session) -> None:
+        conn = self._lock_engine(session).connect()
+        try:
+            left = deadlines.remaining()
+            if left is not None:
+                deadlines.check()
+                conn.execute(f'SET lock_timeout = {max(1, int(left * 1000))}')
+            conn.execute(text('SELECT pg_advisory_lock(hashtext(:sku))'), sku=sku)
+        except BaseException:
+            conn.invalidate()  # whatever it holds goes with the DB session
+            conn.close()
+            raise
+        self._connections[sku].append(conn)
+
+    def _release_external(self, sku: str) -> None:
+        conn = self._connections[sku].pop()
+        if not self._connections[sku]:
+            del self._connections[sku]
+        try:
+            conn.execute(text('SELECT pg_advisory_unlock(hashtext(:sku))'), sku=sku)
+            conn.execute('RESET lock_timeout')
+        except Exception:
+            conn.invalidate()  # closing the DB session releases the lock too
+        finally:
+            conn.close()
+
+
+class FileLockManager(SkuLockManager):
+    """Cross-process stand-in for single-node setups: one lock file per stripe"""
+
+    def __init__(self, directory: str, stripes: int = 64) -> None:
+        super().__init__(stripes)
+        os.makedirs(directory, exist_ok=True)
+        self._files = [
+            open(os.path.join(directory, f'sku-{i}.lock'), 'a+')
+            for i in range(stripes)
+        ]
+        self._depth: Dict[int, int] = defaultdict(int)
+
+    def _acquire_external(self, sku: str, session) -> None:
+        # we already hold the stripe's RLock, so only the first level flocks
+        stripe = self.stripe(sku)
+        if self._depth[stripe] == 0:
+            fcntl.flock(self._files[stripe], fcntl.LOCK_EX)
+        self._depth[stripe] += 1
+
+    def _release_external(self, sku: str) -> None:
+        stripe = self.stripe(sku)
+        self._depth[stripe] -= 1
+        if self._depth[stripe] == 0:
+            fcntl.flock(self._files[stripe], fcntl.LOCK_UN)
@@ -0,0 +1,116 @@
+"""Memory accounting for the aggregates a unit of work holds on to.
+
+One call against a big sku can pull hundreds of thousands of OrderLines into
+the session through `Batch._allocations`, and a few of those in parallel take
+the worker down. So:
+
+* `predict`: before loading, count the rows the aggregate is made of (one cheap
+  query) and turn that into bytes, so we can fail *before* hydrating
+* `estimate`: the same for what has actually been loaded, without loading more
+* the bytes per object come from a calibration with tracemalloc (`calibrate`),
+  by default ~1.4KB per mapped object (measured on SQLAlchemy 1.3, CPython 3.11)
+
+The peak of a request is kept in the context, so the entrypoint can report it.
+A unit of work with a budget raises `MemoryBudgetExceeded` when a product would
+not fit, there is no lighter way to load one product of a request: the lighter
+strategy is the write-only allocations (see `orm.start_mappers`), for the whole
+process. With those the order lines are never loaded, and only the batches count.
+"""
+
+import contextvars
+import gc
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+from sqlalchemy import distinct, func, select
+
+from allocation.adapters import orm
+from allocation.domain import model
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+BYTES_PER_OBJECT = 1400
+
+_peak: contextvars.ContextVar = contextvars.ContextVar('memory_peak', default=None)
+
+
+def _objects(batches: int, lines: int) -> int:
+    return 1 + batches + lines
+
+
+def predict(session, sku: str, partition: str = model.DEFAULT_PARTITION) -> int:
+    """Bytes the Product would take once loaded, from two counts"""
+    batches, lines = session.execute(
+        select([
+            func.count(distinct(orm.batches.c.id)), func.count(orm.allocations.c.id)
+        ])
+        .select_from(orm.batches.outerjoin(orm.allocations))
+        .where(orm.batches.c.sku == sku)
+        .where(orm.batches.c.partition == partition)
+    ).first()
+    if orm.WRITE_ONLY_ALLOCATIONS:
+        lines = 0
+    return _objects(batches, lines) * BYTES_PER_OBJECT
+
+
+def estimate(products: Iterable[model.Product]) -> int:
+    """Bytes of what is loaded. Looks at `__dict__`, so that unloaded lazy
+    collections stay unloaded (asking for them would load them).
+    """
+    objects = 0
+    for product in products:
+        batches = product.__dict__.get('batches', [])
+        lines = 0 if orm.WRITE_ONLY_ALLOCATIONS else sum(
+            len(b.__dict__.get('_allocations', ())) for b in batches
+        )
+        objects += _objects(len(batches), lines)
+    return objects * BYTES_PER_OBJECT
+
+
+def calibrate(load: Callable[[], model.Product]) -> int:
+    """Measures what loading a (big) product really costs with tracemalloc
+    and updates BYTES_PER_OBJECT. `load` must return a fully loaded Product.
+    Run it off-peak: tracemalloc sees the allocations of every thread.
+    """
+    global BYTES_PER_OBJECT
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        product = load()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # what was loaded, like `estimate`: write-only allocations load no lines
+    lines = 0 if orm.WRITE_ONLY_ALLOCATIONS else sum(
+        len(b._allocations) for b in product.batches
+    )
+    BYTES_PER_OBJECT = max(1, size // _objects(len(product.batches), lines))
+    return BYTES_PER_OBJECT
+
+
+@contextmanager
+def track() -> Iterator[None]:
+    """Collects the peak of all the units of work inside of the block"""
+    token = _peak.set([0])
+    try:
+        yield
+    finally:
+        _peak.reset(token)
+
+
+def record(nbytes: int) -> None:
+    peak = _peak.get()
+    if peak is not None and nbytes > peak[0]:
+        peak[0] = nbytes
+
+
+def peak() -> Optional[int]:
+    value = _peak.get()
+    return value[0] if value is not None else None
@@ -1,20 +1,163 @@
-from typing import List, Dict, Callable, Type, NewType
-from allocation.adapters import email
+"""Events -> handlers. A failing handler doesn't stop the others (nor the commit,
+which has happened already): it's retried a few times with exponential backoff,
+and if it keeps failing the event ends up in the dead letters, to be looked at
+and redelivered later.
+
+Handlers are registered per event class and apply to its subclasses too. Which
+handlers an event type gets is worked out over the class hierarchy (MRO), and
+cached with what HANDLERS had for those classes. Any change to HANDLERS, to its
+lists in place or a new HANDLERS altogether, doesn't match it any more.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Set, Tuple, Type
+
+from allocation.adapters import email, tracing
 from allocation.domain import events
+from allocation.service_layer import deadlines
+
 
+logger = logging.getLogger(__name__)
 
 HandlerType = Dict[Type[events.Event], List[Callable]]
 
+MAX_ATTEMPTS = 3
+BACKOFF = 0.05  # seconds before the 2nd attempt, doubled for every next one
+MAX_BACKOFF = 1.0
+
+
+@dataclass
+class HandlerStats:
+    calls: int = 0
+    failures: int = 0  # attempts which raised
+    retries: int = 0
+    dead_lettered: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+@dataclass
+class DeadLetter:
+    event: events.Event
+    handler: Callable
+    error: str
+    attempts: int
+    at: float = field(default_factory=time.time)
+
+
+class DeadLetters:
+    """The events a handler gave up on. In memory and bounded: the oldest
+    ones go (they were logged when they came in).
+    """
+    def __init__(self, maxlen: int = 10_000):
+        self._letters: Deque[DeadLetter] = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._letters)
+
+    def __iter__(self):
+        return iter(list(self._letters))
+
+    def add(self, letter: DeadLetter) -> None:
+        with self._lock:
+            self._letters.append(letter)
+
+    def redeliver(self) -> int:
+        """Runs every handler again on its event, returns how many made it"""
+        with self._lock:
+            letters, self._letters = list(self._letters), deque(maxlen=self._letters.maxlen)
+        return sum(_run(letter.handler, letter.event) for letter in letters)
+
+
+Registered = Tuple[Tuple[Callable, ...], ...]
+
+# event type -> (what was registered for its classes, its handlers)
+_dispatch: Dict[type, Tuple[Registered, Tuple[Callable, ...]]] = {}
+_stats: Dict[str, HandlerStats] = {}
+_stats_lock = threading.Lock()
+DEAD_LETTERS = DeadLetters()
+
+
+def handlers_for(event_type: type) -> Tuple[Callable, ...]:
+    registered = tuple(tuple(HANDLERS.get(cls, ())) for cls in event_type.__mro__)
+    cached = _dispatch.get(event_type)
+    if cached is not None and cached[0] == registered:
+        return cached[1]
+
+    found = tuple(dict.fromkeys(h for handlers in registered for h in handlers))
+    if not found:
+        logger.warning('no handlers for %s', event_type.__name__)
+    _dispatch[event_type] = (registered, found)
+    return found
+
+
 def handle(event: events.Event):
-    for handler in HANDLERS.get(type(event)):
-        handler(event)
-    
+    for handler in handlers_for(type(event)):
+        if handler in NON_ESSENTIAL and deadlines.expired():
+            logger.warning('deadline exceeded, skipping %s', handler.__name__)
+            continue
+        _run(handler, event)
+
+
+def _record(handler: Callable, elapsed: float, failed: bool, retry: bool) -> HandlerStats:
+    with _stats_lock:
+        stats = _stats.setdefault(handler.__name__, HandlerStats())
+        stats.calls += 1
+        stats.failures += failed
+        stats.retries += retry
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        return stats
+
+
+def _run(handler: Callable, event: events.Event) -> bool:
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        start = time.perf_counter()
+        try:
+            with tracing.span(f'handler:{handler.__name__}',
+                              event=type(event).__name__, attempt=attempt):
+                handler(event)
+        except Exception as e:
+            stats = _record(handler, time.perf_counter() - start, True, attempt > 1)
+            backoff = min(BACKOFF * 2 ** (attempt - 1), MAX_BACKOFF)
+            remaining = deadlines.remaining()
+            if attempt < MAX_ATTEMPTS and (remaining is None or remaining > backoff):
+                logger.warning('%s failed on %s (%s), retrying', handler.__name__, event, e)
+                time.sleep(backoff)
+                continue
+            logger.exception('%s gave up on %s', handler.__name__, event)
+            with _stats_lock:
+                stats.dead_lettered += 1
+            DEAD_LETTERS.add(DeadLetter(event, handler, f'{type(e).__name__}: {e}', attempt))
+            return False
+        _record(handler, time.perf_counter() - start, False, attempt > 1)
+        return True
+    return False
+
+
+def metrics() -> dict:
+    with _stats_lock:
+        handlers = {name: HandlerStats(**vars(stats)) for name, stats in _stats.items()}
+    return {'handlers': handlers, 'dead_letters': len(DEAD_LETTERS)}
+
 
 def send_out_of_stock_notification(event: events.OutOfStock):
     email.send_email(
         'stock@made.com', f"Out of stock for {event.sku}"
     )
 
-HANDLERS = {
+HANDLERS: HandlerType = {
     events.OutOfStock: [send_out_of_stock_notification]
 }
+
+# can be skipped when the request has run out of time
+NON_ESSENTIAL: Set[Callable] = {send_out_of_stock_notification}
@@ -5,12 +5,15 @@ neither a ValueObject or entity, e.g. a tax calculator, meaning a function
 does the job.
 """
 
-from typing import List, Dict, Tuple, Optional, NewType, TYPE_CHECKING
+from typing import (
+    Callable, List, Dict, Tuple, Optional, NewType, TypeVar, TYPE_CHECKING
+)
 from datetime import date
 
+from allocation.adapters import profiling, tracing
 from allocation.domain import model
 from allocation.domain.model import OrderLine
-from allocation.service_layer import unit_of_work
+from allocation.service_layer import hot_skus, unit_of_work
 
 
 class InvalidSku(Exception):
@@ -22,26 +25,37 @@ def is_valid_sku(sku: model.Sku, batches: List[model.Batch]) -> bool:
     return sku in {b.sku for b in batches}
 
 
+@profiling.service_call
+@tracing.traced
 def add_batch(
     ref: str, sku: str, qty: int, eta: Optional[date], 
-    uow: unit_of_work.AbstractUnitOfWork
+    uow: unit_of_work.AbstractUnitOfWork,
+    partition: str = model.DEFAULT_PARTITION,
 ) -> None:
     """Add batch to the database (via the repository pattern). Types are basic
     since they come from external world (i.e. the POST request)
     """
     with uow:
-        product = uow.products.get(sku=sku)
+        product = uow.products.get(sku=sku, partition=partition)
         if product is None:
-            product = model.Product(sku, batches=[])
+            product = model.Product(
+                model.Sku(sku), batches=[], partition=model.Partition(partition)
+            )
             uow.products.add(product)
 
-        product.batches.append(model.Batch(ref, sku, qty, eta))
+        product.add_batch(model.Batch(
+            model.BatchReference(ref), model.Sku(sku), model.Quantity(qty), eta,
+            partition=model.Partition(partition),
+        ))
         uow.commit()
 
 
+@profiling.service_call
+@tracing.traced
 def allocate(
-    orderid: str, sku: str, qty: int, uow: unit_of_work.AbstractUnitOfWork
-) -> str:
+    orderid: str, sku: str, qty: int, uow: unit_of_work.AbstractUnitOfWork,
+    partition: Optional[str] = None,
+) -> Optional[str]:
     """Services, in general have a very similar series of steps:
 
     * Fetch something from the repository
@@ -51,20 +65,145 @@ def allocate(
 
     But perfectly, we don't want our service to be **coupled** to DB layer
         -> to be improved with Unit of Work Pattern
+
+    `partition` is where we'd rather allocate from (e.g. the closest warehouse).
+    If it can't, the other partitions of a partitioned sku are tried, one unit
+    of work (so one lock) at a time. `None` when it's out of stock.
+    """
+    return _allocate(
+        _order_line(orderid, sku, qty), uow, partition, model.Product.allocate
+    )
+
+
+@profiling.service_call
+@tracing.traced
+def allocate_split(
+    orderid: str, sku: str, qty: int, uow: unit_of_work.AbstractUnitOfWork,
+    partition: Optional[str] = None,
+) -> Optional[List[Tuple[model.BatchReference, model.Quantity]]]:
+    """Like `allocate`, but the line can be split across the batches of a
+    partition (in eta order), returns (batch ref, qty) of every part
     """
-    line = OrderLine(orderid, sku, qty)
+    return _allocate(
+        _order_line(orderid, sku, qty), uow, partition, model.Product.allocate_split
+    )
 
-    with uow:  # start the context manager
-        product = uow.products.get(sku=line.sku)
-        if product is None:
-            raise InvalidSku(f"Invalid sku {line.sku}")
-        
-        # 1, can have a try-finally here to send the message
-        # 2, or let service emit own messages (plausible)
-        batchref = product.allocate(line)
-        uow.commit()  # always commit unless something goes wrong
 
-    return batchref
+@profiling.service_call
+@tracing.traced
+def allocate_group(
+    sku: str, lines: List[OrderLine], uow: unit_of_work.AbstractUnitOfWork
+) -> List[Optional[str]]:
+    """Many lines of a sku in one transaction, in order. The group commit of
+    `service_layer.coalescer`, returns the batch ref of every line.
+
+    The lines of a partitioned sku go one by one instead, like `allocate`
+    with its fallback over the partitions.
+    """
+    with uow:
+        partitioned = uow.products.partitions(sku) != [model.DEFAULT_PARTITION]
+        if not partitioned:
+            product = uow.products.get(sku=sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+            batchrefs: List[Optional[str]] = [product.allocate(line) for line in lines]
+            uow.commit()
+
+    if partitioned:
+        return [_allocate(line, uow, None, model.Product.allocate) for line in lines]
+
+    hot_skus.TRACKER.record(sku, allocations=sum(ref is not None for ref in batchrefs))
+    return batchrefs
+
+
+def _order_line(orderid: str, sku: str, qty: int) -> OrderLine:
+    return OrderLine(model.OrderReference(orderid), model.Sku(sku), model.Quantity(qty))
+
+
+Allocated = TypeVar('Allocated')
+
+
+def _allocate(
+    line: OrderLine, uow: unit_of_work.AbstractUnitOfWork, partition: Optional[str],
+    allocate_in: Callable[[model.Product, OrderLine], Optional[Allocated]],
+) -> Optional[Allocated]:
+    """`allocate_in(product, line)` in the preferred partition, then the others"""
+    sku = line.sku  # the line is the session's after the commit
+    tried: List[str] = []
+    candidates = [partition if partition is not None else model.DEFAULT_PARTITION]
+
+    while candidates:
+        current = candidates.pop(0)
+        tried.append(current)
+        with uow:  # start the context manager
+            product = uow.products.get(sku=sku, partition=current)
+            recorded = len(product.events) if product is not None else 0
+            allocated = allocate_in(product, line) if product is not None else None
+            if allocated is None and len(tried) == 1:  # only then, it's a query
+                candidates = [p for p in uow.products.partitions(sku) if p not in tried]
+            if allocated is None and candidates:
+                # nothing to commit, not out of stock yet either: forget the
+                # OutOfStock, the product may outlive the uow (InMemoryUnitOfWork)
+                if product is not None:
+                    del product.events[recorded:]
+                continue
+
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+            # 1, can have a try-finally here to send the message
+            # 2, or let service emit own messages (plausible)
+            uow.commit()  # always commit unless something goes wrong
+            break
+
+    if allocated is not None:
+        hot_skus.TRACKER.record(sku, allocations=1)
+    return allocated
+
+
+@profiling.service_call
+@tracing.traced
+def get_product(
+    sku: str, uow: unit_of_work.AbstractUnitOfWork, min_version: int = 0
+) -> dict:
+    """A read-only use-case, served by the replica if the uow has one.
+    Pass the last `version_number` you wrote to read your own writes.
+    """
+    with uow:
+        product = uow.products.get_readonly(sku, min_version=min_version)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {sku}")
+
+        return {
+            "sku": product.sku,
+            "version_number": product.version_number,
+            "batches": [
+                {
+                    "ref": b.reference,
+                    "eta": b.eta.isoformat() if b.eta else None,
+                    "available": b.available_quantity,
+                }
+                for b in sorted(product.batches)
+            ],
+        }
+
+
+@profiling.service_call
+@tracing.traced
+def get_stock(sku: str, uow: unit_of_work.AbstractUnitOfWork) -> dict:
+    """Availability from the read model, doesn't load the Product"""
+    with uow:
+        level = uow.products.stock_level(sku)
+        if level is None:
+            raise InvalidSku(f"Invalid sku {sku}")
+
+        available, earliest_eta = level
+        return {
+            "sku": sku,
+            "available": available,
+            "earliest_eta": earliest_eta.isoformat() if earliest_eta else None,
+        }
 
 
 def reallocate(line: OrderLine, uow: unit_of_work.AbstractUnitOfWork) -> str:
@@ -1,11 +1,20 @@
 import abc
-from sqlalchemy import create_engine
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
+from sqlalchemy.util import LRUCache
 
 from allocation import config
-from allocation.adapters import repository
-from allocation.service_layer import messagebus
+from allocation.adapters import (
+    engines, event_store, orm, profiling, repository, stock_levels, tracing
+)
+from allocation.domain import model
+from allocation.service_layer import deadlines, hot_skus, locks, memory, messagebus
 
 
 class AbstractUnitOfWork(abc.ABC):
@@ -13,12 +22,14 @@ class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
 
     def __enter__(self) -> repository.AbstractRepository:
+        deadlines.check()
         return self
 
     def __exit__(self, *args):
         self.rollback()
     
     def commit(self):
+        deadlines.check()  # nobody is waiting for the result anymore
         self._commit()
         self.publish_events()
     
@@ -37,29 +48,270 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-# will be overritten in integration tests by SQLite
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-    config.get_postgres_uri(), 
-    isolation_level="REPEATABLE_READ"  # read about!!
-))
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    """No transactions at all: what is changed stays changed"""
+    def __init__(self, products=()):
+        self.products = repository.InMemoryRepository(products)
+        self.committed = 0
+
+    def _commit(self):
+        self.committed += 1
+
+    def rollback(self):
+        pass
+
+
+# off by default, set SLOW_QUERY_MS to see what the DB is actually doing
+PROFILER: Optional[profiling.QueryProfiler] = None
+if config.get_slow_query_threshold() is not None:
+    PROFILER = profiling.QueryProfiler(config.get_slow_query_threshold())
+
+# The engines are only created with the first session: importing the module,
+# i.e. starting the container, neither imports the DB driver nor connects.
+# DEFAULT_ENGINE and DEFAULT_READ_ENGINE still work, see `__getattr__`.
+_engines: Optional[engines.Engines] = None
+_engines_lock = threading.Lock()
+
+
+def default_engines() -> engines.Engines:
+    """(primary, read engine or `None`), from the config, created once"""
+    global _engines
+    with _engines_lock:
+        if _engines is None:
+            primary, read = engines.create_engines()
+            if PROFILER is not None:
+                orm.register_profiler(primary, PROFILER)
+            _engines = primary, read
+    return _engines
+
+
+def __getattr__(name):
+    if name == 'DEFAULT_ENGINE':
+        return default_engines()[0]
+    if name == 'DEFAULT_READ_ENGINE':
+        return default_engines()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _LazySessionFactory:
+    """A `sessionmaker` bound to a default engine, once that one is needed.
+    Without a read engine the read one makes no sessions, `None`: the unit of
+    work then reads from its own session, on the primary.
+    """
+    def __init__(self, read: bool = False) -> None:
+        self.read = read
+        self._resolved = False
+        self._factory: Optional[sessionmaker] = None
+
+    def __call__(self, **kwargs) -> Optional[Session]:
+        if not self._resolved:
+            engine = default_engines()[self.read]
+            self._factory = sessionmaker(bind=engine) if engine is not None else None
+            self._resolved = True
+        return self._factory(**kwargs) if self._factory is not None else None
+
+
+# the tests bind their own session factories, to in-memory SQLite
+DEFAULT_SESSION_FACTORY = _LazySessionFactory()
+
+# read-only queries go to a replica (or the sqlite readers) when there is one
+DEFAULT_READ_SESSION_FACTORY = _LazySessionFactory(read=True)
+
+# last version committed by this process, for read-your-writes on the replica.
+# Of the most recently written products only, the older ones have replicated.
+WRITTEN_VERSIONS: Dict[str, int] = LRUCache(10_000)
+
+
+# serialization_failure, deadlock_detected
+_CONFLICT_PGCODES = {'40001', '40P01'}
+
+
+def is_conflict(error: Optional[BaseException]) -> bool:
+    """Rolled back because of another transaction on the same rows: a stale
+    version_number, or the DB giving up on one of the two (not bad input, nor
+    a deadline, nor anything else which would fail on its own as well)
+    """
+    if isinstance(error, StaleDataError):
+        return True
+    orig = getattr(error, 'orig', None) if isinstance(error, DBAPIError) else None
+    return (getattr(orig, 'pgcode', None) in _CONFLICT_PGCODES
+            or getattr(orig, 'sqlite_errorname', None) == 'SQLITE_BUSY')
+
+
+def _lock_manager_from_config() -> Optional[locks.SkuLockManager]:
+    mode = config.get_sku_lock_mode()
+    if mode == "thread":
+        return locks.SkuLockManager()
+    if mode == "advisory":
+        return locks.AdvisoryLockManager()
+    if mode == "file":
+        return locks.FileLockManager(config.get_sku_lock_dir())
+    return None
+
+DEFAULT_LOCK_MANAGER = _lock_manager_from_config()
+
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self, session_factory=DEFAULT_SESSION_FACTORY, snapshot=None,
+        lock_manager=DEFAULT_LOCK_MANAGER,
+        read_session_factory=DEFAULT_READ_SESSION_FACTORY,
+        memory_budget: Optional[int] = config.get_memory_budget(),
+        baked_queries: bool = True,
+    ):
         self.session_factory = session_factory
+        self.read_session_factory = read_session_factory
+        self.snapshot = snapshot
+        self.lock_manager = lock_manager
+        self.lock_wait = 0.0
+        self.memory_budget = memory_budget
+        self.memory_peak = 0
+        self.baked_queries = baked_queries
 
     def __enter__(self):
         """Starts a DB session and instantiate a real repositorys"""
+        super().__enter__()  # checks the deadline
+        self._entered = time.perf_counter()
+        # what can fail comes first: `__exit__` doesn't run if we raise here
         self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
-
-        return super().__enter__()
+        self.read_session = None
+        try:
+            deadlines.apply_to_session(self.session)
+            if self.read_session_factory is not None:
+                self.read_session = self.read_session_factory()
+            if self.read_session is not None:
+                deadlines.apply_to_session(self.read_session)
+        except BaseException:
+            self.session.close()
+            if self.read_session is not None:
+                self.read_session.close()
+            raise
+        self._span = tracing.span('uow', uow=type(self).__name__)
+        self._span.__enter__()
+        self._collecting = profiling.collect()
+        self.query_report = self._collecting.__enter__()
+        self._locked: List[str] = []
+        self._skus: List[str] = []
+        self._predicted = 0
+        self.products = repository.SqlAlchemyRepository(
+            self.session, snapshot=self.snapshot, before_get=self._before_get,
+            read_session=self.read_session, min_versions=WRITTEN_VERSIONS,
+            baked=self.baked_queries,
+        )
+        return self
     
+    def __exit__(self, *args):
+        try:
+            self._account_memory()
+            super().__exit__(*args)
+            self.session.close()
+            if self.read_session is not None:
+                self.read_session.close()
+        finally:
+            # after the rollback, so advisory locks are gone with the transaction
+            while self._locked:
+                self.lock_manager.release(self._locked.pop())
+            self._collecting.__exit__(None, None, None)
+            self._span.__exit__(None, None, None)
+            self._record_hot_skus(conflicted=is_conflict(args[1]))
+
+    def _record_hot_skus(self, conflicted: bool):
+        elapsed = time.perf_counter() - self._entered
+        for sku in self._skus:
+            hot_skus.TRACKER.record(sku, uow_time=elapsed, rollbacks=int(conflicted))
+
+    def _before_get(self, sku, partition):
+        if sku not in self._skus:
+            self._skus.append(sku)
+        if self.lock_manager is not None:
+            self._lock_sku(sku, partition)
+        if self.memory_budget is not None:
+            self._check_memory_budget(sku, partition, self.memory_budget)
+
+    def _lock_sku(self, sku, partition=model.DEFAULT_PARTITION):
+        """Held from `products.get` until the end of the `with uow:` block.
+        Per partition, different partitions of a sku don't wait for each other.
+        """
+        key = model.aggregate_key(sku, partition)
+        if key not in self._locked:
+            waited = self.lock_manager.acquire(key, self.session)
+            self.lock_wait += waited
+            self._locked.append(key)
+            hot_skus.TRACKER.record(sku, lock_wait=waited)
+
+    def _check_memory_budget(self, sku, partition, budget: int):
+        """Fail fast, i.e. before hydrating a product which wouldn't fit"""
+        if any(p.sku == sku and p.partition == partition for p in self.products.seen):
+            return
+        predicted = memory.predict(self.session, sku, partition)
+        held = memory.estimate(self.products.seen)
+        if held + predicted > budget:
+            raise memory.MemoryBudgetExceeded(
+                f"Loading {sku} needs ~{predicted // 1024}KB, "
+                f"budget is {budget // 1024}KB"
+            )
+        self._predicted = max(self._predicted, held + predicted)
+        self._account_memory()
+
+    def _account_memory(self):
+        self.memory_peak = max(
+            self.memory_peak, self._predicted, memory.estimate(self.products.seen)
+        )
+        memory.record(self.memory_peak)
+
+    def _commit(self):
+        self._account_memory()  # before the commit expires everything
+        # before the commit, which expires them (a SELECT each to read them again)
+        written = {product.key: product.version_number for product in self.products.seen}
+        with tracing.span('uow.commit', products=len(self.products.seen)):
+            # the version_number UPDATE first (`execute` doesn't autoflush): two
+            # writers of a sku then conflict on the product, not on inserting
+            # its first stock_levels row
+            self.session.flush()
+            stock_levels.save_products(self.session, self.products.seen)
+            self.session.commit()
+        for key, version in written.items():
+            WRITTEN_VERSIONS[key] = version  # not .update(), which skips the LRU
+
+    def rollback(self):
+        with tracing.span('uow.rollback'):
+            return self.session.rollback()
+
+
+class EventSourcedUnitOfWork(AbstractUnitOfWork):
+    """Same transaction handling, but products are persisted as event logs
+    (see `adapters.event_store`), no ORM mappers needed.
+    """
+    products: event_store.EventSourcedRepository
+
+    def __init__(
+        self, session_factory=DEFAULT_SESSION_FACTORY,
+        snapshot_interval: int = config.get_event_snapshot_interval(),
+    ):
+        self.session_factory = session_factory
+        self.snapshot_interval = snapshot_interval
+
+    def __enter__(self):
+        super().__enter__()  # checks the deadline
+        self.session = self.session_factory()
+        try:
+            deadlines.apply_to_session(self.session)
+        except BaseException:
+            self.session.close()
+            raise
+        self.products = event_store.EventSourcedRepository(
+            self.session, snapshot_interval=self.snapshot_interval
+        )
+        return self
+
     def __exit__(self, *args):
         super().__exit__(*args)
         self.session.close()
 
     def _commit(self):
+        self.products.save()
+        stock_levels.save_products(self.session, self.products.seen)
         self.session.commit()
 
     def rollback(self):
-        return self.session.rollback()
\ No newline at end of file
+        return self.session.rollback()
@@ -0,0 +1,103 @@
+"""Pre-warming: doing what the first requests would otherwise wait for, in the
+background, while the container already accepts traffic.
+
+After a cold start (Cloud Run scales from zero) the first request pays for:
+
+* creating the engines (the DB driver import, sqlite's `create_all`)
+* connecting: TCP + TLS + auth on postgres, the pragmas on sqlite
+* configuring the mappers and compiling the (baked) queries
+* the first reads of the hot products: snapshot pages, DB cache
+
+`prewarm` does all of that once, with the skus we know will be asked for
+(PREWARM_SKUS), `start_in_background` off the main thread. A request which
+comes in meanwhile simply does its share of the work itself, nothing waits
+for the warm-up. See `benchmarks/cold_start.py` for what it buys.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+from sqlalchemy.orm import configure_mappers
+
+from allocation.adapters import engines as engines_, tracing
+from allocation.service_layer import services, unit_of_work
+
+
+logger = logging.getLogger(__name__)
+
+
+def open_connections(engine, connections: int) -> int:
+    """Fills the pool: opens up to `connections` at the same time and gives them
+    back, so they stay open for the requests
+    """
+    count = min(connections, engine.pool.size())
+    if count <= 0:
+        return 0
+    with ThreadPoolExecutor(count) as executor:
+        opened = list(executor.map(lambda _: engine.connect(), range(count)))
+    for conn in opened:
+        conn.close()  # back to the pool, still connected
+    return len(opened)
+
+
+def prewarm(
+    new_uow: Callable[[], unit_of_work.AbstractUnitOfWork],
+    skus: Iterable[str] = (), connections: int = 2,
+    engines: Optional[engines_.Engines] = None,
+) -> Dict[str, float]:
+    """Returns how long (seconds) every step took. `engines` are the ones of
+    the unit of work, by default created from the config
+    """
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+
+    primary, read = engines or unit_of_work.default_engines()
+    timings['engines'] = time.perf_counter() - start
+
+    step = time.perf_counter()
+    for engine in (primary, read):
+        if engine is not None:
+            open_connections(engine, connections)
+    timings['connections'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    configure_mappers()
+    timings['mappers'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    for sku in skus:
+        for read_model in (services.get_product, services.get_stock):
+            try:
+                read_model(sku, new_uow())
+            except services.InvalidSku:
+                logger.info('pre-warm: no product %s', sku)
+                break
+    timings['skus'] = time.perf_counter() - step
+
+    timings['total'] = time.perf_counter() - start
+    return timings
+
+
+def start_in_background(
+    new_uow: Callable[[], unit_of_work.AbstractUnitOfWork],
+    skus: Iterable[str] = (), connections: int = 2,
+) -> threading.Thread:
+    skus = list(skus)
+
+    def run():
+        try:
+            timings = prewarm(new_uow, skus, connections)
+        except Exception:  # a failed warm-up only means a slower first request
+            logger.exception('pre-warm failed')
+            return
+        logger.info('pre-warmed in %.0fms: %s', timings['total'] * 1000, ', '.join(
+            f'{step} {seconds * 1000:.0f}ms' for step, seconds in timings.items()
+            if step != 'total'
+        ))
+
+    thread = threading.Thread(target=tracing.carry(run), name='prewarm', daemon=True)
+    thread.start()
+    return thread
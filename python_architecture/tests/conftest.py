@@ -11,7 +11,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from sqlalchemy.exc import OperationalError
 
+from allocation.adapters import engines
 from allocation.adapters.orm import metadata, start_mappers
+from allocation.service_layer import unit_of_work
 from allocation import config
 
 
@@ -34,6 +36,26 @@ def session(session_factory):
     return session_factory()  # this is not callable, mistake in authors' github
 
 
+@pytest.fixture
+def file_session_factory(tmp_path):
+    """Threads need their own connections, an in-memory DB would be shared"""
+    engine = create_engine(f'sqlite:///{tmp_path / "allocation.db"}')
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
+@pytest.fixture
+def sqlite_engines(tmp_path):
+    """(writer, readers) of the sqlite backend, on a file"""
+    writer, readers = engines.sqlite_engines(str(tmp_path / 'allocation.db'), readers=3)
+    start_mappers()
+    yield writer, readers
+    clear_mappers()
+    unit_of_work.WRITTEN_VERSIONS.clear()
+
+
 def wait_for_postgres_to_come_up(engine):
     deadline = time.time() + 10
 
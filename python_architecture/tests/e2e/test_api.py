@@ -61,3 +61,47 @@ def test_unhappy_path_400_and_error_message():
     assert r.status_code == 400
     assert r.json()["message"] == f"Invalid sku {unknown_sku}"
 
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_get_product_returns_available_quantities():
+    sku, batch = random_sku(), random_batchref()
+    post_to_add_batch(batch, sku, 100, None)
+    url = config.get_api_url()
+
+    r = requests.get(f"{url}/products/{sku}")
+
+    assert r.status_code == 200
+    assert r.json()["batches"] == [{"ref": batch, "eta": None, "available": 100}]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_get_product_of_a_partitioned_sku_has_the_batches_of_all_partitions():
+    sku = random_sku()
+    url = config.get_api_url()
+    for warehouse in ("berlin", "paris"):
+        r = requests.post(f"{url}/add_batch", json={
+            "ref": f"{warehouse}-{sku}", "sku": sku, "qty": 10, "eta": None,
+            "partition": warehouse,
+        })
+        assert r.status_code == 201
+
+    r = requests.get(f"{url}/products/{sku}")
+
+    assert r.status_code == 200
+    assert sorted(b["ref"] for b in r.json()["batches"]) == [f"berlin-{sku}", f"paris-{sku}"]
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_get_stock_returns_available_quantity():
+    sku = random_sku()
+    post_to_add_batch(random_batchref(), sku, 100, "2011-01-02")
+    url = config.get_api_url()
+
+    r = requests.get(f"{url}/stock/{sku}")
+
+    assert r.status_code == 200
+    assert r.json() == {"sku": sku, "available": 100, "earliest_eta": "2011-01-02"}
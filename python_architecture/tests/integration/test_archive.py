@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from allocation.adapters import archive
+from allocation.service_layer import services, unit_of_work
+
+
+def test_exhausted_batches_are_moved_out_of_the_aggregate(in_memory_db, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('old', 'ARCHIVED-SOFA', 10, None, uow)
+    services.add_batch('new', 'ARCHIVED-SOFA', 100, None, uow)
+    services.allocate('o1', 'ARCHIVED-SOFA', 10, uow)
+    services.allocate('o2', 'ARCHIVED-SOFA', 5, uow)
+
+    assert archive.archive_exhausted_batches(in_memory_db, chunk_size=1) == 1
+    assert archive.archive_exhausted_batches(in_memory_db) == 0
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get('ARCHIVED-SOFA')
+        assert [b.reference for b in product.batches] == ['new']
+        assert product.batches[0].available_quantity == 95
+        assert product.version_number == 5
+        assert uow.products.archived_batches('ARCHIVED-SOFA') == [
+            {'ref': 'old', 'eta': None, 'qty': 10, 'lines': {'o1': 10}},
+        ]
+
+
+def test_allocations_keep_working_after_archival(in_memory_db, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'BUSY-DESK', 5, None, uow)
+    services.add_batch('b2', 'BUSY-DESK', 5, None, uow)
+    services.allocate('o1', 'BUSY-DESK', 5, uow)
+    archive.archive_exhausted_batches(in_memory_db)
+
+    assert services.allocate('o2', 'BUSY-DESK', 5, uow) == 'b2'
+
+
+class SerializationFailure(Exception):
+    pgcode = '40001'
+
+
+def conflict():
+    return OperationalError('UPDATE products ...', {}, SerializationFailure())
+
+
+def test_a_chunk_which_lost_to_an_allocation_is_archived_again(
+    in_memory_db, session_factory, monkeypatch
+):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('old', 'CONTESTED-SOFA', 10, None, uow)
+    services.allocate('o1', 'CONTESTED-SOFA', 10, uow)
+    archive_chunk, calls = archive._archive_chunk, []
+    def conflicting_once(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise conflict()
+        archive_chunk(*args)
+    monkeypatch.setattr(archive, '_archive_chunk', conflicting_once)
+
+    assert archive.archive_exhausted_batches(in_memory_db) == 1
+    assert len(calls) == 2
+
+
+def test_a_failed_pass_does_not_stop_the_job(in_memory_db, monkeypatch, caplog):
+    def always_conflicting(*args):
+        raise conflict()
+    class Stop(Exception):
+        pass
+    def sleep(seconds):
+        raise Stop
+    monkeypatch.setattr(archive, 'archive_exhausted_batches', always_conflicting)
+    monkeypatch.setattr(archive.time, 'sleep', sleep)
+
+    with pytest.raises(Stop):  # i.e. it got to wait for the next pass
+        archive.run_forever(in_memory_db)
+    assert 'archiving failed' in caplog.text
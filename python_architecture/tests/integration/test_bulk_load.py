@@ -0,0 +1,67 @@
+from datetime import date
+
+import pytest
+from allocation.adapters import bulk_load
+
+
+def write_csv(path, rows):
+    path.write_text('ref,sku,qty,eta\n' + ''.join(f'{row}\n' for row in rows))
+    return path
+
+
+def test_bulk_load_creates_products_and_batches(in_memory_db, tmp_path):
+    in_memory_db.execute("INSERT INTO products (sku, version_number) VALUES ('OLD-SKU', 4)")
+    path = write_csv(tmp_path / 'shipment.csv', [
+        'b1,OLD-SKU,10,', 'b2,NEW-SKU,20,2011-01-02', 'b3,NEW-SKU,30,',
+    ])
+
+    stats = bulk_load.load_batches(
+        in_memory_db, str(path), bulk_load.read_csv(path), chunk_size=2
+    )
+
+    assert (stats.rows, stats.products_created) == (3, 1)
+    assert list(in_memory_db.execute(
+        'SELECT sku, version_number FROM products ORDER BY sku'
+    )) == [('NEW-SKU', 2), ('OLD-SKU', 5)]
+    assert list(in_memory_db.execute(
+        'SELECT reference, _purchased_quantity FROM batches ORDER BY reference'
+    )) == [('b1', 10), ('b2', 20), ('b3', 30)]
+    assert list(bulk_load.read_csv(path))[1]['eta'] == date(2011, 1, 2)
+
+
+def test_bulk_load_resumes_after_the_last_committed_chunk(in_memory_db, tmp_path):
+    good = [f'b{i},RESUME-SKU,{i},' for i in range(5)]
+    path = write_csv(tmp_path / 'shipment.csv', good + ['broken,RESUME-SKU,oops,'])
+
+    with pytest.raises(ValueError):
+        bulk_load.load_batches(in_memory_db, 'shipment', bulk_load.read_csv(path), 2)
+    [[loaded]] = in_memory_db.execute('SELECT count(*) FROM batches')
+    assert loaded == 4
+
+    path = write_csv(tmp_path / 'shipment.csv', good + ['fixed,RESUME-SKU,5,'])
+    stats = bulk_load.load_batches(
+        in_memory_db, 'shipment', bulk_load.read_csv(path), 2
+    )
+
+    assert (stats.skipped, stats.rows) == (4, 2)
+    refs = [ref for (ref,) in in_memory_db.execute('SELECT reference FROM batches')]
+    assert sorted(refs) == ['b0', 'b1', 'b2', 'b3', 'b4', 'fixed']
+
+
+def test_bulk_load_keeps_partitions_apart(in_memory_db, tmp_path):
+    in_memory_db.execute('PRAGMA foreign_keys=ON')  # a batch needs its product row
+    in_memory_db.execute(
+        "INSERT INTO products (sku, partition, version_number) VALUES ('LAMP', 'paris', 3)"
+    )
+    path = tmp_path / 'shipment.csv'
+    path.write_text('ref,sku,qty,eta,partition\nb1,LAMP,10,,berlin\nb2,LAMP,10,,\n')
+
+    stats = bulk_load.load_batches(in_memory_db, 'shipment', bulk_load.read_csv(path))
+
+    assert stats.products_created == 2
+    assert list(in_memory_db.execute(
+        'SELECT partition, version_number FROM products ORDER BY partition'
+    )) == [('', 1), ('berlin', 1), ('paris', 3)]
+    assert list(in_memory_db.execute(
+        'SELECT reference, partition FROM batches ORDER BY reference'
+    )) == [('b1', 'berlin'), ('b2', '')]
@@ -0,0 +1,125 @@
+import os
+import smtplib
+import socket
+import socketserver
+import threading
+
+import pytest
+
+from allocation.adapters import email, tracing
+
+
+class SmtpSink(socketserver.StreamRequestHandler):
+    """Just enough of a mail server to accept everything, like a debugging server"""
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 sink')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 sink')
+            elif command == 'DATA':
+                self.reply('354 go on')
+                message = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append(message.decode())
+                self.reply('250 queued')
+            elif line.upper().startswith('RCPT TO:<NOBODY'):
+                self.reply('550 no such user')
+            else:
+                self.reply('250 ok')
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('localhost', 0), SmtpSink)
+    server.daemon_threads = True
+    server.messages, server.connections = [], 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_emails_go_out_in_batches_over_few_connections(smtp_server):
+    transport = email.SmtpTransport(
+        'localhost', smtp_server.server_address[1], pool_size=2, batch_size=20
+    )
+    for i in range(50):
+        transport.send('stock@made.com', f'Out of stock for SKU-{i}')
+    transport.flush()
+
+    assert len(smtp_server.messages) == 50
+    assert 'Out of stock for SKU-49' in ''.join(smtp_server.messages)
+    assert transport.pool.opened <= 2
+    stats = transport.stats()
+    assert stats.sent == 50 and stats.failed == 0
+    assert stats.batches < 50
+    assert stats.sends_per_sec > 0 and stats.max_latency >= stats.mean_latency > 0
+    transport.close()
+    assert smtp_server.connections == transport.pool.opened
+
+
+def test_refused_emails_are_counted_and_the_batch_goes_on(smtp_server):
+    transport = email.SmtpTransport('localhost', smtp_server.server_address[1])
+    transport.send('nobody@made.com', 'lost')
+    transport.send('stock@made.com', 'arrives')
+    transport.close()
+
+    assert len(smtp_server.messages) == 1
+    assert transport.stats().sent == 1
+    assert transport.stats().failed == 1
+
+
+def test_a_dropped_connection_is_replaced(smtp_server):
+    transport = email.SmtpTransport('localhost', smtp_server.server_address[1], pool_size=1)
+    transport.send('stock@made.com', 'first')
+    transport.flush()
+    idle = transport.pool._idle.queue[0]
+    idle.sock.shutdown(socket.SHUT_RDWR)  # as if the server had timed us out
+
+    transport.send('stock@made.com', 'second')
+    transport.close()
+
+    assert len(smtp_server.messages) == 2
+    assert transport.pool.opened == 2
+
+
+def test_sends_join_the_trace_they_were_queued_in(smtp_server, monkeypatch):
+    traces = []
+    monkeypatch.setattr(tracing, 'EXPORTER', tracing.FileExporter(os.devnull))
+    monkeypatch.setattr(tracing.EXPORTER, 'export', traces.append)
+    transport = email.SmtpTransport('localhost', smtp_server.server_address[1])
+
+    with tracing.start_trace('POST /allocate', sampled=True) as root:
+        transport.send('stock@made.com', 'Out of stock for LAMP')
+        transport.flush()
+    transport.close()
+
+    [trace] = traces
+    [send] = [s for s in trace.spans if s.name == 'email.send']
+    assert send.parent_id == root.span_id
+
+
+def test_send_email_only_prints_without_a_transport(capsys):
+    email.send_email('stock@made.com', 'Out of stock for LAMP')
+    assert 'Out of stock for LAMP' in capsys.readouterr().out
+
+
+def test_a_connection_which_failed_otherwise_is_closed_too(smtp_server):
+    pool = email.ConnectionPool('localhost', smtp_server.server_address[1], size=1)
+    with pytest.raises(smtplib.SMTPResponseException):
+        with pool.connection() as smtp:
+            raise smtplib.SMTPResponseException(421, 'closing')
+
+    assert smtp.sock is None
+    assert pool._idle.empty()
+    with pool.connection():  # and the slot is free again
+        pass
+    pool.close()
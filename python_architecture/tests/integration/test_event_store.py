@@ -0,0 +1,66 @@
+from datetime import date
+
+from allocation.adapters import orm
+from allocation.service_layer import services, unit_of_work
+
+
+def count_rows(session_factory, table):
+    [[count]] = session_factory().execute(f'SELECT count(*) FROM {table}')
+    return count
+
+
+def test_products_are_rebuilt_from_their_events(session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(session_factory)
+    services.add_batch('b1', 'EVENTFUL-RUG', 10, None, uow)
+    services.add_batch('b2', 'EVENTFUL-RUG', 100, date(2011, 1, 2), uow)
+    services.allocate('o1', 'EVENTFUL-RUG', 8, uow)
+    services.allocate('o2', 'EVENTFUL-RUG', 8, uow)
+
+    with unit_of_work.EventSourcedUnitOfWork(session_factory) as uow:
+        product = uow.products.get('EVENTFUL-RUG')
+        assert product.version_number == 4
+        assert [(b.reference, b.eta, b.available_quantity) for b in product.batches] == [
+            ('b1', None, 2), ('b2', date(2011, 1, 2), 92),
+        ]
+    assert [kind for (kind,) in session_factory().execute(
+        'SELECT kind FROM product_events ORDER BY seq'
+    )] == ['batch_added', 'batch_added', 'allocated', 'allocated']
+
+
+def test_snapshots_bound_the_events_to_replay(session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(session_factory, snapshot_interval=3)
+    services.add_batch('b1', 'BUSY-CHAIR', 100, None, uow)
+    for i in range(7):
+        services.allocate(f'o{i}', 'BUSY-CHAIR', 1, uow)
+
+    [[snapshot_seq]] = session_factory().execute(
+        "SELECT seq FROM product_snapshots WHERE sku = 'BUSY-CHAIR'"
+    )
+    assert snapshot_seq == 6
+    assert count_rows(session_factory, 'product_events') == 8
+
+    with unit_of_work.EventSourcedUnitOfWork(session_factory) as uow:
+        product = uow.products.get('BUSY-CHAIR')
+        assert product.batches[0].available_quantity == 93
+        assert product.version_number == 8
+
+
+def test_uncommitted_changes_are_not_appended(session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(session_factory)
+    services.add_batch('b1', 'QUIET-LAMP', 100, None, uow)
+
+    with uow:
+        uow.products.get('QUIET-LAMP').batches[0]._purchased_quantity = 5
+
+    assert count_rows(session_factory, 'product_events') == 1
+
+
+def test_two_lines_of_one_order_in_one_batch_are_both_kept(session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(session_factory, snapshot_interval=3)
+    services.add_batch('b1', 'TWICE-TABLE', 100, None, uow)
+    services.allocate('o1', 'TWICE-TABLE', 2, uow)
+    services.allocate('o1', 'TWICE-TABLE', 3, uow)  # from the snapshot on
+
+    with unit_of_work.EventSourcedUnitOfWork(session_factory) as uow:
+        product = uow.products.get('TWICE-TABLE')
+        assert product.batches[0].available_quantity == 95
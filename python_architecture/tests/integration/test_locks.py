@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy.orm import sessionmaker, clear_mappers
+from sqlalchemy.orm.exc import StaleDataError
+
+from allocation.adapters.orm import start_mappers
+from allocation.domain import model
+from allocation.service_layer import hot_skus, locks, services, unit_of_work
+
+
+def slow_allocate(session_factory, lock_manager, orderid, sku, uows):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, lock_manager=lock_manager)
+    with uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(model.OrderLine(orderid, sku, 10))
+        time.sleep(0.2)
+        uow.commit()
+    uows.append(uow)
+
+
+def test_uows_for_the_same_sku_wait_for_each_other(file_session_factory):
+    manager = locks.SkuLockManager()
+    services.add_batch('b1', 'BUSY-TABLE', 100, None, 
+        unit_of_work.SqlAlchemyUnitOfWork(file_session_factory, lock_manager=manager))
+    uows = []
+
+    threads = [
+        threading.Thread(target=slow_allocate, args=(
+            file_session_factory, manager, orderid, 'BUSY-TABLE', uows
+        ))
+        for orderid in ('o1', 'o2')
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(uows) == 2
+    assert max(uow.lock_wait for uow in uows) >= 0.1
+    stats = manager.stats()['BUSY-TABLE']
+    assert stats.acquisitions == 3
+    assert stats.contended == 1
+
+    with unit_of_work.SqlAlchemyUnitOfWork(file_session_factory) as uow:
+        product = uow.products.get(sku='BUSY-TABLE')
+        assert product.batches[0].available_quantity == 80
+        assert product.version_number == 3
+
+
+def test_file_locks_exclude_other_lock_managers(tmp_path):
+    first = locks.FileLockManager(str(tmp_path))
+    second = locks.FileLockManager(str(tmp_path))
+    waits = []
+
+    def acquire_and_release():
+        waits.append(second.acquire('SHARED-SKU'))
+        second.release('SHARED-SKU')
+
+    first.acquire('SHARED-SKU')
+    thread = threading.Thread(target=acquire_and_release)
+    thread.start()
+    time.sleep(0.2)
+    first.release('SHARED-SKU')
+    thread.join()
+
+    assert waits[0] >= 0.1
+
+
+def test_rollbacks_time_and_lock_waits_are_tracked_per_sku(file_session_factory, monkeypatch):
+    tracker = hot_skus.HotSkus()
+    monkeypatch.setattr(hot_skus, 'TRACKER', tracker)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        file_session_factory, lock_manager=locks.SkuLockManager()
+    )
+    services.add_batch('b1', 'LAMP', 100, None, uow)
+    with pytest.raises(StaleDataError):
+        with uow:
+            uow.products.get(sku='LAMP')
+            raise StaleDataError('somebody else updated the version')
+    with pytest.raises(services.InvalidSku):  # not a conflict, not a rollback
+        services.allocate('o1', 'SOFA', 1, uow)
+    services.allocate('o2', 'LAMP', 1000, uow)  # out of stock, not an allocation
+
+    assert tracker.top('rollbacks')[0].sku == 'LAMP'
+    assert tracker.top('allocations') == []
+    assert tracker.top('rollbacks')[0].value == 1
+    assert tracker.top('uow_time')[0].value > 0
+    assert tracker.top('lock_wait')[0].sku == 'LAMP'
+
+
+def test_advisory_lock_waiters_read_what_the_holder_committed(postgres_db):
+    """Needs postgres: under REPEATABLE READ a waiter must not have taken its
+    snapshot before the lock, or its commit fails on the version it didn't see
+    """
+    start_mappers()
+    try:
+        session_factory = sessionmaker(
+            bind=postgres_db.execution_options(isolation_level='REPEATABLE READ')
+        )
+        sku = f'ADVISORY-TABLE-{time.time_ns()}'
+        services.add_batch('b-' + sku, sku, 100, None, unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, lock_manager=None,
+        ))
+        uows = []
+        threads = [  # a manager each, like two processes
+            threading.Thread(target=slow_allocate, args=(
+                session_factory, locks.AdvisoryLockManager(), orderid, sku, uows
+            ))
+            for orderid in ('o1', 'o2')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(uows) == 2  # neither of them failed
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory, lock_manager=None) as uow:
+            assert uow.products.get(sku=sku).batches[0].available_quantity == 80
+    finally:
+        clear_mappers()
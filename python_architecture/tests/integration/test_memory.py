@@ -0,0 +1,61 @@
+import pytest
+
+from allocation.domain import model
+from allocation.service_layer import memory, services, unit_of_work
+
+
+def add_busy_product(session_factory, sku, lines):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', sku, 1000, None, uow)
+    with uow:
+        product = uow.products.get(sku=sku)
+        for i in range(lines):
+            product.allocate(model.OrderLine(f'o{i}', sku, 1))
+        uow.commit()
+
+
+def test_predict_counts_batches_and_lines_without_loading(session_factory):
+    add_busy_product(session_factory, 'LAMP', 20)
+    session = session_factory()
+    assert memory.predict(session, 'LAMP') == 22 * memory.BYTES_PER_OBJECT
+    assert memory.predict(session, 'NOTHING') == 1 * memory.BYTES_PER_OBJECT
+    assert list(session) == []
+
+
+def test_uow_records_the_peak_of_what_it_held(session_factory):
+    add_busy_product(session_factory, 'LAMP', 20)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, memory_budget=10**6)
+    with memory.track():
+        with uow:
+            product = uow.products.get(sku='LAMP')
+            product.allocate(model.OrderLine('o-last', 'LAMP', 1))
+            uow.commit()
+        assert memory.peak() == uow.memory_peak
+
+    assert uow.memory_peak == 23 * memory.BYTES_PER_OBJECT
+
+
+def test_uow_fails_fast_when_a_product_would_not_fit(session_factory):
+    add_busy_product(session_factory, 'LAMP', 20)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, memory_budget=10 * memory.BYTES_PER_OBJECT
+    )
+    with pytest.raises(memory.MemoryBudgetExceeded, match='LAMP'):
+        with uow:
+            uow.products.get(sku='LAMP')
+
+    assert list(uow.session) == []
+
+
+def test_calibrate_measures_bytes_per_object(session_factory, monkeypatch):
+    add_busy_product(session_factory, 'LAMP', 200)
+    monkeypatch.setattr(memory, 'BYTES_PER_OBJECT', 1)
+
+    def load():
+        product = session_factory().query(model.Product).filter_by(sku='LAMP').one()
+        for batch in product.batches:
+            batch._allocations
+        return product
+
+    assert 200 < memory.calibrate(load) < 20_000
+    assert memory.BYTES_PER_OBJECT > 200
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from allocation.adapters import archive, reconcile, stock_levels
+from allocation.domain import events
+from allocation.service_layer import locks, messagebus, services, unit_of_work
+
+
+def add_warehouses(uow):
+    services.add_batch('berlin-1', 'LAMP', 10, None, uow, partition='berlin')
+    services.add_batch('paris-1', 'LAMP', 10, None, uow, partition='paris')
+
+
+def test_partitions_are_products_of_their_own(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    add_warehouses(uow)
+
+    with uow:
+        assert uow.products.partitions('LAMP') == ['berlin', 'paris']
+        berlin = uow.products.get('LAMP', partition='berlin')
+        assert [b.reference for b in berlin.batches] == ['berlin-1']
+        assert berlin.key == 'LAMP@berlin'
+        assert uow.products.get('LAMP') is None
+
+
+def test_allocate_prefers_the_partition_then_falls_back(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    add_warehouses(uow)
+
+    assert services.allocate('o1', 'LAMP', 8, uow, partition='paris') == 'paris-1'
+    assert services.allocate('o2', 'LAMP', 8, uow, partition='paris') == 'berlin-1'
+    assert services.allocate('o3', 'LAMP', 1, uow) == 'berlin-1'
+
+    with uow:
+        assert uow.products.get('LAMP', partition='paris').version_number == 2
+        assert uow.products.get('LAMP', partition='berlin').version_number == 3
+        assert uow.products.stock_level('LAMP') == (3, None)
+
+
+def test_out_of_stock_only_when_no_partition_has_it(session_factory, monkeypatch):
+    published = []
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [published.append])
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    add_warehouses(uow)
+
+    assert services.allocate('o1', 'LAMP', 20, uow, partition='paris') is None
+    assert published == [events.OutOfStock('LAMP')]
+    with pytest.raises(services.InvalidSku):
+        services.allocate('o2', 'SOFA', 1, uow, partition='paris')
+
+
+def test_no_out_of_stock_when_another_partition_has_it(monkeypatch):
+    published = []
+    monkeypatch.setitem(messagebus.HANDLERS, events.OutOfStock, [published.append])
+    uow = unit_of_work.InMemoryUnitOfWork()  # the products outlive the uow
+    services.add_batch('paris-1', 'LAMP', 5, None, uow, partition='paris')
+    services.add_batch('berlin-1', 'LAMP', 10, None, uow, partition='berlin')
+
+    assert services.allocate('o1', 'LAMP', 8, uow, partition='paris') == 'berlin-1'
+    assert published == []
+    assert uow.products.get('LAMP', partition='paris').events == []
+
+
+def test_partitions_of_a_sku_do_not_wait_for_each_other(file_session_factory):
+    manager = locks.SkuLockManager()
+    add_warehouses(unit_of_work.SqlAlchemyUnitOfWork(file_session_factory))
+    uows = []
+
+    def slow_allocate(partition):
+        uow = unit_of_work.SqlAlchemyUnitOfWork(file_session_factory, lock_manager=manager)
+        with uow:
+            uow.products.get('LAMP', partition=partition)
+            time.sleep(0.2)
+        uows.append(uow)
+
+    threads = [threading.Thread(target=slow_allocate, args=(p,)) for p in ('berlin', 'paris')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(uow.lock_wait for uow in uows) < 0.1
+    assert set(manager.stats()) == {'LAMP@berlin', 'LAMP@paris'}
+
+
+def test_jobs_keep_partitions_apart(in_memory_db, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    add_warehouses(uow)
+    services.allocate('o1', 'LAMP', 10, uow, partition='paris')
+
+    assert archive.archive_exhausted_batches(in_memory_db) == 1
+    assert reconcile.reconcile(in_memory_db).ok
+    with in_memory_db.begin() as conn:
+        stock_levels.recompute(conn, ['LAMP'])
+        assert stock_levels.get(conn, 'LAMP') == (10, None)
+    with uow:
+        assert uow.products.get('LAMP', partition='paris').version_number == 3
+        assert uow.products.get('LAMP', partition='berlin').version_number == 1
+
+
+def test_queries_see_all_partitions_of_a_sku(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    add_warehouses(uow)
+    services.allocate('o1', 'LAMP', 3, uow, partition='paris')
+
+    product = services.get_product('LAMP', uow)
+    assert product['version_number'] == 3  # 2 + 1, all writes to the sku
+    assert sorted((b['ref'], b['available']) for b in product['batches']) == [
+        ('berlin-1', 10), ('paris-1', 7),
+    ]
+    assert services.get_stock('LAMP', uow)['available'] == 17
+
+
+def test_in_memory_stock_levels_add_up_the_partitions():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    add_warehouses(uow)
+
+    assert services.get_stock('LAMP', uow) == {
+        'sku': 'LAMP', 'available': 20, 'earliest_eta': None,
+    }
+    assert len(services.get_product('LAMP', uow)['batches']) == 2
+
+
+def test_baked_and_plain_queries_return_the_same_products(session_factory):
+    add_warehouses(unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+    services.allocate('o1', 'LAMP', 3, unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    def products(baked):
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, baked_queries=baked)
+        with uow:
+            found = [uow.products.get('LAMP', partition=p) for p in ('berlin', 'paris', 'rome')]
+            found.append(uow.products.get_readonly('LAMP'))
+            return [
+                p and (p.key, p.version_number, sorted(
+                    (b.reference, b.available_quantity) for b in p.batches
+                ))
+                for p in found
+            ]
+
+    assert products(baked=True) == products(baked=False)
+    assert products(baked=True)[2] is None
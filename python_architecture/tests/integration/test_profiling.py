@@ -0,0 +1,43 @@
+import logging
+
+from allocation.adapters import orm, profiling
+from allocation.service_layer import services, unit_of_work
+
+
+def test_normalize_groups_statements_with_different_literals():
+    first = profiling.normalize("SELECT * FROM batches WHERE sku = 'RED-CHAIR'")
+    second = profiling.normalize("SELECT *  FROM batches\n WHERE sku = 'BLUE-SOFA'")
+    assert first == second == "SELECT * FROM batches WHERE sku = ?"
+    assert profiling.normalize("SELECT 1 WHERE id IN (?, ?, ?)") == (
+        "SELECT ? WHERE id IN (...)"
+    )
+
+
+def test_uow_collects_a_report_of_its_statements(in_memory_db, session_factory):
+    profiler = profiling.QueryProfiler(slow_threshold=10)
+    orm.register_profiler(in_memory_db, profiler)
+    services.add_batch('b1', 'NOISY-LAMP', 100, None, 
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.allocate('o1', 'NOISY-LAMP', 10, uow)
+
+    report = uow.query_report
+    assert report.call == 'allocate'
+    assert report.count > 0
+    assert any(sql.startswith('SELECT products.') for sql in report.statements)
+    assert any(sql.startswith('INSERT INTO order_lines') for sql in report.statements)
+    assert sum(s.count for s in profiler.statements.values()) > report.count
+
+
+def test_slow_queries_are_logged_with_the_service_call(
+    in_memory_db, session_factory, caplog
+):
+    orm.register_profiler(in_memory_db, profiling.QueryProfiler(slow_threshold=0))
+
+    with caplog.at_level(logging.WARNING, logger=profiling.__name__):
+        services.add_batch('b1', 'SLOW-CLOCK', 100, None, 
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+
+    assert 'slow query' in caplog.text
+    assert 'in add_batch' in caplog.text
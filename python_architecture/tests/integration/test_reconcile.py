@@ -0,0 +1,60 @@
+from allocation.adapters import archive, orm, reconcile
+from allocation.service_layer import services, unit_of_work
+
+
+def add_stock(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'LAMP', 10, None, uow)
+    services.add_batch('b2', 'LAMP', 10, None, uow)
+    services.add_batch('b3', 'SOFA', 10, None, uow)
+    services.allocate('o1', 'LAMP', 10, uow)
+    services.allocate('o2', 'LAMP', 4, uow)
+    services.allocate('o3', 'SOFA', 1, uow)
+
+
+def test_a_consistent_store_has_no_violations(in_memory_db, session_factory):
+    add_stock(session_factory)
+    archive.archive_exhausted_batches(in_memory_db)
+
+    report = reconcile.reconcile(in_memory_db, chunk_size=1)
+
+    assert report.ok, report.samples
+    assert report.rows == {'batches': 2, 'allocations': 2, 'products': 2, 'order_lines': 3}
+    assert report.rows_per_sec > 0
+
+
+def test_violations_are_found_and_counted(in_memory_db, session_factory):
+    add_stock(session_factory)
+    with in_memory_db.begin() as conn:
+        conn.execute(orm.order_lines.update().where(orm.order_lines.c.orderid == 'o1')
+                     .values(qty=11))
+        conn.execute(orm.order_lines.update().where(orm.order_lines.c.orderid == 'o3')
+                     .values(sku='LAMP'))
+        conn.execute(orm.order_lines.insert().values(orderid='o4', sku='SOFA', qty=1))
+        conn.execute(orm.allocations.insert().values(orderline_id=999, batch_id=2))
+
+    report = reconcile.reconcile(in_memory_db, chunk_size=2)
+
+    assert not report.ok
+    assert dict(report.violations) == {
+        'over_allocated': 1, 'sku_mismatch': 1, 'dangling_allocation': 1,
+        'orphaned_line': 1,
+    }
+    assert {(v.check, v.key) for v in report.samples} == {
+        ('over_allocated', 'b1'), ('sku_mismatch', 'b3'),
+        ('dangling_allocation', 'b2'), ('orphaned_line', '4'),
+    }
+
+
+def test_versions_must_not_go_down_between_runs(in_memory_db, session_factory):
+    add_stock(session_factory)
+    assert reconcile.reconcile(in_memory_db).ok
+
+    with in_memory_db.begin() as conn:
+        conn.execute(orm.products.update().where(orm.products.c.sku == 'LAMP')
+                     .values(version_number=1))
+    report = reconcile.reconcile(in_memory_db)
+
+    assert dict(report.violations) == {'version_regressed': 1}
+    assert report.samples[0].key == 'LAMP'
+    assert reconcile.reconcile(in_memory_db).violations['version_regressed'] == 1
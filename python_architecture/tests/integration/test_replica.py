@@ -0,0 +1,102 @@
+"""Two SQLite files standing in for a primary and a (lagging) replica"""
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters.orm import metadata, start_mappers
+from allocation.service_layer import services, unit_of_work
+
+
+@pytest.fixture
+def primary_and_replica(tmp_path):
+    factories = []
+    for name in ('primary', 'replica'):
+        engine = create_engine(f'sqlite:///{tmp_path / name}.db')
+        metadata.create_all(engine)
+        factories.append(sessionmaker(bind=engine))
+    start_mappers()
+    yield factories
+    clear_mappers()
+    unit_of_work.WRITTEN_VERSIONS.clear()
+
+
+def insert_product(session, sku, version):
+    session.execute(
+        'INSERT INTO products (sku, version_number) VALUES (:sku, :version)',
+        dict(sku=sku, version=version)
+    )
+    session.execute(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta)'
+        ' VALUES (:ref, :sku, 100, null)',
+        dict(ref=f'{sku}-batch', sku=sku)
+    )
+    session.commit()
+
+
+def test_reads_go_to_the_replica_and_writes_to_the_primary(primary_and_replica):
+    primary, replica = primary_and_replica
+    insert_product(replica(), 'REPLICA-ONLY', version=3)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_session_factory=replica)
+    services.add_batch('b1', 'NEW-SOFA', 100, None, uow)
+
+    with uow:
+        assert [p.sku for p in uow.products.list()] == ['REPLICA-ONLY']
+    assert services.get_product('REPLICA-ONLY', uow)['version_number'] == 3
+    rows = list(primary().execute('SELECT sku FROM products'))
+    assert rows == [('NEW-SOFA',)]
+
+
+def test_lagging_replica_falls_back_to_the_primary_for_our_writes(primary_and_replica):
+    primary, replica = primary_and_replica
+    insert_product(primary(), 'LAGGY-CHAIR', version=1)
+    insert_product(replica(), 'LAGGY-CHAIR', version=1)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_session_factory=replica)
+    services.allocate('o1', 'LAGGY-CHAIR', 10, uow)
+
+    product = services.get_product('LAGGY-CHAIR', uow)
+    assert product['version_number'] == 2
+    assert product['batches'][0]['available'] == 90
+
+
+def test_explicit_min_version_is_respected(primary_and_replica):
+    primary, replica = primary_and_replica
+    insert_product(primary(), 'OLD-LAMP', version=5)
+    insert_product(replica(), 'OLD-LAMP', version=4)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary, read_session_factory=replica)
+
+    assert services.get_product('OLD-LAMP', uow)['version_number'] == 4
+    assert services.get_product('OLD-LAMP', uow, min_version=5)['version_number'] == 5
+
+
+def test_remembering_written_versions_costs_no_queries(primary_and_replica):
+    primary, _ = primary_and_replica
+    uow = unit_of_work.SqlAlchemyUnitOfWork(primary)
+    services.add_batch('b1', 'WRITTEN-LAMP', 100, None, uow)
+
+    statements = []
+    with uow:
+        uow.products.get('WRITTEN-LAMP').allocate(services.OrderLine('o1', 'WRITTEN-LAMP', 1))
+        event.listen(
+            uow.session.get_bind(), 'before_cursor_execute',
+            lambda *args: statements.append(args[2]),
+        )
+        uow.commit()
+
+    assert unit_of_work.WRITTEN_VERSIONS['WRITTEN-LAMP'] == 2
+    assert not any(s.startswith('SELECT') for s in statements)
+
+
+def test_without_a_read_engine_reads_go_to_the_primary(primary_and_replica, monkeypatch):
+    primary, _ = primary_and_replica
+    monkeypatch.setattr(unit_of_work, '_engines', (primary.kw['bind'], None))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        primary, read_session_factory=unit_of_work._LazySessionFactory(read=True)
+    )
+    services.add_batch('b1', 'ONLY-SOFA', 100, None, uow)
+
+    with uow:
+        assert uow.products.read_session is uow.session
+    assert services.get_product('ONLY-SOFA', uow)['version_number'] == 1
@@ -0,0 +1,41 @@
+from allocation.adapters import repository
+from allocation.domain import model
+
+
+def insert_products(session, count):
+    for i in range(count):
+        sku = f'STREAM-{i:03}'
+        batch = model.Batch(f'batch-{i}', sku, 100, eta=None)
+        batch.allocate(model.OrderLine(f'order-{i}', sku, i))
+        session.add(model.Product(sku, [batch]))
+    session.commit()
+    session.expunge_all()
+
+
+def test_iter_products_streams_every_product_in_sku_order(session):
+    insert_products(session, 25)
+    repo = repository.SqlAlchemyRepository(session)
+
+    seen = [(p.sku, p.batches[0].available_quantity) for p in repo.iter_products(10)]
+
+    assert seen == [(f'STREAM-{i:03}', 100 - i) for i in range(25)]
+
+
+def test_iter_products_keeps_the_session_small(session):
+    insert_products(session, 25)
+    repo = repository.SqlAlchemyRepository(session)
+
+    sizes = [len(session.identity_map) for _ in repo.iter_products(chunk_size=5)]
+
+    # product + batch + order line per aggregate, one chunk at a time
+    assert max(sizes) <= 5 * 3
+
+
+def test_iter_products_keeps_products_used_by_the_unit_of_work(session):
+    insert_products(session, 3)
+    repo = repository.SqlAlchemyRepository(session)
+    product = repo.get('STREAM-001')
+
+    list(repo.iter_products(chunk_size=2))
+
+    assert product in session
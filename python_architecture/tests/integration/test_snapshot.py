@@ -0,0 +1,73 @@
+from datetime import date
+
+from allocation.adapters import orm, profiling, snapshot
+from allocation.service_layer import services, unit_of_work
+
+
+def export_snapshot(session_factory, path):
+    with open(path, 'wb') as f:
+        snapshot.export(session_factory(), f)
+    return snapshot.load(path)
+
+
+def test_snapshot_roundtrips_products(session_factory, tmp_path):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'SHINY-TABLE', 100, None, uow)
+    services.add_batch('b2', 'SHINY-TABLE', 50, date(2011, 1, 2), uow)
+    services.allocate('o1', 'SHINY-TABLE', 10, uow)
+
+    snap = export_snapshot(session_factory, tmp_path / 'products.snap')
+    product = snap.get('SHINY-TABLE', version_number=3)  # 2 batches, 1 allocation
+
+    assert len(snap) == 1
+    assert {b.reference: b.available_quantity for b in product.batches} == {
+        'b1': 90, 'b2': 50
+    }
+    assert [b.eta for b in product.batches] == [None, date(2011, 1, 2)]
+
+
+def test_warm_start_hydrates_a_product_with_a_single_query(
+    in_memory_db, session_factory, tmp_path
+):
+    orm.register_profiler(in_memory_db, profiling.QueryProfiler(slow_threshold=10))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'WARM-CHAIR', 100, None, uow)
+    services.allocate('o1', 'WARM-CHAIR', 10, uow)
+    snap = export_snapshot(session_factory, tmp_path / 'products.snap')
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, snapshot=snap)
+    with uow:
+        product = uow.products.get('WARM-CHAIR')
+        assert uow.query_report.count == 1
+        assert product.batches[0].available_quantity == 90
+
+    services.allocate('o2', 'WARM-CHAIR', 5, uow)
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as cold:
+        product = cold.products.get('WARM-CHAIR')
+        assert product.batches[0].available_quantity == 85
+        assert product.version_number == 3
+
+
+def test_stale_entries_fall_back_to_the_database(session_factory, tmp_path):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'STALE-LAMP', 100, None, uow)
+    snap = export_snapshot(session_factory, tmp_path / 'products.snap')
+    services.allocate('o1', 'STALE-LAMP', 10, uow)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, snapshot=snap)
+    with uow:
+        product = uow.products.get('STALE-LAMP')
+        assert product.batches[0].available_quantity == 90
+    assert 'STALE-LAMP' not in snap
+
+
+def test_a_batch_added_after_the_export_makes_the_entry_stale(session_factory, tmp_path):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'GROWING-LAMP', 10, None, uow)
+    snap = export_snapshot(session_factory, tmp_path / 'products.snap')
+    services.add_batch('b2', 'GROWING-LAMP', 100, None, uow)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, snapshot=snap)
+    assert services.allocate('o1', 'GROWING-LAMP', 50, uow) == 'b2'
+    assert 'GROWING-LAMP' not in snap
+    assert services.get_stock('GROWING-LAMP', uow)['available'] == 60
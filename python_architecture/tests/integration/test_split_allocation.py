@@ -0,0 +1,32 @@
+from datetime import date
+
+from allocation.adapters import reconcile
+from allocation.service_layer import services, unit_of_work
+
+
+def test_split_allocations_are_persisted_per_batch(in_memory_db, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'PALLET-RACK', 20, None, uow)
+    services.add_batch('b2', 'PALLET-RACK', 50, date(2011, 1, 2), uow)
+
+    assert services.allocate_split('o1', 'PALLET-RACK', 45, uow) == [('b1', 20), ('b2', 25)]
+
+    rows = session_factory().execute(
+        'SELECT b.reference, ol.orderid, ol.qty FROM allocations a'
+        ' JOIN batches b ON a.batch_id = b.id JOIN order_lines ol ON a.orderline_id = ol.id'
+        ' ORDER BY b.reference'
+    )
+    assert list(rows) == [('b1', 'o1', 20), ('b2', 'o1', 25)]
+    assert services.get_stock('PALLET-RACK', uow)['available'] == 25
+    assert reconcile.reconcile(in_memory_db).ok
+
+
+def test_split_allocations_in_the_event_store(session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(session_factory)
+    services.add_batch('b1', 'PALLET-RACK', 20, None, uow)
+    services.add_batch('b2', 'PALLET-RACK', 50, date(2011, 1, 2), uow)
+    services.allocate_split('o1', 'PALLET-RACK', 45, uow)
+
+    with unit_of_work.EventSourcedUnitOfWork(session_factory) as uow:
+        product = uow.products.get('PALLET-RACK')
+        assert [b.available_quantity for b in product.batches] == [0, 25]
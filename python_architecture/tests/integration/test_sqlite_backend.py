@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from allocation.service_layer import services, unit_of_work
+
+
+def test_sqlite_connections_are_tuned(sqlite_engines):
+    writer, readers = sqlite_engines
+
+    with writer.connect() as conn:
+        assert conn.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert conn.execute('PRAGMA busy_timeout').scalar() == 5000
+    with readers.connect() as conn:
+        assert conn.execute('PRAGMA query_only').scalar() == 1
+
+
+def test_services_run_on_one_writer_and_the_readers(sqlite_engines):
+    writer, readers = sqlite_engines
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=writer), read_session_factory=sessionmaker(bind=readers),
+    )
+
+    services.add_batch('b1', 'EDGE-LAMP', 100, None, uow)
+    assert services.allocate('o1', 'EDGE-LAMP', 10, uow) == 'b1'
+    assert services.get_stock('EDGE-LAMP', uow)['available'] == 90
+    assert services.get_product('EDGE-LAMP', uow)['version_number'] == 2
+
+
+def test_readers_cannot_write(sqlite_engines):
+    _, readers = sqlite_engines
+
+    with pytest.raises(OperationalError, match='readonly'):
+        with readers.begin() as conn:
+            conn.execute("INSERT INTO products (sku) VALUES ('NOPE')")
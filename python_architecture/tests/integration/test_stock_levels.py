@@ -0,0 +1,59 @@
+from datetime import date
+
+from sqlalchemy import event
+
+from allocation.adapters import bulk_load, orm, stock_levels
+from allocation.service_layer import services, unit_of_work
+
+
+def test_stock_levels_are_updated_at_commit(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('later', 'STOCKED-BED', 10, date(2011, 1, 2), uow)
+    services.add_batch('now', 'STOCKED-BED', 10, None, uow)
+    services.allocate('o1', 'STOCKED-BED', 10, uow)
+
+    assert stock_levels.get(session_factory(), 'STOCKED-BED') == (10, date(2011, 1, 2))
+    assert services.get_stock('STOCKED-BED', uow) == {
+        'sku': 'STOCKED-BED', 'available': 10, 'earliest_eta': '2011-01-02',
+    }
+
+
+def test_bulk_load_recomputes_the_same_stock_levels(in_memory_db, session_factory, tmp_path):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'LOADED-BED', 10, None, uow)
+    services.allocate('o1', 'LOADED-BED', 4, uow)
+    path = tmp_path / 'shipment.csv'
+    path.write_text('ref,sku,qty,eta\nb2,LOADED-BED,20,2011-01-02\n')
+
+    bulk_load.load_batches(in_memory_db, 'shipment', bulk_load.read_csv(path))
+
+    with uow:
+        product = uow.products.get('LOADED-BED')
+        assert stock_levels.get(uow.session, 'LOADED-BED') == (
+            stock_levels.of_product(product)
+        ) == (26, None)
+
+
+def test_skus_without_a_row_are_served_then_backfilled(in_memory_db, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'OLD-BED', 10, None, uow)
+    services.allocate('o1', 'OLD-BED', 4, uow)
+    with in_memory_db.begin() as conn:  # as if written before the read model
+        conn.execute(orm.stock_levels.delete())
+
+    assert services.get_stock('OLD-BED', uow)['available'] == 6
+    assert stock_levels.backfill(in_memory_db, chunk_size=1) == 1
+    assert stock_levels.get(session_factory(), 'OLD-BED') == (6, None)
+
+
+def test_the_product_is_written_before_its_stock_level(in_memory_db, session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'RACED-BED', 10, None, uow)
+    statements = []
+    event.listen(in_memory_db, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+
+    services.allocate('o1', 'RACED-BED', 1, uow)
+
+    tables = [s.split()[1] for s in statements if s.startswith(('UPDATE', 'INSERT'))]
+    assert tables.index('products') < tables.index('stock_levels')
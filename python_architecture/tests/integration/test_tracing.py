@@ -0,0 +1,80 @@
+import json
+
+import pytest
+from allocation.adapters import tracing
+from allocation.service_layer import messagebus, services, unit_of_work
+
+
+class ListExporter:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = ListExporter()
+    monkeypatch.setattr(tracing, 'EXPORTER', exporter)
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(messagebus.email, 'send_email', lambda *args: None)
+    return exporter
+
+
+def test_spans_cover_service_uow_repository_and_handlers(session_factory, exporter):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    services.add_batch('b1', 'TRACED-LAMP', 10, None, uow)
+
+    with tracing.start_trace('POST /allocate'):
+        services.allocate('o1', 'TRACED-LAMP', 20, uow)
+
+    [trace] = exporter.traces
+    spans = {s.name: s for s in trace.spans}
+    assert set(spans) == {
+        'POST /allocate', 'allocate', 'uow', 'repository.get', 'uow.commit',
+        'uow.rollback', 'handler:send_out_of_stock_notification',
+    }
+    assert spans['allocate'].parent_id == spans['POST /allocate'].span_id
+    assert spans['repository.get'].parent_id == spans['uow'].span_id
+    assert spans['handler:send_out_of_stock_notification'].parent_id == spans['uow'].span_id
+    assert {s.trace.trace_id for s in trace.spans} == {trace.trace_id}
+
+
+def test_unsampled_requests_record_nothing(session_factory, exporter):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    with tracing.start_trace('POST /add_batch', sampled=False) as root:
+        services.add_batch('b1', 'QUIET-LAMP', 10, None, uow)
+
+    assert root is None
+    assert exporter.traces == []
+
+
+def test_file_exporter_writes_json_lines(tmp_path):
+    trace = tracing.Trace()
+    trace.add(tracing.Span(trace, 'allocate', None, sku='RED-CHAIR'))
+    exporter = tracing.FileExporter(str(tmp_path / 'traces.jsonl'))
+
+    exporter.export(trace)
+
+    [line] = (tmp_path / 'traces.jsonl').read_text().splitlines()
+    assert json.loads(line)['attributes'] == {'sku': 'RED-CHAIR'}
+
+
+def test_otlp_payload_has_one_span_per_span():
+    trace = tracing.Trace()
+    trace.add(tracing.Span(trace, 'allocate', None, sku='RED-CHAIR'))
+    exporter = tracing.OtlpHttpExporter('http://localhost:4318')
+
+    [resource] = exporter.payload(trace)['resourceSpans']
+    [span] = resource['scopeSpans'][0]['spans']
+
+    assert span['traceId'] == trace.trace_id
+    assert span['attributes'] == [{'key': 'sku', 'value': {'stringValue': 'RED-CHAIR'}}]
+
+
+def test_spans_outside_of_a_trace_are_one_shared_no_op():
+    assert tracing.span('a') is tracing.span('b')
+    with tracing.span('a') as span, tracing.span('a'):  # reusable, nested too
+        assert span is None
@@ -4,8 +4,9 @@ import traceback
 from typing import List
 
 import pytest
+from allocation.adapters import profiling, tracing
 from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from allocation.service_layer import deadlines, unit_of_work
 
 import uuid
 
@@ -94,6 +95,36 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
+def test_a_failed_start_leaves_nothing_behind(session_factory, monkeypatch):
+    closed = []
+    def new_session():
+        session = session_factory()
+        session.close = lambda: closed.append(session)
+        return session
+    def out_of_time(session):
+        raise deadlines.DeadlineExceeded('Deadline exceeded')
+    monkeypatch.setattr(deadlines, 'apply_to_session', out_of_time)
+
+    with pytest.raises(deadlines.DeadlineExceeded):
+        with unit_of_work.SqlAlchemyUnitOfWork(new_session):
+            pass
+
+    assert tracing._current.get() is None
+    assert profiling._current_report.get() is None
+    assert len(closed) == 1
+
+
+def test_the_deadline_bounds_the_read_session_too(session_factory, monkeypatch):
+    bounded = []
+    monkeypatch.setattr(deadlines, 'apply_to_session', bounded.append)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, read_session_factory=session_factory
+    )
+    with uow:
+        assert bounded == [uow.session, uow.read_session]
+
+
 def try_to_allocate(orderid, sku, exceptions):
     """Simulate a slow function with sleep. Highlight concurrency issues"""
     line = model.OrderLine(orderid, sku, 10)
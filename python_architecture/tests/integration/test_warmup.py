@@ -0,0 +1,33 @@
+from sqlalchemy.orm import sessionmaker
+
+from allocation.service_layer import services, unit_of_work, warmup
+
+
+def test_prewarm_fills_the_pools_and_reads_the_hot_skus(sqlite_engines):
+    writer, readers = sqlite_engines
+    def new_uow():
+        return unit_of_work.SqlAlchemyUnitOfWork(
+            sessionmaker(bind=writer), read_session_factory=sessionmaker(bind=readers),
+        )
+    services.add_batch('b1', 'WARM-LAMP', 10, None, new_uow())
+    writer.dispose()
+    readers.dispose()  # cold pools
+
+    timings = warmup.prewarm(
+        new_uow, ['WARM-LAMP', 'NO-SUCH-SKU'], connections=2,
+        engines=sqlite_engines,
+    )
+
+    assert writer.pool.checkedin() == 1  # its pool size
+    assert readers.pool.checkedin() == 2
+    assert set(timings) == {'engines', 'connections', 'mappers', 'skus', 'total'}
+
+
+def test_a_failed_prewarm_only_gets_logged(monkeypatch, caplog):
+    def broken():
+        raise ConnectionError('no database')
+    monkeypatch.setattr(unit_of_work, 'default_engines', broken)
+
+    warmup.start_in_background(lambda: None).join()
+
+    assert 'pre-warm failed' in caplog.text
@@ -0,0 +1,141 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker, clear_mappers
+
+from allocation.adapters import orm
+from allocation.domain import model
+from allocation.service_layer import memory, services, unit_of_work
+
+
+@pytest.fixture
+def write_only_session_factory(in_memory_db):
+    orm.start_mappers(write_only_allocations=True)
+    yield sessionmaker(bind=in_memory_db)
+    clear_mappers()
+    orm.WRITE_ONLY_ALLOCATIONS = False
+
+
+def count_statements(engine):
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    return statements
+
+
+def test_allocating_does_not_load_the_lines_of_a_batch(in_memory_db, write_only_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory)
+    services.add_batch('b1', 'LAMP', 1000, None, uow)
+    for i in range(50):
+        services.allocate(f'o{i}', 'LAMP', 2, uow)
+
+    statements = count_statements(in_memory_db)
+    assert services.allocate('o-last', 'LAMP', 2, uow) == 'b1'
+    assert not any(s.startswith('SELECT order_lines.') for s in statements)
+
+    with uow:
+        [batch] = uow.products.get('LAMP').batches
+        assert batch.available_quantity == 1000 - 51 * 2
+        assert uow.memory_peak < memory.BYTES_PER_OBJECT * 3
+
+
+def test_deallocate_deletes_only_the_one_line(in_memory_db, write_only_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory)
+    services.add_batch('b1', 'LAMP', 100, None, uow)
+    services.allocate('o1', 'LAMP', 10, uow)
+    services.allocate('o2', 'LAMP', 20, uow)
+
+    with uow:
+        [batch] = uow.products.get('LAMP').batches
+        assert model.OrderLine('o1', 'LAMP', 10) in batch._allocations
+        batch.deallocate(model.OrderLine('o1', 'LAMP', 10))
+        batch.deallocate(model.OrderLine('o-unknown', 'LAMP', 10))
+        uow.commit()
+
+    with uow:
+        [batch] = uow.products.get('LAMP').batches
+        assert batch.available_quantity == 80
+        assert model.OrderLine('o1', 'LAMP', 10) not in batch._allocations
+        assert list(batch._allocations) == [model.OrderLine('o2', 'LAMP', 20)]
+
+
+def test_new_batches_work_before_they_are_saved(write_only_session_factory):
+    batch = model.Batch('b1', 'LAMP', 10, None)
+    batch.allocate(model.OrderLine('o1', 'LAMP', 4))
+    assert batch.available_quantity == 6
+    assert model.OrderLine('o1', 'LAMP', 4) in batch._allocations
+
+
+def test_memory_prediction_only_counts_batches(write_only_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory)
+    services.add_batch('b1', 'LAMP', 100, None, uow)
+    for i in range(10):
+        services.allocate(f'o{i}', 'LAMP', 1, uow)
+
+    assert memory.predict(write_only_session_factory(), 'LAMP') == 2 * memory.BYTES_PER_OBJECT
+
+
+@pytest.fixture(params=['set', 'write-only'])
+def saved_batch(request, in_memory_db):
+    """A batch of 20 DESKs in a session, the way the repository hands them out"""
+    orm.start_mappers(write_only_allocations=request.param == 'write-only')
+    session = sessionmaker(bind=in_memory_db)()
+    session.add(model.Product('DESK', [model.Batch('b1', 'DESK', 20, None)]))
+    session.commit()
+    yield session.query(model.Batch).one()
+    session.close()
+    clear_mappers()
+    orm.WRITE_ONLY_ALLOCATIONS = False
+
+
+def test_batches_behave_the_same_in_both_modes(saved_batch):
+    line = model.OrderLine('o1', 'DESK', 2)
+
+    saved_batch.deallocate(line)
+    assert saved_batch.available_quantity == 20
+
+    saved_batch.allocate(line)
+    saved_batch.allocate(line)  # idempotent
+    assert saved_batch.available_quantity == 18
+    assert not saved_batch.can_allocate(model.OrderLine('o2', 'DESK', 19))
+
+    saved_batch.deallocate(line)
+    assert saved_batch.available_quantity == 20
+
+
+def test_allocating_a_line_twice_is_idempotent(write_only_session_factory):
+    for _ in range(2):
+        with unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory) as uow:
+            if uow.products.get('LAMP') is None:
+                uow.products.add(model.Product('LAMP', [model.Batch('b1', 'LAMP', 100, None)]))
+            uow.products.get('LAMP').batches[0].allocate(model.OrderLine('o1', 'LAMP', 10))
+            uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory) as uow:
+        assert uow.products.get('LAMP').batches[0].available_quantity == 90
+    [[rows]] = write_only_session_factory().execute('SELECT count(*) FROM allocations')
+    assert rows == 1
+
+
+def test_quantities_of_all_batches_are_one_query(in_memory_db, write_only_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory)
+    for i in range(20):
+        services.add_batch(f'b{i}', 'LAMP', 1, None, uow)
+    for i in range(19):
+        services.allocate(f'o{i}', 'LAMP', 1, uow)
+
+    statements = count_statements(in_memory_db)
+    assert services.allocate('o-last', 'LAMP', 1, uow) == 'b19'
+    assert len([s for s in statements if 'sum(order_lines.qty)' in s]) == 1
+
+
+def test_calibrate_counts_only_what_was_loaded(write_only_session_factory, monkeypatch):
+    monkeypatch.setattr(memory, 'BYTES_PER_OBJECT', 1)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(write_only_session_factory)
+    services.add_batch('b1', 'LAMP', 1000, None, uow)
+    services.allocate('o1', 'LAMP', 2, uow)
+
+    session = write_only_session_factory()
+
+    def load():
+        return session.query(model.Product).filter_by(sku='LAMP').one()
+
+    assert memory.calibrate(load) > 1
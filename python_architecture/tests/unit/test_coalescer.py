@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+
+import pytest
+from allocation.adapters import repository, tracing
+from allocation.domain import model
+from allocation.service_layer import coalescer, deadlines, services, unit_of_work
+
+
+class FakeRepository(repository.AbstractRepository):
+
+    def __init__(self, products):
+        super().__init__()
+        self._products = {p.sku: p for p in products}
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku):
+        return self._products.get(sku)
+
+
+class CountingUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    """Shared by all the threads, counts the transactions"""
+
+    def __init__(self, products):
+        self.products = FakeRepository(products)
+        self.commits = 0
+
+    def _commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def allocate_concurrently(coalescing, orders):
+    results = {}
+
+    def allocate(orderid, sku, qty):
+        try:
+            results[orderid] = coalescing.allocate(orderid, sku, qty)
+        except Exception as e:
+            results[orderid] = e
+
+    threads = [threading.Thread(target=allocate, args=order) for order in orders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_allocations_for_a_sku_share_one_transaction():
+    product = model.Product('HOT-SOFA', [model.Batch('b1', 'HOT-SOFA', 100, None)])
+    uow = CountingUnitOfWork([product])
+    coalescing = coalescer.AllocateCoalescer(lambda: uow, window=0.2)
+
+    results = allocate_concurrently(
+        coalescing, [(f'o{i}', 'HOT-SOFA', 10) for i in range(8)]
+    )
+
+    assert set(results.values()) == {'b1'}
+    assert uow.commits < 8
+    assert product.batches[0].available_quantity == 20
+    assert product.version_number == 8
+
+
+def test_full_groups_are_flushed_without_waiting_for_the_window():
+    product = model.Product('HOT-LAMP', [model.Batch('b1', 'HOT-LAMP', 100, None)])
+    uow = CountingUnitOfWork([product])
+    coalescing = coalescer.AllocateCoalescer(lambda: uow, window=5, max_group=2)
+
+    results = allocate_concurrently(
+        coalescing, [('o1', 'HOT-LAMP', 10), ('o2', 'HOT-LAMP', 10)]
+    )
+
+    assert results == {'o1': 'b1', 'o2': 'b1'}
+    assert uow.commits == 1
+
+
+def test_invalid_sku_is_raised_to_every_caller_of_the_group():
+    uow = CountingUnitOfWork([])
+    coalescing = coalescer.AllocateCoalescer(lambda: uow, window=0.1)
+
+    results = allocate_concurrently(
+        coalescing, [('o1', 'NOPE', 10), ('o2', 'NOPE', 10)]
+    )
+
+    assert all(isinstance(e, services.InvalidSku) for e in results.values())
+    assert results['o1'] is not results['o2']  # each raised its own
+    assert uow.commits == 0
+
+
+def test_the_group_commit_is_a_traced_service_call(monkeypatch):
+    traces = []
+    monkeypatch.setattr(tracing, 'EXPORTER', tracing.FileExporter(os.devnull))
+    monkeypatch.setattr(tracing.EXPORTER, 'export', traces.append)
+    product = model.Product('HOT-RUG', [model.Batch('b1', 'HOT-RUG', 100, None)])
+    coalescing = coalescer.AllocateCoalescer(lambda: CountingUnitOfWork([product]))
+
+    with tracing.start_trace('POST /allocate', sampled=True):
+        assert coalescing.allocate('o1', 'HOT-RUG', 10) == 'b1'
+
+    [trace] = traces
+    assert 'allocate_group' in {s.name for s in trace.spans}
+
+
+def test_a_partitioned_sku_falls_back_over_its_partitions():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    services.add_batch('paris-1', 'SPLIT-SOFA', 10, None, uow, partition='paris')
+    services.add_batch('berlin-1', 'SPLIT-SOFA', 10, None, uow, partition='berlin')
+    coalescing = coalescer.AllocateCoalescer(lambda: uow, window=0.1)
+
+    results = allocate_concurrently(
+        coalescing, [('o1', 'SPLIT-SOFA', 8), ('o2', 'SPLIT-SOFA', 8)]
+    )
+
+    assert sorted(results.values()) == ['berlin-1', 'paris-1']
+
+
+def test_a_follower_out_of_time_gives_up_its_line():
+    product = model.Product('SLOW-SOFA', [model.Batch('b1', 'SLOW-SOFA', 100, None)])
+    uow = CountingUnitOfWork([product])
+    coalescing = coalescer.AllocateCoalescer(lambda: uow, window=0.3)
+    leader = threading.Thread(target=coalescing.allocate, args=('o1', 'SLOW-SOFA', 10))
+    leader.start()
+    time.sleep(0.05)
+
+    with deadlines.deadline(0.05), pytest.raises(deadlines.DeadlineExceeded):
+        coalescing.allocate('o2', 'SLOW-SOFA', 10)
+    leader.join()
+
+    assert product.batches[0].available_quantity == 90
+
+
+def test_a_follower_with_time_left_allocates_when_the_leader_ran_out():
+    product = model.Product('LATE-SOFA', [model.Batch('b1', 'LATE-SOFA', 100, None)])
+    coalescing = coalescer.AllocateCoalescer(lambda: CountingUnitOfWork([product]), window=0.2)
+    results = {}
+
+    def hurried_leader():
+        with deadlines.deadline(0.05):
+            try:
+                coalescing.allocate('o1', 'LATE-SOFA', 10)
+            except deadlines.DeadlineExceeded as e:
+                results['o1'] = e
+    leader = threading.Thread(target=hurried_leader)
+    leader.start()
+    time.sleep(0.02)
+
+    assert coalescing.allocate('o2', 'LATE-SOFA', 10) == 'b1'
+    leader.join()
+    assert isinstance(results['o1'], deadlines.DeadlineExceeded)
+    assert product.batches[0].available_quantity == 90
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import pytest
+from allocation.domain import events
+from allocation.service_layer import deadlines, locks, messagebus, services, unit_of_work
+
+
+def test_no_deadline_by_default():
+    assert deadlines.remaining() is None
+    deadlines.check()
+
+
+def test_uow_refuses_to_start_after_the_deadline():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    services.add_batch('b1', 'LATE-LAMP', 100, None, uow)
+
+    with deadlines.deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(deadlines.DeadlineExceeded):
+            services.allocate('o1', 'LATE-LAMP', 10, uow)
+
+    assert uow.products.get('LATE-LAMP').batches[0].available_quantity == 100
+
+
+def test_non_essential_handlers_are_skipped_once_the_deadline_passed(monkeypatch):
+    sent = []
+    monkeypatch.setattr(messagebus.email, 'send_email', lambda *args: sent.append(args))
+
+    with deadlines.deadline(0):
+        messagebus.handle(events.OutOfStock('LATE-SOFA'))
+    messagebus.handle(events.OutOfStock('LATE-SOFA'))
+
+    assert len(sent) == 1
+
+
+def test_waiting_for_a_sku_lock_ends_with_the_deadline():
+    manager = locks.SkuLockManager()
+    holder = threading.Thread(target=manager.acquire, args=('LAMP',))
+    holder.start()
+    holder.join()  # the lock stays with the (finished) thread
+
+    start = time.perf_counter()
+    with deadlines.deadline(0.05), pytest.raises(deadlines.DeadlineExceeded):
+        manager.acquire('LAMP')
+    assert time.perf_counter() - start < 1
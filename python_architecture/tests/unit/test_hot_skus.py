@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from allocation.domain import model
+from allocation.service_layer import hot_skus, services, unit_of_work
+
+
+def test_space_saving_keeps_the_heavy_hitters_within_k_counters():
+    summary = hot_skus.SpaceSaving(k=10)
+    rng = random.Random(42)
+    keys = ['HOT-1'] * 500 + ['HOT-2'] * 300 + [f'COLD-{i}' for i in range(1000)]
+    rng.shuffle(keys)
+    for key in keys:
+        summary.add(key)
+
+    assert len(summary.counts) == 10
+    assert 'HOT-1' in summary.counts and 'HOT-2' in summary.counts
+    for key in ('HOT-1', 'HOT-2'):
+        true_count = keys.count(key)
+        assert summary.counts[key] - summary.errors[key] <= true_count <= summary.counts[key]
+
+
+def test_top_ranks_by_metric():
+    tracker = hot_skus.HotSkus(k=5)
+    for sku, n in [('LAMP', 3), ('SOFA', 7), ('TABLE', 1)]:
+        for _ in range(n):
+            tracker.record(sku, allocations=1, uow_time=0.01)
+    tracker.record('TABLE', uow_time=1.0)
+
+    assert [h.sku for h in tracker.top('allocations')] == ['SOFA', 'LAMP', 'TABLE']
+    assert tracker.top('uow_time', 1)[0].sku == 'TABLE'
+    assert tracker.top('allocations')[0].per_second > 0
+    assert tracker.top('rollbacks') == []
+    with pytest.raises(ValueError):
+        tracker.top('popularity')
+
+
+def test_old_windows_roll_off(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(hot_skus.time, 'monotonic', lambda: now[0])
+    tracker = hot_skus.HotSkus(window=60)
+    tracker.record('LAMP', allocations=5)
+
+    now[0] += 61
+    tracker.record('SOFA', allocations=1)
+    assert {h.sku for h in tracker.top('allocations')} == {'LAMP', 'SOFA'}
+
+    now[0] += 61
+    assert [h.sku for h in tracker.top('allocations')] == ['SOFA']
+    now[0] += 200
+    assert tracker.top('allocations') == []
+
+
+def test_services_and_unit_of_work_feed_the_tracker(monkeypatch):
+    tracker = hot_skus.HotSkus()
+    monkeypatch.setattr(hot_skus, 'TRACKER', tracker)
+    uow = unit_of_work.InMemoryUnitOfWork()
+    services.add_batch('b1', 'LAMP', 100, None, uow)
+    services.allocate('o1', 'LAMP', 10, uow)
+    services.allocate('o2', 'LAMP', 10, uow)
+
+    [hot] = tracker.top('allocations')
+    assert (hot.sku, hot.value) == ('LAMP', 2)
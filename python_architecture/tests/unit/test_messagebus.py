@@ -0,0 +1,112 @@
+from dataclasses import dataclass
+
+import pytest
+
+from allocation.domain import events
+from allocation.service_layer import deadlines, messagebus
+
+
+@dataclass
+class UrgentOutOfStock(events.OutOfStock):
+    pass
+
+
+class NobodyCares(events.Event):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def fresh_bus(monkeypatch):
+    monkeypatch.setattr(messagebus, 'HANDLERS', {})
+    monkeypatch.setattr(messagebus, 'DEAD_LETTERS', messagebus.DeadLetters())
+    monkeypatch.setattr(messagebus, '_stats', {})
+    monkeypatch.setattr(messagebus, 'BACKOFF', 0.001)
+
+
+def test_handlers_apply_to_subclasses_of_their_event():
+    seen = []
+    def on_any(event): seen.append(('any', event))
+    def on_out_of_stock(event): seen.append(('oos', event))
+    messagebus.HANDLERS[events.Event] = [on_any]
+    messagebus.HANDLERS[events.OutOfStock] = [on_out_of_stock]
+
+    messagebus.handle(UrgentOutOfStock('LAMP'))
+
+    assert [name for name, _ in seen] == ['oos', 'any']
+    assert messagebus.handlers_for(UrgentOutOfStock) == (on_out_of_stock, on_any)
+
+
+def test_unknown_events_are_fine():
+    messagebus.handle(NobodyCares())
+
+
+def test_changing_the_handlers_resets_the_dispatch_table():
+    seen = []
+    messagebus.handle(events.OutOfStock('LAMP'))
+    messagebus.HANDLERS[events.OutOfStock] = [seen.append]
+    messagebus.handle(events.OutOfStock('LAMP'))
+    assert seen == [events.OutOfStock('LAMP')]
+
+
+def test_changes_in_place_and_a_new_handlers_reset_it_too(monkeypatch):
+    seen, others = [], []
+    messagebus.HANDLERS[events.OutOfStock] = []
+    messagebus.handle(events.OutOfStock('LAMP'))
+
+    messagebus.HANDLERS[events.OutOfStock].append(seen.append)
+    messagebus.handle(events.OutOfStock('LAMP'))
+    monkeypatch.setattr(messagebus, 'HANDLERS', {events.Event: [others.append]})
+    messagebus.handle(events.OutOfStock('SOFA'))
+
+    assert seen == [events.OutOfStock('LAMP')]
+    assert others == [events.OutOfStock('SOFA')]
+
+
+def test_a_failing_handler_is_retried_and_does_not_stop_the_others():
+    calls, seen = [], []
+    def flaky(event):
+        calls.append(event)
+        if len(calls) < 3:
+            raise ConnectionError('try again')
+    messagebus.HANDLERS[events.OutOfStock] = [flaky, seen.append]
+
+    messagebus.handle(events.OutOfStock('LAMP'))
+
+    assert len(calls) == 3 and len(seen) == 1
+    stats = messagebus.metrics()['handlers']['flaky']
+    assert (stats.calls, stats.failures, stats.retries) == (3, 2, 2)
+    assert len(messagebus.DEAD_LETTERS) == 0
+
+
+def test_events_which_keep_failing_end_up_in_the_dead_letters():
+    fail = [True]
+    def broken(event):
+        if fail[0]:
+            raise ValueError('nope')
+    messagebus.HANDLERS[events.OutOfStock] = [broken]
+
+    messagebus.handle(events.OutOfStock('LAMP'))
+
+    [letter] = messagebus.DEAD_LETTERS
+    assert letter.event == events.OutOfStock('LAMP')
+    assert letter.attempts == messagebus.MAX_ATTEMPTS
+    assert letter.error == 'ValueError: nope'
+    assert messagebus.metrics()['dead_letters'] == 1
+
+    fail[0] = False
+    assert messagebus.DEAD_LETTERS.redeliver() == 1
+    assert len(messagebus.DEAD_LETTERS) == 0
+
+
+def test_no_retries_past_the_deadline():
+    calls = []
+    def broken(event):
+        calls.append(event)
+        raise ValueError('nope')
+    messagebus.HANDLERS[events.OutOfStock] = [broken]
+
+    with deadlines.deadline(0.0001):
+        messagebus.handle(events.OutOfStock('LAMP'))
+
+    assert len(calls) == 1
+    assert len(messagebus.DEAD_LETTERS) == 1
@@ -0,0 +1,36 @@
+import json
+
+from allocation.entrypoints import replay
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.domain import events
+
+
+COMMANDS = [
+    {'cmd': 'add_batch', 'ref': 'b1', 'sku': 'REPLAY-LAMP', 'qty': 20, 'eta': None},
+    {'cmd': 'add_batch', 'ref': 'b2', 'sku': 'REPLAY-LAMP', 'qty': 20, 'eta': '2011-01-02'},
+    {'cmd': 'allocate', 'orderid': 'o1', 'sku': 'REPLAY-LAMP', 'qty': 15},
+    {'cmd': 'allocate', 'orderid': 'o2', 'sku': 'REPLAY-LAMP', 'qty': 15},
+    {'cmd': 'allocate', 'orderid': 'o3', 'sku': 'REPLAY-LAMP', 'qty': 15},
+    {'cmd': 'allocate', 'orderid': 'o4', 'sku': 'NO-SUCH-SKU', 'qty': 1},
+]
+
+
+def test_replay_reports_outcomes_and_final_stock():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    handlers = messagebus.HANDLERS[events.OutOfStock]
+
+    report = replay.replay(COMMANDS, lambda: uow)
+
+    assert report.commands == 6
+    assert report.out_of_stock == 1
+    assert report.errors == {'InvalidSku': 1}
+    assert report.stock == {'REPLAY-LAMP': 10}
+    assert set(report.percentiles('allocate')) == {50, 90, 99, 100}
+    assert messagebus.HANDLERS[events.OutOfStock] == handlers
+
+
+def test_replay_reads_ndjson(tmp_path):
+    path = tmp_path / 'orders.ndjson'
+    path.write_text('\n'.join(json.dumps(c) for c in COMMANDS) + '\n')
+
+    assert list(replay.read_commands(path)) == COMMANDS
@@ -0,0 +1,46 @@
+import threading
+import time
+
+from allocation.entrypoints import sampler
+
+
+def busy_allocating(stop):
+    while not stop.is_set():
+        sum(i * i for i in range(1000))
+
+
+def test_sampler_sees_where_the_time_goes():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_allocating, args=(stop,))
+    worker.start()
+    profile = sampler.StackSampler(interval=0.001)
+
+    profile.run_for(0.2)
+    stop.set()
+    worker.join()
+
+    assert f'{__name__}:busy_allocating' in profile.collapsed()
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in profile.collapsed().splitlines())
+
+
+def test_sampler_stops_after_the_requests():
+    profile = sampler.StackSampler()
+    threading.Timer(0.05, lambda: [profile.request_done() for _ in range(3)]).start()
+
+    start = time.monotonic()
+    profile.run_for(10, max_requests=3)
+
+    assert time.monotonic() - start < 5
+
+
+def test_speedscope_profile_shares_the_frames():
+    profile = sampler.StackSampler()
+    profile.samples.update({('a:main', 'b:allocate'): 3, ('a:main', 'c:commit'): 1})
+
+    speedscope = profile.speedscope()
+
+    assert [f['name'] for f in speedscope['shared']['frames']] == [
+        'a:main', 'b:allocate', 'c:commit'
+    ]
+    assert speedscope['profiles'][0]['samples'] == [[0, 1], [0, 2]]
+    assert speedscope['profiles'][0]['weights'] == [3, 1]
@@ -74,3 +74,21 @@ def test_commits():
     services.add_batch("b1", "OMINOUS-MIRROR", 100, None, uow)
     services.allocate("o1", "OMINOUS-MIRROR", 10, uow)
     assert uow.committed is True
+
+
+def test_get_product_reports_available_quantities():
+    uow = FakeUnitOfWork()
+    services.add_batch("b1", "TALL-SHELF", 100, None, uow)
+    services.allocate("o1", "TALL-SHELF", 10, uow)
+
+    product = services.get_product("TALL-SHELF", uow)
+
+    assert product["batches"] == [{"ref": "b1", "eta": None, "available": 90}]
+
+
+def test_get_stock_without_a_read_model_uses_the_aggregate():
+    uow = FakeUnitOfWork()
+    services.add_batch("b1", "SHORT-SHELF", 100, None, uow)
+    services.allocate("o1", "SHORT-SHELF", 10, uow)
+
+    assert services.get_stock("SHORT-SHELF", uow)["available"] == 90
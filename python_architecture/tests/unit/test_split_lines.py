@@ -0,0 +1,61 @@
+from datetime import date, timedelta
+
+import pytest
+
+from allocation.domain import events
+from allocation.domain.model import Batch, OrderLine, Product, plan_split
+
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = tomorrow + timedelta(days=10)
+
+
+def test_splits_a_line_over_batches_in_eta_order():
+    later_batch = Batch("later", "BIG-TABLE", 50, eta=later)
+    in_stock = Batch("in-stock", "BIG-TABLE", 30, eta=None)
+    tomorrows = Batch("tomorrow", "BIG-TABLE", 40, eta=tomorrow)
+    product = Product("BIG-TABLE", batches=[later_batch, tomorrows, in_stock])
+
+    allocations = product.allocate_split(OrderLine("b2b-order", "BIG-TABLE", 100))
+
+    assert allocations == [("in-stock", 30), ("tomorrow", 40), ("later", 30)]
+    assert [b.available_quantity for b in (in_stock, tomorrows, later_batch)] == [0, 0, 20]
+    assert OrderLine("b2b-order", "BIG-TABLE", 30) in later_batch._allocations
+    assert product.version_number == 1
+
+
+def test_skips_batches_with_nothing_left():
+    empty = Batch("empty", "BIG-TABLE", 10, eta=None)
+    empty.allocate(OrderLine("earlier", "BIG-TABLE", 10))
+    full = Batch("full", "BIG-TABLE", 10, eta=tomorrow)
+    product = Product("BIG-TABLE", batches=[empty, full])
+
+    assert product.allocate_split(OrderLine("o1", "BIG-TABLE", 4)) == [("full", 4)]
+
+
+def test_does_not_look_past_the_batch_covering_the_line():
+    class Unavailable(Batch):
+        @property
+        def available_quantity(self):
+            raise AssertionError("should not be needed")
+
+    batches = [Batch("b1", "BIG-TABLE", 10, eta=None),
+               Unavailable("b2", "BIG-TABLE", 10, eta=later)]
+
+    assert [qty for _, qty in plan_split(OrderLine("o1", "BIG-TABLE", 10), batches)] == [10]
+
+
+def test_allocates_nothing_if_all_batches_together_are_not_enough():
+    batches = [Batch("b1", "BIG-TABLE", 10, eta=None), Batch("b2", "BIG-TABLE", 10, eta=today)]
+    product = Product("BIG-TABLE", batches=batches)
+
+    assert product.allocate_split(OrderLine("o1", "BIG-TABLE", 21)) is None
+    assert product.events[-1] == events.OutOfStock(sku="BIG-TABLE")
+    assert [b.available_quantity for b in batches] == [10, 10]
+    assert product.version_number == 0
+
+
+def test_there_is_nothing_to_split_in_an_empty_line():
+    with pytest.raises(ValueError):
+        plan_split(OrderLine("o1", "BIG-TABLE", 0), [Batch("b1", "BIG-TABLE", 10, eta=None)])